@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Extract input variables & parameters of formulas from the bytecode of their functions, without needing their source.
+
+The code objects of formulas are interpreted abstractly: only the values needed to find the calculated variables and
+the legislation parameters are tracked (string constants, legislation nodes, calculation methods, functions & code
+objects), every other value being unknown (None).
+"""
+
+
+import dis
+import inspect
+import os
+import sys
+
+from . import formulas_parsers_2to3
+from .source_formulas_extractors import calculation_methods_name
+
+
+# Numbers of values popped & pushed by the opcodes whose stack effect doesn't depend on their argument and that have no
+# specific interpretation
+stack_effect_by_opname = dict(
+    (opname, (2, 1) if opname.startswith(('BINARY_', 'INPLACE_')) else (1, 1))
+    for opname in dis.opmap
+    if opname.startswith(('BINARY_', 'INPLACE_', 'UNARY_'))
+    )
+stack_effect_by_opname.update({
+    'BUILD_CLASS': (3, 1),
+    'BUILD_MAP': (0, 1),
+    'COMPARE_OP': (2, 1),
+    'DELETE_ATTR': (1, 0),
+    'DELETE_FAST': (0, 0),
+    'DELETE_GLOBAL': (0, 0),
+    'DELETE_NAME': (0, 0),
+    'DELETE_SLICE+0': (1, 0),
+    'DELETE_SLICE+1': (2, 0),
+    'DELETE_SLICE+2': (2, 0),
+    'DELETE_SLICE+3': (3, 0),
+    'DELETE_SUBSCR': (2, 0),
+    'END_FINALLY': (1, 0),
+    'EXEC_STMT': (3, 0),
+    'GET_ITER': (1, 1),
+    'IMPORT_FROM': (0, 1),
+    'IMPORT_NAME': (2, 1),
+    'IMPORT_STAR': (1, 0),
+    'LIST_APPEND': (1, 0),
+    'LOAD_CLOSURE': (0, 1),
+    'LOAD_LOCALS': (0, 1),
+    'MAP_ADD': (2, 0),
+    'NOP': (0, 0),
+    'POP_BLOCK': (0, 0),
+    'POP_TOP': (1, 0),
+    'PRINT_EXPR': (1, 0),
+    'PRINT_ITEM': (1, 0),
+    'PRINT_ITEM_TO': (2, 0),
+    'PRINT_NEWLINE': (0, 0),
+    'PRINT_NEWLINE_TO': (1, 0),
+    'SET_ADD': (1, 0),
+    'SLICE+0': (1, 1),
+    'SLICE+1': (2, 1),
+    'SLICE+2': (2, 1),
+    'SLICE+3': (3, 1),
+    'STOP_CODE': (0, 0),
+    'STORE_ATTR': (2, 0),
+    'STORE_GLOBAL': (1, 0),
+    'STORE_MAP': (2, 0),
+    'STORE_NAME': (1, 0),
+    'STORE_SLICE+0': (2, 0),
+    'STORE_SLICE+1': (3, 0),
+    'STORE_SLICE+2': (3, 0),
+    'STORE_SLICE+3': (4, 0),
+    'STORE_SUBSCR': (3, 0),
+    'WITH_CLEANUP': (2, 1),
+    'YIELD_VALUE': (1, 1),
+    })
+
+
+class Extractor(object):
+    """Extractor of the input variables & parameters of formulas, with the same interface as the parsers of
+    input_variables_extractors
+    """
+    column = None  # Column whose formula is being extracted
+    helper_source_files_path = None  # Source files of the module functions used by the formula of the last column
+    input_variables = None  # Names of the variables calculated by the formula being extracted
+    interpreted_codes = None  # Code objects already interpreted for the formula being extracted
+    interpreted_keys = None  # (code, arguments) couples already interpreted for the formula being extracted
+    legislation = None  # Legislation JSON, loaded on first use
+    package_dir = None  # Directory of the country package: only its functions are followed when called by formulas
+    parameters_tree = None  # Tree of the legislation nodes used by the last column formula (see add_parameter_path)
+    tax_benefit_system = None
+
+    def __init__(self, tax_benefit_system = None):
+        assert tax_benefit_system is not None
+        self.tax_benefit_system = tax_benefit_system
+        package = sys.modules[tax_benefit_system.__class__.__module__.split('.')[0]]
+        self.package_dir = os.path.dirname(os.path.abspath(package.__file__))
+
+    def call(self, function_value, arguments, argument_by_name, global_value_by_name, cell_value_by_name):
+        """Interpret the call of a value with given values as arguments and return the value of the result."""
+        if function_value is None:
+            return None
+        kind = function_value[0]
+        if kind == u'method':
+            method_name = function_value[1]
+            if method_name == u'legislation_at':
+                return (u'legislation', ())
+            input_variable = arguments[0] if arguments else None
+            if input_variable is not None:
+                if input_variable[0] == u'string':
+                    self.input_variables.add(input_variable[1])
+                elif input_variable[0] == u'class_name':
+                    # Assume this is "self.__class__.__name__".
+                    self.input_variables.add(self.column.name)
+        elif kind == u'function':
+            function = function_value[1]
+            # Without source, use the compiled file of the module of the function.
+            self.helper_source_files_path.add(inspect.getsourcefile(function) or function.func_globals['__file__'])
+            self.interpret_code(function.func_code, arguments, argument_by_name, function.func_globals, {})
+        elif kind == u'code':
+            self.interpret_code(function_value[1], arguments, argument_by_name, global_value_by_name,
+                cell_value_by_name)
+        return None
+
+    def get_global_value(self, name, global_value_by_name):
+        if name == u'law':
+            return (u'legislation', ())
+        value = global_value_by_name.get(name)
+        if inspect.isfunction(value) and os.path.abspath(value.func_code.co_filename).startswith(
+                self.package_dir + os.sep):
+            return (u'function', value)
+        return None
+
+    def get_input_variables_and_parameters(self, column):
+        formula_class = column.formula_class
+        assert formula_class is not None, "Column {} has no formula".format(column.name)
+        if column.is_input_variable():
+            return None, None
+        self.column = column
+        self.helper_source_files_path = set()
+        self.input_variables = input_variables = set()
+        self.interpreted_codes = set()
+        self.interpreted_keys = set()
+        self.parameters_tree = parameters_tree = {}
+        dated_formulas_class = getattr(formula_class, 'dated_formulas_class', None)
+        for formula_class in ([formula_class] if dated_formulas_class is None else [
+                dated_formula_class['formula_class']
+                for dated_formula_class in dated_formulas_class
+                ]):
+            function = formula_class.function.im_func
+            self.interpret_code(function.func_code, (), {}, function.func_globals, {})
+        parameters = set(formulas_parsers_2to3.iter_parameters_name(parameters_tree))
+        del self.column
+        del self.input_variables
+        del self.interpreted_codes
+        del self.interpreted_keys
+        return input_variables, parameters
+
+    def get_legislation_node(self, names):
+        """Return the JSON of the legislation node at given path, or None when it is not a node."""
+        node = self.legislation
+        if node is None:
+            self.legislation = node = self.tax_benefit_system.get_legislation()
+        for name in names:
+            node = node['children'].get(name)
+            if node is None or node['@type'] != u'Node':
+                return None
+        return node
+
+    def interpret_code(self, code, arguments, argument_by_name, global_value_by_name, cell_value_by_name):
+        """Interpret a code object called with given values as arguments."""
+        key = (code, tuple(arguments), frozenset(argument_by_name.iteritems()))
+        if key in self.interpreted_keys:
+            return
+        self.interpreted_keys.add(key)
+        self.interpreted_codes.add(code)
+        value_by_name = dict(zip(code.co_varnames[:code.co_argcount], arguments))
+        value_by_name.update(argument_by_name)
+        cell_and_free_vars = code.co_cellvars + code.co_freevars
+
+        reachable = True
+        stack = []
+        stack_by_offset = {}  # Stacks at the targets of the jumps already interpreted
+        for offset, opcode, argument, next_offset in iter_instructions(code):
+            saved_stack = stack_by_offset.pop(offset, None)
+            if not reachable:
+                # After an unconditional jump, the stack is the one of the jumps to this instruction.
+                stack = saved_stack if saved_stack is not None else []
+                reachable = True
+            opname = dis.opname[opcode]
+            if opcode in dis.hasjrel:
+                target = next_offset + argument
+            elif opcode in dis.hasjabs:
+                target = argument
+
+            stack_effect = stack_effect_by_opname.get(opname)
+            if stack_effect is not None:
+                pops_count, pushes_count = stack_effect
+                pop_values(stack, pops_count)
+                stack.extend([None] * pushes_count)
+            elif opname in ('BUILD_LIST', 'BUILD_SET', 'BUILD_SLICE', 'BUILD_TUPLE'):
+                pop_values(stack, argument)
+                stack.append(None)
+            elif opname in ('BREAK_LOOP', 'CONTINUE_LOOP', 'JUMP_ABSOLUTE', 'JUMP_FORWARD'):
+                if opname != 'BREAK_LOOP':
+                    stack_by_offset.setdefault(target, list(stack))
+                reachable = False
+            elif opname in ('CALL_FUNCTION', 'CALL_FUNCTION_KW', 'CALL_FUNCTION_VAR', 'CALL_FUNCTION_VAR_KW'):
+                pop_values(stack, {'CALL_FUNCTION_KW': 1, 'CALL_FUNCTION_VAR': 1, 'CALL_FUNCTION_VAR_KW': 2}.get(
+                    opname, 0))
+                keywords_and_values = pop_values(stack, 2 * (argument >> 8))
+                call_argument_by_name = dict(
+                    (keyword[1], value)
+                    for keyword, value in zip(keywords_and_values[::2], keywords_and_values[1::2])
+                    if keyword is not None and keyword[0] == u'string'
+                    )
+                call_arguments = pop_values(stack, argument & 0xFF)
+                function_value = pop_values(stack, 1)[0]
+                stack.append(self.call(function_value, call_arguments, call_argument_by_name, global_value_by_name,
+                    cell_value_by_name))
+            elif opname == 'DUP_TOP':
+                stack.append(stack[-1] if stack else None)
+            elif opname == 'DUP_TOPX':
+                values = pop_values(stack, argument)
+                stack.extend(values + values)
+            elif opname == 'FOR_ITER':
+                stack_by_offset.setdefault(target, stack[:-1])
+                stack.append(None)
+            elif opname in ('JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP'):
+                stack_by_offset.setdefault(target, list(stack))
+                pop_values(stack, 1)
+            elif opname == 'LOAD_ATTR':
+                subject = pop_values(stack, 1)[0]
+                name = code.co_names[argument]
+                if subject is not None and subject[0] == u'legislation':
+                    names = subject[1] + (name,)
+                    formulas_parsers_2to3.add_parameter_path(self.parameters_tree, names)
+                    stack.append((u'legislation', names) if self.get_legislation_node(names) is not None else None)
+                elif name in calculation_methods_name or name == 'legislation_at':
+                    stack.append((u'method', name))
+                elif name == '__name__':
+                    stack.append((u'class_name',))
+                else:
+                    stack.append(None)
+            elif opname == 'LOAD_CONST':
+                constant = code.co_consts[argument]
+                if isinstance(constant, basestring):
+                    stack.append((u'string', constant.decode('utf-8') if isinstance(constant, str) else constant))
+                elif inspect.iscode(constant):
+                    stack.append((u'code', constant))
+                else:
+                    stack.append(None)
+            elif opname == 'LOAD_DEREF':
+                stack.append(cell_value_by_name.get(cell_and_free_vars[argument]))
+            elif opname == 'LOAD_FAST':
+                stack.append(value_by_name.get(code.co_varnames[argument]))
+            elif opname in ('LOAD_GLOBAL', 'LOAD_NAME'):
+                stack.append(self.get_global_value(code.co_names[argument], global_value_by_name))
+            elif opname in ('MAKE_CLOSURE', 'MAKE_FUNCTION'):
+                code_value = pop_values(stack, 1)[0]
+                pop_values(stack, argument + (1 if opname == 'MAKE_CLOSURE' else 0))
+                stack.append(code_value)
+            elif opname in ('POP_JUMP_IF_FALSE', 'POP_JUMP_IF_TRUE'):
+                pop_values(stack, 1)
+                stack_by_offset.setdefault(target, list(stack))
+            elif opname == 'RAISE_VARARGS':
+                pop_values(stack, argument)
+                reachable = False
+            elif opname == 'RETURN_VALUE':
+                pop_values(stack, 1)
+                reachable = False
+            elif opname in ('ROT_FOUR', 'ROT_THREE', 'ROT_TWO'):
+                values = pop_values(stack, {'ROT_FOUR': 4, 'ROT_THREE': 3, 'ROT_TWO': 2}[opname])
+                stack.extend(values[-1:] + values[:-1])
+            elif opname == 'SETUP_EXCEPT':
+                # The exception handler starts with the exception type, value & traceback.
+                stack_by_offset.setdefault(target, stack + [None] * 3)
+            elif opname == 'SETUP_FINALLY':
+                stack_by_offset.setdefault(target, stack + [None])
+            elif opname == 'SETUP_LOOP':
+                stack_by_offset.setdefault(target, list(stack))
+            elif opname == 'SETUP_WITH':
+                pop_values(stack, 1)
+                # The "__exit__" method of the context manager stays on the stack, below the value of "__enter__()".
+                stack.append(None)
+                stack_by_offset.setdefault(target, stack + [None])
+                stack.append(None)
+            elif opname == 'STORE_DEREF':
+                cell_value_by_name[cell_and_free_vars[argument]] = pop_values(stack, 1)[0]
+            elif opname == 'STORE_FAST':
+                value_by_name[code.co_varnames[argument]] = pop_values(stack, 1)[0]
+            elif opname == 'UNPACK_SEQUENCE':
+                pop_values(stack, 1)
+                stack.extend([None] * argument)
+            else:
+                assert False, u'Unexpected opcode {} in {}'.format(opname, code)
+
+        # Interpret the nested functions that have not been called, like the lambdas given to helpers.
+        for constant in code.co_consts:
+            if inspect.iscode(constant) and constant not in self.interpreted_codes:
+                self.interpret_code(constant, (), {}, global_value_by_name, cell_value_by_name)
+
+
+def iter_instructions(code):
+    """Iterate over the (offset, opcode, argument, next offset) of the instructions of a code object."""
+    co_code = code.co_code
+    extended_argument = 0
+    offset = 0
+    while offset < len(co_code):
+        opcode = ord(co_code[offset])
+        if opcode < dis.HAVE_ARGUMENT:
+            yield offset, opcode, None, offset + 1
+            offset += 1
+            continue
+        argument = ord(co_code[offset + 1]) + ord(co_code[offset + 2]) * 256 + extended_argument
+        extended_argument = 0
+        if opcode == dis.EXTENDED_ARG:
+            extended_argument = argument * 65536
+        else:
+            yield offset, opcode, argument, offset + 3
+        offset += 3
+
+
+def pop_values(stack, count):
+    """Pop count values from the stack, completing them with unknown values when the stack is too short."""
+    if count == 0:
+        return []
+    values = stack[-count:]
+    del stack[-count:]
+    return [None] * (count - len(values)) + values
+
+
+def setup(tax_benefit_system):
+    """Return an extractor of the input variables & parameters of the formulas of a tax-benefit system."""
+    return Extractor(tax_benefit_system = tax_benefit_system)
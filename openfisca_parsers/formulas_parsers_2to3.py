@@ -28,19 +28,36 @@
 
 from __future__ import division
 
+import ast
 import collections
+import cPickle
+import functools
+import hashlib
 import inspect
 import itertools
+import linecache
+import lib2to3.pgen2.parse
 import lib2to3.pgen2.token
+import lib2to3.pgen2.tokenize
 import lib2to3.pygram
 import lib2to3.pytree
+import logging
 import os
+import sys
+import tempfile
 import textwrap
 
 from biryani.states import State
 import numpy as np
 
 
+log = logging.getLogger(__name__)
+# Lines of a class definition in a source file, from the line of its class statement to the last line of its body
+SourceLocation = collections.namedtuple('SourceLocation', ['file_path', 'first_line_number', 'last_line_number'])
+# Position of a lib2to3 node, kept by wrappers instead of the node itself in lean mode:
+# file_path & first_line_number are those of the parsed source (first_line_number is None when the whole file has been
+# parsed), line_number & column are the position of the node in the parsed source.
+SourceSpan = collections.namedtuple('SourceSpan', ['file_path', 'first_line_number', 'line_number', 'column', 'type'])
 symbols = lib2to3.pygram.python_symbols  # Note: symbols is a module.
 tokens = lib2to3.pgen2.token  # Note: tokens is a module.
 type_symbol = lib2to3.pytree.type_repr  # Note: type_symbol is a function.
@@ -60,7 +77,7 @@ lib2to3.pytree.Leaf.__unicode__ = lambda self: self.prefix.decode('utf-8') + (se
 class AbstractWrapper(object):
     container = None  # The wrapper directly containing this wrapper
     hint = None  # A wrapper that is the hinted type of this wrapper
-    node = None  # The lib2to3 node
+    node = None  # The syntax tree node (a lib2to3 node, unless the parser has another node_class)
     parser = None
 
     def __init__(self, container = None, hint = None, node = None, parser = None):
@@ -72,13 +89,13 @@ class AbstractWrapper(object):
             assert isinstance(hint, AbstractWrapper), "Invalid hint {} for node:\n{}\n\n{}".format(hint, repr(node),
                 unicode(node).encode('utf-8'))
             self.hint = hint
-        if node is not None:
-            assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
-                unicode(node).encode('utf-8'))
-            self.node = node
         assert isinstance(parser, Parser), "Invalid parser {} for node:\n{}\n\n{}".format(parser, repr(node),
             unicode(node).encode('utf-8'))
         self.parser = parser
+        if node is not None:
+            assert isinstance(node, parser.node_class), "Invalid node:\n{}\n\n{}".format(repr(node),
+                unicode(node).encode('utf-8'))
+            self.node = parser.get_source_span(node) if parser.lean else node
 
     @property
     def containing_class(self):
@@ -101,6 +118,13 @@ class AbstractWrapper(object):
             return None
         return container.containing_module
 
+    def get_node(self):
+        """Return the lib2to3 node of wrapper, parsing its source again in lean mode."""
+        node = self.node
+        if isinstance(node, SourceSpan):
+            node = self.parser.get_span_node(node)
+        return node
+
     def guess(self, expected):
         assert issubclass(expected, AbstractWrapper)
         if isinstance(self, expected):
@@ -432,6 +456,38 @@ class Assignment(AbstractWrapper):
 
 
 class Attribute(AbstractWrapper):
+    # Names of the expected wrapper classes of guesser_name_by_key, by decreasing priority: Like an if/elif cascade,
+    # only the guessers of the first class that is a subclass of the expected class are used.
+    guess_categories = [
+        'Boolean',
+        'CompactNode',
+        'Date',
+        'Entity',
+        'FormulaClass',
+        'Holder',
+        'Instant',
+        'Number',
+        'String',
+        'TaxScale',
+        'UniformDictionary',
+        ]
+    # Names of the methods guessing the value of an attribute, by (expected wrapper class name, attribute name).
+    # The guesser of a None attribute name is used when no guesser of the attribute name exists or finds nothing.
+    # Subclasses can copy and extend this table, and guess_categories.
+    guesser_name_by_key = {
+        ('Boolean', None): 'guess_boolean_parameter',
+        ('CompactNode', None): 'guess_compact_node',
+        ('Date', u'date'): 'guess_period_date',
+        ('Entity', u'entity'): 'guess_holder_entity',
+        ('FormulaClass', u'__class__'): 'guess_formula_class',
+        ('Holder', u'holder'): 'guess_formula_holder',
+        ('Instant', u'start'): 'guess_period_start',
+        ('Number', None): 'guess_number_parameter',
+        ('Number', u'count'): 'guess_entity_count',
+        ('String', u'__name__'): 'guess_formula_class_name',
+        ('TaxScale', None): 'guess_tax_scale',
+        ('UniformDictionary', u'_array_by_period'): 'guess_holder_array_by_period',
+        }
     name = None
     subject = None
 
@@ -447,91 +503,127 @@ class Attribute(AbstractWrapper):
         if guessed is not None:
             return guessed
 
+        category = self.parser.get_guess_category(self.__class__, 'guesser_name_by_key', expected)
+        if category is None:
+            return None
+        guesser_name = self.guesser_name_by_key.get((category, self.name))
+        if guesser_name is not None:
+            guessed = getattr(self, guesser_name)(expected)
+            if guessed is not None:
+                return guessed
+        guesser_name = self.guesser_name_by_key.get((category, None))
+        if guesser_name is not None:
+            return getattr(self, guesser_name)(expected)
+        return None
+
+    def guess_boolean_parameter(self, expected):
         parser = self.parser
-        if issubclass(parser.Boolean, expected):
-            compact_node_wrapper = self.subject.guess(parser.CompactNode)
-            if compact_node_wrapper is not None:
-                child_json = compact_node_wrapper.value['children'][self.name]
-                child_type = child_json['@type']
-                if child_type == u'Parameter' and child_json.get('format') == 'boolean':
-                    return parser.Boolean(parser = parser)
-        elif issubclass(parser.CompactNode, expected):
-            compact_node = self.subject.guess(parser.CompactNode)
-            if compact_node is not None:
-                child_json = compact_node.value['children'].get(self.name)
-                if child_json is not None:
-                    child_type = child_json['@type']
-                    if child_type == u'Node':
-                        return parser.CompactNode(is_reference = compact_node.is_reference, name = self.name,
-                            parent = compact_node, parser = parser, value = child_json)
-        elif issubclass(parser.Date, expected):
-            if self.name == 'date':
-                period = self.subject.guess(parser.Period)
-                if period is not None:
-                    return parser.Date(parser = parser)
-        elif issubclass(parser.Entity, expected):
-            if self.name == 'entity':
-                holder = self.subject.guess(parser.Holder)
-                if holder is not None:
-                    entity_class = holder.column.entity
-                    return parser.Entity(entity_class = entity_class, parser = parser)
-        elif issubclass(parser.FormulaClass, expected):
-            if self.name == '__class__':
-                formula = self.subject.guess(parser.Formula)
-                if formula is not None:
-                    return formula.formula_class
-        elif issubclass(parser.Holder, expected):
-            if self.name == 'holder':
-                formula = self.subject.guess(parser.Formula)
-                if formula is not None:
-                    return parser.Holder(column = formula.column, parser = parser)
-        elif issubclass(parser.Instant, expected):
-            if self.name == 'start':
-                    period = self.subject.guess(parser.Period)
-                    if period is not None:
-                        return parser.Instant(parser = parser)
-        elif issubclass(parser.Number, expected):
-            if self.name == 'count':
-                entity = self.subject.guest(parser.Entity)
-                if entity is not None:
-                    return parser.Number(parser = parser)
-            compact_node_wrapper = self.subject.guess(parser.CompactNode)
-            if compact_node_wrapper is not None:
-                child_json = compact_node_wrapper.value['children'][self.name]
-                child_type = child_json['@type']
-                if child_type == u'Parameter' and child_json.get('format') != 'boolean':
-                    return parser.Number(parser = parser)
-        elif issubclass(parser.String, expected):
-            if self.name == '__name__':
-                formula_class = self.subject.guess(parser.FormulaClass)
-                if formula_class is not None:
-                    return parser.String(parser = parser, value = parser.column.name)
-        elif issubclass(parser.TaxScale, expected):
-            compact_node_wrapper = self.subject.guess(parser.CompactNode)
-            if compact_node_wrapper is not None:
-                child_json = compact_node_wrapper.value['children'][self.name]
+        compact_node_wrapper = self.subject.guess(parser.CompactNode)
+        if compact_node_wrapper is not None:
+            child_json = compact_node_wrapper.value['children'][self.name]
+            child_type = child_json['@type']
+            if child_type == u'Parameter' and child_json.get('format') == 'boolean':
+                return parser.Boolean(parser = parser)
+        return None
+
+    def guess_compact_node(self, expected):
+        parser = self.parser
+        compact_node = self.subject.guess(parser.CompactNode)
+        if compact_node is not None:
+            child_json = compact_node.value['children'].get(self.name)
+            if child_json is not None:
                 child_type = child_json['@type']
-                if child_type == u'Scale':
-                    return parser.TaxScale(parser = parser)
-        elif issubclass(parser.UniformDictionary, expected):
-            if self.name == '_array_by_period':
-                holder = self.subject.guess(parser.Holder)
-                if holder is not None:
-                    column = holder.column
-                    entity_class = column.entity
-                    cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
-                    return parser.UniformDictionary(
-                        key = parser.Period(
-                            parser = parser,
-                            ),
-                        parser = parser,
-                        value = parser.Array(
-                            cell = cell_wrapper,
-                            entity_class = parser.entity_class,
-                            parser = parser,
-                            ),
-                        )
+                if child_type == u'Node':
+                    return parser.CompactNode(is_reference = compact_node.is_reference, name = self.name,
+                        parent = compact_node, parser = parser, value = child_json)
+        return None
+
+    def guess_entity_count(self, expected):
+        parser = self.parser
+        entity = self.subject.guess(parser.Entity)
+        if entity is not None:
+            return parser.Number(parser = parser)
+        return None
+
+    def guess_formula_class(self, expected):
+        formula = self.subject.guess(self.parser.Formula)
+        if formula is not None:
+            return formula.formula_class
+        return None
+
+    def guess_formula_class_name(self, expected):
+        parser = self.parser
+        formula_class = self.subject.guess(parser.FormulaClass)
+        if formula_class is not None:
+            return parser.String(parser = parser, value = parser.column.name)
+        return None
+
+    def guess_formula_holder(self, expected):
+        parser = self.parser
+        formula = self.subject.guess(parser.Formula)
+        if formula is not None:
+            return parser.Holder(column = formula.column, parser = parser)
+        return None
+
+    def guess_holder_array_by_period(self, expected):
+        parser = self.parser
+        holder = self.subject.guess(parser.Holder)
+        if holder is not None:
+            column = holder.column
+            cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
+            return parser.UniformDictionary(
+                key = parser.Period(
+                    parser = parser,
+                    ),
+                parser = parser,
+                value = parser.Array(
+                    cell = cell_wrapper,
+                    entity_class = parser.entity_class,
+                    parser = parser,
+                    ),
+                )
+        return None
+
+    def guess_holder_entity(self, expected):
+        parser = self.parser
+        holder = self.subject.guess(parser.Holder)
+        if holder is not None:
+            entity_class = holder.column.entity
+            return parser.Entity(entity_class = entity_class, parser = parser)
+        return None
 
+    def guess_number_parameter(self, expected):
+        parser = self.parser
+        compact_node_wrapper = self.subject.guess(parser.CompactNode)
+        if compact_node_wrapper is not None:
+            child_json = compact_node_wrapper.value['children'][self.name]
+            child_type = child_json['@type']
+            if child_type == u'Parameter' and child_json.get('format') != 'boolean':
+                return parser.Number(parser = parser)
+        return None
+
+    def guess_period_date(self, expected):
+        parser = self.parser
+        period = self.subject.guess(parser.Period)
+        if period is not None:
+            return parser.Date(parser = parser)
+        return None
+
+    def guess_period_start(self, expected):
+        parser = self.parser
+        period = self.subject.guess(parser.Period)
+        if period is not None:
+            return parser.Instant(parser = parser)
+        return None
+
+    def guess_tax_scale(self, expected):
+        parser = self.parser
+        compact_node_wrapper = self.subject.guess(parser.CompactNode)
+        if compact_node_wrapper is not None:
+            child_json = compact_node_wrapper.value['children'][self.name]
+            child_type = child_json['@type']
+            if child_type == u'Scale':
+                return parser.TaxScale(parser = parser)
         return None
 
     @classmethod
@@ -549,7 +641,65 @@ class Attribute(AbstractWrapper):
 
 
 class Call(AbstractWrapper):
+    # Names of the methods guessing the value of a call to a function, by (expected wrapper class name, function name),
+    # and of a call to a method, by (expected wrapper class name, method name). See Attribute.guesser_name_by_key.
+    function_guesser_name_by_key = {
+        ('Array', u'and_'): 'guess_boolean_array',
+        ('Array', u'floor'): 'guess_number_array',
+        ('Array', u'max_'): 'guess_number_array',
+        ('Array', u'min_'): 'guess_number_array',
+        ('Array', u'not_'): 'guess_not_array',
+        ('Array', u'or_'): 'guess_boolean_array',
+        ('Array', u'round_'): 'guess_number_array',
+        ('Array', u'xor_'): 'guess_boolean_array',
+        ('Boolean', u'hasattr'): 'guess_boolean',
+        ('Date', u'date'): 'guess_date',
+        ('Number', u'len'): 'guess_number',
+        ('UniformIterator', u'sorted'): 'guess_sorted_iterator',
+        }
+    # Names of the expected wrapper classes of function_guesser_name_by_key & method_guesser_name_by_key, by decreasing
+    # priority. See Attribute.guess_categories.
+    guess_categories = [
+        'Array',
+        'Boolean',
+        'CompactNode',
+        'Date',
+        'DatedHolder',
+        'Instant',
+        'Number',
+        'Period',
+        'TaxScale',
+        'UniformDictionary',
+        'UniformIterator',
+        ]
     keyword_argument = None
+    method_guesser_name_by_key = {
+        ('Array', u'all'): 'guess_boolean',
+        ('Array', u'any'): 'guess_boolean',
+        ('Array', u'any_by_roles'): 'guess_entity_array',
+        ('Array', u'calculate'): 'guess_calculated_array',
+        ('Array', u'calculate_add'): 'guess_calculated_array',
+        ('Array', u'calculate_add_divide'): 'guess_calculated_array',
+        ('Array', u'calculate_divide'): 'guess_calculated_array',
+        ('Array', u'cast_from_entity_to_role'): 'guess_person_array',
+        ('Array', u'cast_from_entity_to_roles'): 'guess_person_array',
+        ('Array', u'filter_role'): 'guess_filtered_role_array',
+        ('Array', u'get_array'): 'guess_calculated_array',
+        ('Array', u'sum_by_entity'): 'guess_entity_array',
+        ('CompactNode', u'legislation_at'): 'guess_legislation',
+        ('DatedHolder', u'compute'): 'guess_computed_dated_holder',
+        ('DatedHolder', u'compute_add'): 'guess_computed_dated_holder',
+        ('DatedHolder', u'compute_add_divide'): 'guess_computed_dated_holder',
+        ('DatedHolder', u'compute_divide'): 'guess_computed_dated_holder',
+        ('Instant', u'offset'): 'guess_instant_offset',
+        ('Period', u'offset'): 'guess_period_offset',
+        ('Period', u'period'): 'guess_instant_period',
+        ('TaxScale', u'calc'): 'guess_tax_scale_calc',
+        ('UniformDictionary', u'split_by_roles'): 'guess_roles_dictionary',
+        ('UniformIterator', u'iteritems'): 'guess_uniform_dictionary_items_iterator',
+        ('UniformIterator', u'iterkeys'): 'guess_uniform_dictionary_keys_iterator',
+        ('UniformIterator', u'itervalues'): 'guess_uniform_dictionary_values_iterator',
+        }
     named_arguments = None
     positional_arguments = None
     star_argument = None
@@ -601,262 +751,251 @@ class Call(AbstractWrapper):
             assert function.returns, "Function {} has no return statement".format(function.name)
             return function.returns[-1].guess(expected)
 
-        if issubclass(parser.Array, expected):
-            function = self.subject.guess(parser.Variable)
-            if function is not None:
-                if function.name in (u'and_', u'or_', u'xor_'):
-                    for argument in self.positional_arguments:
-                        array = argument.guess(parser.Array)
-                        if array is not None:
-                            return parser.Array(
-                                cell = parser.Boolean(
-                                    parser = parser,
-                                    ),
-                                entity_class = array.entity_class,
-                                parser = parser,
-                                )
-                elif function.name in (u'floor', u'max_', u'min_', u'round_'):
-                    for argument in self.positional_arguments:
-                        array = argument.guess(parser.Array)
-                        if array is not None:
-                            return parser.Array(
-                                cell = parser.Number(
-                                    parser = parser,
-                                    ),
-                                entity_class = array.entity_class,
-                                parser = parser,
-                                )
-                elif function.name == 'not_':
-                    assert len(self.positional_arguments) == 1
-                    argument = self.positional_arguments[0]
-                    array = argument.guess(parser.Array)
-                    if array is not None:
-                        return parser.Array(
-                            cell = parser.Boolean(
-                                parser = parser,
-                                ),
-                            entity_class = array.entity_class,
-                            parser = parser,
-                            )
-            else:
-                method = self.subject.guess(parser.Attribute)
-                if method is not None:
-                    if method.name in ('all', 'any'):
-                        return parser.Boolean(
-                            parser = parser,
-                            )
-                    if method.name in ('any_by_roles', 'sum_by_entity'):
-                        assert len(self.positional_arguments) == 1, self.positional_arguments
-                        assert len(self.named_arguments) == 0, self.named_arguments
-                        variable = self.positional_arguments[0].guess(parser.Variable)
-                        if variable is None:
-                            cell_wrapper = None
-                        else:
-                            variable_name = variable.name
-                            if variable_name.endswith(u'_holder'):
-                                variable_name = variable_name[:-len(u'_holder')]
-                            tax_benefit_system = parser.tax_benefit_system
-                            column = tax_benefit_system.column_by_name[variable_name]
-                            cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
-                        return parser.Array(
-                            cell = cell_wrapper,
-                            entity_class = parser.entity_class,
-                            parser = parser,
-                            )
-                    if method.name in ('calculate', 'calculate_add', 'calculate_add_divide', 'calculate_divide',
-                            'get_array'):
-                        assert len(self.positional_arguments) >= 1
-                        variable_name_wrapper = self.positional_arguments[0].guess(parser.String)
-                        if variable_name_wrapper is None:
-                            cell_wrapper = None
-                            entity_class = None
-                        else:
-                            tax_benefit_system = parser.tax_benefit_system
-                            column = tax_benefit_system.column_by_name[variable_name_wrapper.value]
-                            cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
-                            entity_class = column.entity
-                        return parser.Array(
-                            cell = cell_wrapper,
-                            entity_class = entity_class,
-                            parser = parser,
-                            )
-                    if method.name in ('cast_from_entity_to_role', 'cast_from_entity_to_roles'):
-                        assert len(self.positional_arguments) >= 1
-                        variable = self.positional_arguments[0].guess(parser.Variable)
-                        if variable is None:
-                            cell_wrapper = None
-                        else:
-                            variable_name = variable.name
-                            if variable_name.endswith(u'_holder'):
-                                variable_name = variable_name[:-len(u'_holder')]
-                            tax_benefit_system = parser.tax_benefit_system
-                            column = tax_benefit_system.column_by_name[variable_name]
-                            cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
-                        return parser.Array(
-                            cell = cell_wrapper,
-                            entity_class = parser.person_class,
-                            parser = parser,
-                            )
-                    if method.name == 'filter_role':
-                        assert len(self.positional_arguments) >= 1
-                        variable = self.positional_arguments[0].guess(parser.Variable)
-                        if variable is None:
-                            cell_wrapper = None
-                        else:
-                            variable_name = variable.name
-                            if variable_name.endswith(u'_holder'):
-                                variable_name = variable_name[:-len(u'_holder')]
-                            tax_benefit_system = parser.tax_benefit_system
-                            column = tax_benefit_system.column_by_name[variable_name]
-                            cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
-                        return parser.Array(
-                            cell = cell_wrapper,
-                            entity_class = parser.entity_class,
-                            parser = parser,
-                            )
-        elif issubclass(parser.Boolean, expected):
-            function = self.subject.guess(parser.Variable)
-            if function is not None:
-                if function.name == 'hasattr':
-                    return parser.Boolean(parser = parser)
-        elif issubclass(parser.CompactNode, expected):
-            method = self.subject.guess(parser.Attribute)
-            if method is not None:
-                if method.name == 'legislation_at':
-                    method_subject = method.subject
-                    if method_subject.guess(parser.Simulation):
-                        positional_arguments = self.positional_arguments
-                        assert len(positional_arguments) == 1, positional_arguments
-                        instant = positional_arguments[0].guess(parser.Instant)
-                        if instant is not None:
-                            named_arguments = self.named_arguments
-                            assert len(named_arguments) <= 1, named_arguments
-                            reference = named_arguments.get('reference')
-                            assert reference is None
-                            return parser.CompactNode(
-                                is_reference = bool(reference),
-                                parser = parser,
-                                value = parser.tax_benefit_system.get_legislation(),
-                                )
-        elif issubclass(parser.Date, expected):
+        # Like an if/elif cascade, only the guessers of the expected wrapper class with the highest priority are used.
+        # When this class has guessers for both functions & methods, methods are tried only when subject is not a
+        # variable.
+        function_category = parser.get_guess_category(self.__class__, 'function_guesser_name_by_key', expected)
+        method_category = parser.get_guess_category(self.__class__, 'method_guesser_name_by_key', expected)
+        if function_category is not None and (method_category is None
+                or self.guess_categories.index(function_category) <= self.guess_categories.index(method_category)):
             function = self.subject.guess(parser.Variable)
             if function is not None:
-                if function.name == 'date':
-                    return parser.Date(parser = parser)
-        elif issubclass(parser.DatedHolder, expected):
+                guesser_name = self.function_guesser_name_by_key.get((function_category, function.name))
+                if guesser_name is None:
+                    return None
+                return getattr(self, guesser_name)(expected, function)
+            if method_category != function_category:
+                return None
+        if method_category is not None:
             method = self.subject.guess(parser.Attribute)
             if method is not None:
-                if method.name in ('compute', 'compute_add', 'compute_add_divide', 'compute_divide'):
-                    assert len(self.positional_arguments) >= 1
-                    variable_name_wrapper = self.positional_arguments[0].guess(parser.String)
-                    if variable_name_wrapper is None:
-                        column = None
-                    else:
-                        column = parser.tax_benefit_system.column_by_name[variable_name_wrapper.value]
-                    return parser.DatedHolder(
-                        column = column,
+                guesser_name = self.method_guesser_name_by_key.get((method_category, method.name))
+                if guesser_name is None:
+                    return None
+                return getattr(self, guesser_name)(expected, method)
+        return None
+
+    def get_first_argument_cell_wrapper(self):
+        """Return the cell wrapper of the variable (or holder) given as first argument, or None."""
+        parser = self.parser
+        variable = self.positional_arguments[0].guess(parser.Variable)
+        if variable is None:
+            return None
+        variable_name = variable.name
+        if variable_name.endswith(u'_holder'):
+            variable_name = variable_name[:-len(u'_holder')]
+        tax_benefit_system = parser.tax_benefit_system
+        column = tax_benefit_system.column_by_name[variable_name]
+        return parser.get_cell_wrapper(container = self.container, type = column.dtype)
+
+    def guess_boolean(self, expected, function_or_method):
+        return self.parser.Boolean(parser = self.parser)
+
+    def guess_boolean_array(self, expected, function):
+        parser = self.parser
+        for argument in self.positional_arguments:
+            array = argument.guess(parser.Array)
+            if array is not None:
+                return parser.Array(
+                    cell = parser.Boolean(
                         parser = parser,
-                        )
-        elif issubclass(parser.Instant, expected):
-            method = self.subject.guess(parser.Attribute)
-            if method is not None:
-                if method.name == 'offset':
-                    if method.subject.guess(parser.Instant) is not None:
-                        return parser.Instant(parser = parser)
-        elif issubclass(parser.Number, expected):
-            function = self.subject.guess(parser.Variable)
-            if function is not None:
-                if function.name == 'len':
-                    return parser.Number(parser = parser)
-        elif issubclass(parser.Period, expected):
-            method = self.subject.guess(parser.Attribute)
-            if method is not None:
-                if method.name == 'offset':
-                    period = method.subject.guess(parser.Period)
-                    if period is not None:
-                        # period.offset(...)
-                        return parser.Period(parser = parser, unit = period.unit)
-                elif method.name == 'period':
-                    if method.subject.guess(parser.Instant):
-                        # instant.period(...)
-                        assert len(self.positional_arguments) >= 1
-                        unit = self.positional_arguments[0].guess(parser.String)
-                        if unit is not None:
-                            assert unit.value is not None, 'Missing value in unit string'
-                            return parser.Period(parser = parser, unit = unit.value)
-        elif issubclass(parser.TaxScale, expected):
-            method = self.subject.guess(parser.Attribute)
-            if method is not None:
-                if method.name == 'calc':
-                    if method.subject.guess(parser.Instant) is not None:
-                        return parser.TaxScale(parser = parser)
-        elif issubclass(parser.UniformDictionary, expected):
-            method = self.subject.guess(parser.Attribute)
-            if method is not None:
-                if method.name == 'split_by_roles':
-                    assert len(self.positional_arguments) == 1, self.positional_arguments
-                    assert len(self.named_arguments) <= 1, self.named_arguments
-                    variable = self.positional_arguments[0].guess(parser.Variable)
-                    if variable is None:
-                        cell_wrapper = None
-                    else:
-                        variable_name = variable.name
-                        if variable_name.endswith(u'_holder'):
-                            variable_name = variable_name[:-len(u'_holder')]
-                        tax_benefit_system = parser.tax_benefit_system
-                        column = tax_benefit_system.column_by_name[variable_name]
-                        cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
-                    return parser.UniformDictionary(
-                        key = parser.Role(
-                            parser = parser,
-                            ),
+                        ),
+                    entity_class = array.entity_class,
+                    parser = parser,
+                    )
+        return None
+
+    def guess_calculated_array(self, expected, method):
+        parser = self.parser
+        assert len(self.positional_arguments) >= 1
+        variable_name_wrapper = self.positional_arguments[0].guess(parser.String)
+        if variable_name_wrapper is None:
+            cell_wrapper = None
+            entity_class = None
+        else:
+            tax_benefit_system = parser.tax_benefit_system
+            column = tax_benefit_system.column_by_name[variable_name_wrapper.value]
+            cell_wrapper = parser.get_cell_wrapper(container = self.container, type = column.dtype)
+            entity_class = column.entity
+        return parser.Array(
+            cell = cell_wrapper,
+            entity_class = entity_class,
+            parser = parser,
+            )
+
+    def guess_computed_dated_holder(self, expected, method):
+        parser = self.parser
+        assert len(self.positional_arguments) >= 1
+        variable_name_wrapper = self.positional_arguments[0].guess(parser.String)
+        if variable_name_wrapper is None:
+            column = None
+        else:
+            column = parser.tax_benefit_system.column_by_name[variable_name_wrapper.value]
+        return parser.DatedHolder(
+            column = column,
+            parser = parser,
+            )
+
+    def guess_date(self, expected, function):
+        return self.parser.Date(parser = self.parser)
+
+    def guess_entity_array(self, expected, method):
+        assert len(self.positional_arguments) == 1, self.positional_arguments
+        assert len(self.named_arguments) == 0, self.named_arguments
+        parser = self.parser
+        return parser.Array(
+            cell = self.get_first_argument_cell_wrapper(),
+            entity_class = parser.entity_class,
+            parser = parser,
+            )
+
+    def guess_filtered_role_array(self, expected, method):
+        assert len(self.positional_arguments) >= 1
+        parser = self.parser
+        return parser.Array(
+            cell = self.get_first_argument_cell_wrapper(),
+            entity_class = parser.entity_class,
+            parser = parser,
+            )
+
+    def guess_instant_offset(self, expected, method):
+        parser = self.parser
+        if method.subject.guess(parser.Instant) is not None:
+            return parser.Instant(parser = parser)
+        return None
+
+    def guess_instant_period(self, expected, method):
+        parser = self.parser
+        if method.subject.guess(parser.Instant):
+            # instant.period(...)
+            assert len(self.positional_arguments) >= 1
+            unit = self.positional_arguments[0].guess(parser.String)
+            if unit is not None:
+                assert unit.value is not None, 'Missing value in unit string'
+                return parser.Period(parser = parser, unit = unit.value)
+        return None
+
+    def guess_legislation(self, expected, method):
+        parser = self.parser
+        method_subject = method.subject
+        if method_subject.guess(parser.Simulation):
+            positional_arguments = self.positional_arguments
+            assert len(positional_arguments) == 1, positional_arguments
+            instant = positional_arguments[0].guess(parser.Instant)
+            if instant is not None:
+                named_arguments = self.named_arguments
+                assert len(named_arguments) <= 1, named_arguments
+                reference = named_arguments.get('reference')
+                assert reference is None
+                return parser.CompactNode(
+                    is_reference = bool(reference),
+                    parser = parser,
+                    value = parser.get_legislation(),
+                    )
+        return None
+
+    def guess_not_array(self, expected, function):
+        assert len(self.positional_arguments) == 1
+        return self.guess_boolean_array(expected, function)
+
+    def guess_number(self, expected, function):
+        return self.parser.Number(parser = self.parser)
+
+    def guess_number_array(self, expected, function):
+        parser = self.parser
+        for argument in self.positional_arguments:
+            array = argument.guess(parser.Array)
+            if array is not None:
+                return parser.Array(
+                    cell = parser.Number(
                         parser = parser,
-                        value = parser.Array(
-                            cell = cell_wrapper,
-                            entity_class = parser.entity_class,
-                            parser = parser,
-                            ),
-                        )
-        elif issubclass(parser.UniformIterator, expected):
-            function = self.subject.guess(parser.Variable)
-            if function is not None:
-                if function.name == 'sorted':
-                    assert len(self.positional_arguments) >= 1
-                    argument = self.positional_arguments[0]
-                    uniform_iterator = argument.guess(expected)
-                    if uniform_iterator is not None:
-                        return uniform_iterator
-                    uniform_dictionary = argument.guess(parser.UniformDictionary)
-                    if uniform_dictionary is not None:
-                        return uniform_dictionary.guess(expected)
-            else:
-                method = self.subject.guess(parser.Attribute)
-                if method is not None:
-                    if method.name == 'iterkeys':
-                        uniform_dictionary = method.subject.guess(parser.UniformDictionary)
-                        if uniform_dictionary is not None:
-                            return parser.UniformIterator(
-                                items = [uniform_dictionary.key],
-                                parser = parser,
-                                )
-                    elif method.name == 'iteritems':
-                        uniform_dictionary = method.subject.guess(parser.UniformDictionary)
-                        if uniform_dictionary is not None:
-                            return parser.UniformIterator(
-                                items = [
-                                    uniform_dictionary.key,
-                                    uniform_dictionary.value,
-                                    ],
-                                parser = parser,
-                                )
-                    elif method.name == 'itervalues':
-                        uniform_dictionary = method.subject.guess(parser.UniformDictionary)
-                        if uniform_dictionary is not None:
-                            return parser.UniformIterator(
-                                items = [uniform_dictionary.value],
-                                parser = parser,
-                                )
+                        ),
+                    entity_class = array.entity_class,
+                    parser = parser,
+                    )
+        return None
+
+    def guess_period_offset(self, expected, method):
+        parser = self.parser
+        period = method.subject.guess(parser.Period)
+        if period is not None:
+            # period.offset(...)
+            return parser.Period(parser = parser, unit = period.unit)
+        return None
+
+    def guess_person_array(self, expected, method):
+        assert len(self.positional_arguments) >= 1
+        parser = self.parser
+        return parser.Array(
+            cell = self.get_first_argument_cell_wrapper(),
+            entity_class = parser.person_class,
+            parser = parser,
+            )
+
+    def guess_roles_dictionary(self, expected, method):
+        assert len(self.positional_arguments) == 1, self.positional_arguments
+        assert len(self.named_arguments) <= 1, self.named_arguments
+        parser = self.parser
+        return parser.UniformDictionary(
+            key = parser.Role(
+                parser = parser,
+                ),
+            parser = parser,
+            value = parser.Array(
+                cell = self.get_first_argument_cell_wrapper(),
+                entity_class = parser.entity_class,
+                parser = parser,
+                ),
+            )
+
+    def guess_sorted_iterator(self, expected, function):
+        assert len(self.positional_arguments) >= 1
+        argument = self.positional_arguments[0]
+        uniform_iterator = argument.guess(expected)
+        if uniform_iterator is not None:
+            return uniform_iterator
+        uniform_dictionary = argument.guess(self.parser.UniformDictionary)
+        if uniform_dictionary is not None:
+            return uniform_dictionary.guess(expected)
+        return None
 
+    def guess_tax_scale_calc(self, expected, method):
+        parser = self.parser
+        if method.subject.guess(parser.Instant) is not None:
+            return parser.TaxScale(parser = parser)
+        return None
+
+    def guess_uniform_dictionary_items_iterator(self, expected, method):
+        parser = self.parser
+        uniform_dictionary = method.subject.guess(parser.UniformDictionary)
+        if uniform_dictionary is not None:
+            return parser.UniformIterator(
+                items = [
+                    uniform_dictionary.key,
+                    uniform_dictionary.value,
+                    ],
+                parser = parser,
+                )
+        return None
+
+    def guess_uniform_dictionary_keys_iterator(self, expected, method):
+        parser = self.parser
+        uniform_dictionary = method.subject.guess(parser.UniformDictionary)
+        if uniform_dictionary is not None:
+            return parser.UniformIterator(
+                items = [uniform_dictionary.key],
+                parser = parser,
+                )
+        return None
+
+    def guess_uniform_dictionary_values_iterator(self, expected, method):
+        parser = self.parser
+        uniform_dictionary = method.subject.guess(parser.UniformDictionary)
+        if uniform_dictionary is not None:
+            return parser.UniformIterator(
+                items = [uniform_dictionary.value],
+                parser = parser,
+                )
         return None
 
     @classmethod
@@ -874,7 +1013,10 @@ class Call(AbstractWrapper):
         child_index = 0
         while child_index < len(children):
             argument = children[child_index]
-            if argument.type == symbols.argument:
+            if argument.type == symbols.argument and argument.children[0].type == tokens.DOUBLESTAR:
+                # "**kwargs"
+                keyword_argument = parser.parse_value(argument.children[1], container = container)
+            elif argument.type == symbols.argument:
                 # Named argument
                 argument_children = argument.children
                 assert len(argument_children) == 3, "Unexpected length {} of children in argument:\n{}\n\n{}".format(
@@ -885,6 +1027,9 @@ class Call(AbstractWrapper):
                 assert equal.type == tokens.EQUAL, "Unexpected equal type:\n{}\n\n{}".format(repr(equal),
                     unicode(equal).encode('utf-8'))
                 named_arguments[argument_name.value] = parser.parse_value(argument_value, container = container)
+            elif argument.type == symbols.star_expr:
+                # "*args"
+                star_argument = parser.parse_value(argument.children[1], container = container)
             else:
                 # Positional argument
                 if argument.type == tokens.STAR:
@@ -1006,30 +1151,45 @@ class ClassFileInput(AbstractWrapper):
 
     @classmethod
     def parse(cls, class_definition, parser = None):
-        source_lines, line_number = inspect.getsourcelines(class_definition)
-        source = textwrap.dedent(''.join(source_lines))
-        node = parser.driver.parse_string(source)
-        assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
-            unicode(node).encode('utf-8'))
-        children = node.children
-        assert len(children) == 2 and children[0].type == symbols.classdef and children[1].type == tokens.ENDMARKER, \
-            "Unexpected node children in:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
         python_module = inspect.getmodule(class_definition)
+        module_file_input = parser.get_module_file_input(python_module)
+        node = module_file_input.class_node_by_name.get(class_definition.__name__) \
+            if module_file_input is not None else None
+        if node is None:
+            # Class is not at the top level of a module parsable by lib2to3 => Parse its source alone.
+            source_lines, line_number = parser.get_class_source_lines(class_definition)
+            source_origin = (inspect.getsourcefile(class_definition), line_number)
+            source = textwrap.dedent(''.join(source_lines))
+            file_input_node = parser.parse_source(source)
+            assert file_input_node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(
+                repr(file_input_node), unicode(file_input_node).encode('utf-8'))
+            children = file_input_node.children
+            assert len(children) == 2 and children[0].type == symbols.classdef \
+                and children[1].type == tokens.ENDMARKER, "Unexpected node children in:\n{}\n\n{}".format(
+                    repr(file_input_node), unicode(file_input_node).encode('utf-8'))
+            node = children[0]
+        else:
+            file_input_node = module_file_input.node
+            source_origin = (inspect.getsourcefile(python_module), None)
         if parser.country_package is not None:
             assert python_module.__file__.startswith(os.path.dirname(parser.country_package.__file__)), \
-                "Requested class is defined outside country_package:\n{}".format(source)
-        module = parser.python_module_by_name.get(python_module.__name__)
-        if module is None:
-            parser.python_module_by_name[python_module.__name__] = module = parser.Module(node, python = python_module,
-                parser = parser)
-        self = cls(parser = parser)
-        class_definition_class = self.get_class_class(parser = parser)
+                "Requested class is defined outside country_package:\n{}".format(unicode(node).encode('utf-8'))
+        previous_source_origin = parser.source_origin
+        parser.source_origin = source_origin
         try:
-            return class_definition_class.parse(children[0], container = module, parser = parser)
+            module = parser.python_module_by_name.get(python_module.__name__)
+            if module is None:
+                parser.python_module_by_name[python_module.__name__] = module = parser.Module(file_input_node,
+                    python = python_module, parser = parser)
+            self = cls(parser = parser)
+            class_definition_class = self.get_class_class(parser = parser)
+            return class_definition_class.parse(node, container = module, parser = parser)
         except:
             if node is not None:
                 print "An exception occurred in node:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
             raise
+        finally:
+            parser.source_origin = previous_source_origin
 
 
 class CompactNode(AbstractWrapper):
@@ -1471,6 +1631,7 @@ class For(AbstractWrapper):
 class Function(AbstractWrapper):
     body = None
     body_parsed = False
+    definition_node = None  # In lean mode, the lib2to3 node of the function, kept until its body is parsed
     keyword_name = None  # Name of "kwargs" in "**kwargs"
     name = None
     named_parameters = None  # Dictionary of parameter name => default value
@@ -1483,6 +1644,8 @@ class Function(AbstractWrapper):
             named_parameters = None, node = None, parser = None, positional_parameters = None, returns = None,
             star_name = None, variable_by_name = None):
         super(Function, self).__init__(container = container, hint = hint, node = node, parser = parser)
+        if node is not None and parser.lean:
+            self.definition_node = node
         if body is None:
             body = []
         else:
@@ -1527,6 +1690,11 @@ class Function(AbstractWrapper):
     def get_function_class(cls, parser = None):
         return parser.Function
 
+    def get_node(self):
+        if self.definition_node is not None:
+            return self.definition_node
+        return super(Function, self).get_node()
+
     def get_variable(self, name, default = UnboundLocalError, parser = None):
         variable = self.variable_by_name.get(name, None)
         if variable is None:
@@ -1559,12 +1727,20 @@ class Function(AbstractWrapper):
 
     def parse_body(self):
         parser = self.parser
-        children = self.node.children
+        children = self.get_node().children
         assert len(children) == 5
 
         self.body_parsed = True
-        body = parser.parse_suite(children[4], container = self)
+        previous_source_origin = parser.source_origin
+        if isinstance(self.node, SourceSpan):
+            parser.source_origin = (self.node.file_path, self.node.first_line_number)
+        try:
+            body = parser.parse_suite(children[4], container = self)
+        finally:
+            parser.source_origin = previous_source_origin
         self.body[:] = body
+        # In lean mode, the node is no more needed.
+        self.definition_node = None
 
     def parse_call(self, call):
         if not self.body_parsed:
@@ -1603,7 +1779,7 @@ class Function(AbstractWrapper):
 
     def parse_parameters(self):
         parser = self.parser
-        children = self.node.children
+        children = self.get_node().children
         assert len(children) == 5
 
         parameters = children[2]
@@ -1723,31 +1899,48 @@ class FunctionFileInput(AbstractWrapper):
 
     @classmethod
     def parse(cls, function, parser = None):
-        source_lines, line_number = inspect.getsourcelines(function)
-        source = textwrap.dedent(''.join(source_lines))
-        # print source
-        node = parser.driver.parse_string(source)
-        assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
-            unicode(node).encode('utf-8'))
-        children = node.children
-        assert len(children) == 2 and children[0].type == symbols.funcdef and children[1].type == tokens.ENDMARKER, \
-            "Unexpected node children in:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
         python_module = inspect.getmodule(function)
+        module_file_input = parser.get_module_file_input(python_module)
+        # Look up top-level functions by name, not by the line number of their code, which is obsolete when their
+        # source file has been parsed again after a change (see Parser.forget_source_file).
+        node = module_file_input.function_node_by_name.get(function.__name__) \
+            if module_file_input is not None and parser.is_top_level_function(function) else None
+        if node is None:
+            # Function is not at the top level of a module parsable by lib2to3 => Parse its source alone.
+            source_lines, line_number = parser.get_function_source_lines(function)
+            source_origin = (inspect.getsourcefile(function), line_number)
+            source = textwrap.dedent(''.join(source_lines))
+            # print source
+            file_input_node = parser.parse_source(source)
+            assert file_input_node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(
+                repr(file_input_node), unicode(file_input_node).encode('utf-8'))
+            children = file_input_node.children
+            assert len(children) == 2 and children[0].type == symbols.funcdef \
+                and children[1].type == tokens.ENDMARKER, "Unexpected node children in:\n{}\n\n{}".format(
+                    repr(file_input_node), unicode(file_input_node).encode('utf-8'))
+            node = children[0]
+        else:
+            file_input_node = module_file_input.node
+            source_origin = (inspect.getsourcefile(python_module), None)
         if parser.country_package is not None:
             assert python_module.__file__.startswith(os.path.dirname(parser.country_package.__file__)), \
-                "Requested class is defined outside country_package:\n{}".format(source)
-        module = parser.python_module_by_name.get(python_module.__name__)
-        if module is None:
-            parser.python_module_by_name[python_module.__name__] = module = parser.Module(node, python = python_module,
-                parser = parser)
-        self = cls(parser = parser)
-        function_class = self.get_function_class(parser = parser)
+                "Requested class is defined outside country_package:\n{}".format(unicode(node).encode('utf-8'))
+        previous_source_origin = parser.source_origin
+        parser.source_origin = source_origin
         try:
-            return function_class.parse(children[0], container = module, parser = parser)
+            module = parser.python_module_by_name.get(python_module.__name__)
+            if module is None:
+                parser.python_module_by_name[python_module.__name__] = module = parser.Module(file_input_node,
+                    python = python_module, parser = parser)
+            self = cls(parser = parser)
+            function_class = self.get_function_class(parser = parser)
+            return function_class.parse(node, container = module, parser = parser)
         except:
             if node is not None:
                 print "An exception occurred in node:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
             raise
+        finally:
+            parser.source_origin = previous_source_origin
 
 
 class Holder(AbstractWrapper):
@@ -2049,81 +2242,7 @@ class Module(AbstractWrapper):
         if python is not None:
             # Python module
             self.python = python
-        self.variable_by_name = collections.OrderedDict(sorted(dict(
-            and_ = parser.Variable(container = self, name = u'and_', parser = parser),
-            around = parser.Variable(container = self, name = u'around', parser = parser),
-            apply_along_axis = parser.Variable(container = self, name = u'apply_along_axis', parser = parser),
-            array = parser.Variable(container = self, name = u'array', parser = parser),
-            CAT = parser.Variable(container = self, name = u'CAT', parser = parser,
-                value = parser.Enum(parser = parser)),
-            ceil = parser.Variable(container = self, name = u'ceil', parser = parser),
-            CHEF = parser.Variable(container = self, name = u'CHEF', parser = parser,
-                value = parser.Number(parser = parser, value = 0)),
-            # combine_tax_scales = parser.Variable(container = self, name = u'combine_tax_scales', parser = parser),
-            CONJ = parser.Variable(container = self, name = u'CONJ', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            CREF = parser.Variable(container = self, name = u'CREF', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            date = parser.Variable(container = self, name = u'date', parser = parser),
-            datetime64 = parser.Variable(container = self, name = u'datetime64', parser = parser),
-            dict = parser.Variable(container = self, name = u'dict', parser = parser),
-            # ENFS = parser.Variable(container = self, name = u'ENFS', parser = parser,
-            #     value = parser.UniformList(parser = parser, value = parser.Number(parser = parser, value = x))),
-            ENFS = parser.Variable(container = self, name = u'ENFS', parser = parser),
-            floor = parser.Variable(container = self, name = u'floor', parser = parser),
-            fromiter = parser.Variable(container = self, name = u'fromiter', parser = parser),
-            fsolve = parser.Variable(container = self, name = u'fsolve', parser = parser),
-            hasattr = parser.Variable(container = self, name = u'hasattr', parser = parser),
-            holidays = parser.Variable(container = self, name = u'holidays', parser = parser),
-            int16 = parser.Variable(container = self, name = u'int16', parser = parser,
-                value = parser.Type(parser = parser, value = np.int16)),
-            int32 = parser.Variable(container = self, name = u'int32', parser = parser,
-                value = parser.Type(parser = parser, value = np.int32)),
-            izip = parser.Variable(container = self, name = u'izip', parser = parser),
-            law = parser.Variable(container = self, name = u'law', parser = parser,
-                value = parser.CompactNode(parser = parser, value = parser.tax_benefit_system.get_legislation())),
-            len = parser.Variable(container = self, name = u'len', parser = parser),
-            log = parser.Variable(container = self, name = u'log', parser = parser,
-                value = parser.Logger(parser = parser)),
-            MarginalRateTaxScale = parser.Variable(container = self, name = u'MarginalRateTaxScale', parser = parser),
-            max = parser.Variable(container = self, name = u'max', parser = parser),
-            max_ = parser.Variable(container = self, name = u'max_', parser = parser),
-            math = parser.Variable(container = self, name = u'math', parser = parser),
-            min_ = parser.Variable(container = self, name = u'min_', parser = parser),
-            not_ = parser.Variable(container = self, name = u'not_', parser = parser),
-            ones = parser.Variable(container = self, name = u'ones', parser = parser),
-            or_ = parser.Variable(container = self, name = u'or_', parser = parser),
-            original_busday_count = parser.Variable(container = self, name = u'original_busday_count', parser = parser),
-            PAC1 = parser.Variable(container = self, name = u'PAC1', parser = parser,
-                value = parser.Number(parser = parser, value = 2)),
-            PAC2 = parser.Variable(container = self, name = u'PAC2', parser = parser,
-                value = parser.Number(parser = parser, value = 3)),
-            PAC3 = parser.Variable(container = self, name = u'PAC3', parser = parser,
-                value = parser.Number(parser = parser, value = 4)),
-            PART = parser.Variable(container = self, name = u'PART', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            partial = parser.Variable(container = self, name = u'partial', parser = parser),
-            PREF = parser.Variable(container = self, name = u'PREF', parser = parser,
-                value = parser.Number(parser = parser, value = 0)),
-            round = parser.Variable(container = self, name = u'round', parser = parser),
-            round_ = parser.Variable(container = self, name = u'round_', parser = parser),
-            # scale_tax_scales = parser.Variable(container = self, name = u'scale_tax_scales', parser = parser),
-            SCOLARITE_COLLEGE = parser.Variable(container = self, name = u'SCOLARITE_COLLEGE', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            sorted = parser.Variable(container = self, name = u'sorted', parser = parser),
-            startswith = parser.Variable(container = self, name = u'startswith', parser = parser),
-            TAUX_DE_PRIME = parser.Variable(container = self, name = u'TAUX_DE_PRIME', parser = parser,
-                value = parser.Number(parser = parser, value = 1 / 4)),
-            # TaxScalesTree = parser.Variable(container = self, name = u'TaxScalesTree', parser = parser),
-            timedelta64 = parser.Variable(container = self, name = u'timedelta64', parser = parser),
-            ValueError = parser.Variable(container = self, name = u'ValueError', parser = parser),
-            VOUS = parser.Variable(container = self, name = u'VOUS', parser = parser,
-                value = parser.Number(parser = parser, value = 0)),
-            where = parser.Variable(container = self, name = u'where', parser = parser),
-            xor_ = parser.Variable(container = self, name = u'xor_', parser = parser),
-            zeros = parser.Variable(container = self, name = u'zeros', parser = parser),
-            zone_apl_by_depcom = parser.Variable(container = self, name = u'zone_apl_by_depcom', parser = parser),
-            ).iteritems()))
+        self.variable_by_name = collections.OrderedDict()
 
     @property
     def containing_module(self):
@@ -2132,25 +2251,84 @@ class Module(AbstractWrapper):
     def get_variable(self, name, default = UnboundLocalError, parser = None):
         variable = self.variable_by_name.get(name, None)
         if variable is None:
-            value = getattr(self.python, name, UnboundLocalError)
-            if value is UnboundLocalError:
-                if default is UnboundLocalError:
-                    raise KeyError("Undefined value for {}".format(name))
-                return default
-            if not inspect.isfunction(value):
-                # TODO?
-                if default is UnboundLocalError:
-                    raise KeyError("Undefined value for {}".format(name))
-                return default
-            # Declare function before parsing if to avoid infinite parsing when it is recursive.
-            self.variable_by_name[name] = variable = parser.Variable(container = self, name = name,
-                parser = parser)
-            function = parser.FunctionFileInput.parse(value, parser = parser)
-            assert isinstance(function, parser.Function), function
-            variable.value = function
+            variable = parser.builtin_variable_by_name.get(name, None)
+        if variable is None and name == u'law':
+            # Materialize legislation only in modules that use it.
+            self.variable_by_name[name] = variable = parser.Variable(container = self, name = name, parser = parser,
+                value = parser.get_law())
+        if variable is None:
+            # Functions are per-column state, because their body is parsed using the arguments of their first call.
+            key = (self.python.__name__, name)
+            variable = parser.function_variable_by_key.get(key)
+            if variable is None:
+                value = getattr(self.python, name, UnboundLocalError)
+                if value is UnboundLocalError:
+                    if default is UnboundLocalError:
+                        raise KeyError("Undefined value for {}".format(name))
+                    return default
+                if not inspect.isfunction(value):
+                    # TODO?
+                    if default is UnboundLocalError:
+                        raise KeyError("Undefined value for {}".format(name))
+                    return default
+                # Declare function before parsing if to avoid infinite parsing when it is recursive.
+                parser.function_variable_by_key[key] = variable = parser.Variable(container = self, name = name,
+                    parser = parser)
+                function = parser.FunctionFileInput.parse(value, parser = parser)
+                assert isinstance(function, parser.Function), function
+                variable.value = function
         return variable
 
 
+class ModuleFileInput(AbstractWrapper):
+    """Wrapper for the lib2to3 tree of a whole Python module, parsed once and shared by all its definitions"""
+    class_node_by_name = None  # Top-level classdef nodes, by class name
+    function_node_by_name = None  # Top-level funcdef nodes (of the last definition of each name), by function name
+    python = None
+
+    def __init__(self, class_node_by_name = None, function_node_by_name = None, node = None, parser = None,
+            python = None):
+        super(ModuleFileInput, self).__init__(node = node, parser = parser)
+        assert isinstance(class_node_by_name, dict)
+        self.class_node_by_name = class_node_by_name
+        assert isinstance(function_node_by_name, dict)
+        self.function_node_by_name = function_node_by_name
+        if python is not None:
+            # Python module
+            self.python = python
+
+    @classmethod
+    def parse(cls, python_module, parser = None):
+        source_file_path = inspect.getsourcefile(python_module)
+        if source_file_path is None:
+            return None
+        source_lines = linecache.getlines(source_file_path, python_module.__dict__)
+        if not source_lines:
+            return None
+        try:
+            node = parser.parse_source(''.join(source_lines))
+        except (IndentationError, lib2to3.pgen2.parse.ParseError, lib2to3.pgen2.tokenize.TokenError):
+            log.warning(u'Unable to parse module {} as a whole'.format(python_module.__name__))
+            return None
+        assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
+            unicode(node).encode('utf-8'))
+
+        class_node_by_name = {}
+        function_node_by_name = {}
+        for child in node.children:
+            if child.type == symbols.classdef:
+                # Like inspect.getsourcelines, use the first top-level definition of a class.
+                class_node_by_name.setdefault(child.children[1].value, child)
+            elif child.type == symbols.funcdef:
+                # Use the last top-level definition of a function, which is the one bound to its name in the module.
+                function_node_by_name[child.children[1].value] = child
+            elif child.type == symbols.decorated and child.children[-1].type == symbols.funcdef:
+                # Decorated functions are parsed alone.
+                function_node_by_name.pop(child.children[-1].children[1].value, None)
+        return cls(class_node_by_name = class_node_by_name, function_node_by_name = function_node_by_name,
+            node = node, parser = parser, python = python_module)
+
+
 class NoneWrapper(AbstractWrapper):
     pass
 
@@ -2744,6 +2922,68 @@ class Parser(State):
     Assignment = Assignment
     Attribute = Attribute
     Boolean = Boolean
+    # Wrapper class names & values of the variables available in all modules, by name (None when the value of a
+    # variable is unknown). Use register_builtin() to add variables to a parser.
+    builtin_value_by_name = dict(
+        and_ = None,
+        around = None,
+        apply_along_axis = None,
+        array = None,
+        CAT = ('Enum', None),
+        ceil = None,
+        CHEF = ('Number', 0),
+        # combine_tax_scales = None,
+        CONJ = ('Number', 1),
+        CREF = ('Number', 1),
+        date = None,
+        datetime64 = None,
+        dict = None,
+        # ENFS = ('UniformList', Number),
+        ENFS = None,
+        floor = None,
+        fromiter = None,
+        fsolve = None,
+        hasattr = None,
+        holidays = None,
+        int16 = ('Type', np.int16),
+        int32 = ('Type', np.int32),
+        izip = None,
+        # law is added to modules on first use, see Module.get_variable().
+        len = None,
+        log = ('Logger', None),
+        MarginalRateTaxScale = None,
+        max = None,
+        max_ = None,
+        math = None,
+        min_ = None,
+        not_ = None,
+        ones = None,
+        or_ = None,
+        original_busday_count = None,
+        PAC1 = ('Number', 2),
+        PAC2 = ('Number', 3),
+        PAC3 = ('Number', 4),
+        PART = ('Number', 1),
+        partial = None,
+        PREF = ('Number', 0),
+        round = None,
+        round_ = None,
+        # scale_tax_scales = None,
+        SCOLARITE_COLLEGE = ('Number', 1),
+        sorted = None,
+        startswith = None,
+        TAUX_DE_PRIME = ('Number', 1 / 4),
+        # TaxScalesTree = None,
+        timedelta64 = None,
+        ValueError = None,
+        VOUS = ('Number', 0),
+        where = None,
+        xor_ = None,
+        zeros = None,
+        zone_apl_by_depcom = None,
+        )
+    builtin_variable_by_name = None  # Variables available in all modules, shared by their Module wrappers
+    cache_dir = None  # Directory where parsed lib2to3 trees are stored, keyed by source hash
     Call = Call
     Class = Class
     ClassFileInput = ClassFileInput
@@ -2772,16 +3012,25 @@ class Parser(State):
     Function = Function
     # FunctionCall = FunctionCall
     FunctionFileInput = FunctionFileInput
+    function_variable_by_key = None  # Per-column dictionary of module functions variables, by (module name, name)
+    grammar_hash = None  # Hash of the driver grammar, used in cache keys
+    guess_category_by_key = None  # Cache of get_guess_category()
     Holder = Holder
     If = If
     Instant = Instant
     Key = Key
     Lambda = Lambda
+    law = None  # CompactNode wrapper of the whole legislation, shared by all modules
+    lean = False  # When True, wrappers keep a SourceSpan instead of their lib2to3 node & modules trees are not kept
+    legislation = None  # Legislation JSON, loaded on first use
     List = List
     ListGenerator = ListGenerator
     Logger = Logger
     # Math = Math
     Module = Module
+    module_file_input_by_name = None
+    ModuleFileInput = ModuleFileInput
+    node_class = lib2to3.pytree.Base  # Class of the syntax tree nodes given to wrappers
     NoneWrapper = NoneWrapper
     NotTest = NotTest
     Number = Number
@@ -2792,6 +3041,33 @@ class Parser(State):
     Return = Return
     Role = Role
     Simulation = Simulation
+    # Names of the wrapper classes (whose parse method is used) or of the parser methods that parse the simple statement
+    # contained in a simple_stmt node, by lib2to3 node type
+    simple_statement_parser_name_by_type = {
+        symbols.assert_stmt: 'Assert',
+        symbols.expr_stmt: 'Assignment',
+        symbols.global_stmt: 'ignore_node',  # TODO: Used only by zone_apl.
+        symbols.power: 'parse_power',
+        symbols.raise_stmt: 'Raise',
+        symbols.return_stmt: 'Return',
+        tokens.NAME: 'parse_continue',
+        tokens.STRING: 'String',  # Docstring
+        }
+    simple_statement_parsers = None  # Dense list of simple statement parsing functions, indexed by lib2to3 node type
+    source_locator = None  # SourceLocator of the classes of the country package
+    source_origin = None  # (file path, first line number) of the source being parsed, used by SourceSpan
+    # Names of the wrapper classes or of the parser methods that parse a statement of a suite, by lib2to3 node type
+    statement_parser_name_by_type = {
+        symbols.for_stmt: 'For',
+        symbols.funcdef: 'parse_function_definition',
+        symbols.if_stmt: 'If',
+        symbols.simple_stmt: 'parse_simple_statement',
+        symbols.with_stmt: 'ignore_node',  # TODO: Used only by zone_apl.
+        tokens.DEDENT: 'ignore_node',
+        tokens.INDENT: 'ignore_node',
+        tokens.NEWLINE: 'ignore_node',
+        }
+    statement_parsers = None  # Dense list of statement parsing functions, indexed by lib2to3 node type
     StemNode = StemNode
     String = String
     # Structure = Structure
@@ -2806,15 +3082,57 @@ class Parser(State):
     UniformDictionary = UniformDictionary
     UniformIterator = UniformIterator
     # UniformList = UniformList
+    # Names of the wrapper classes or of the parser methods that parse a value, by lib2to3 node type
+    value_parser_name_by_type = {
+        symbols.and_expr: 'AndExpression',
+        symbols.and_test: 'AndTest',
+        symbols.arith_expr: 'ArithmeticExpression',
+        symbols.atom: 'parse_atom',
+        symbols.comparison: 'Comparison',
+        symbols.expr: 'Expression',
+        symbols.factor: 'Factor',
+        symbols.lambdef: 'Lambda',
+        symbols.not_test: 'NotTest',
+        symbols.power: 'parse_power',
+        symbols.term: 'Term',
+        symbols.test: 'Test',
+        symbols.testlist: 'Tuple',
+        symbols.testlist_gexp: 'TupleGenerator',
+        tokens.NAME: 'parse_name',
+        tokens.NUMBER: 'Number',
+        tokens.STRING: 'String',
+        }
+    value_parsers = None  # Dense list of value parsing functions, indexed by lib2to3 node type
     Variable = Variable
     XorExpression = XorExpression
 
-    def __init__(self, country_package = None, driver = None, tax_benefit_system = None):
+    def __init__(self, cache_dir = None, country_package = None, driver = None, lean = False,
+            tax_benefit_system = None):
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
         if country_package is not None:
             self.country_package = country_package
+        if lean:
+            self.lean = True
+        self.builtin_variable_by_name = {}
+        for name, wrapper_class_name_and_value in self.builtin_value_by_name.iteritems():
+            value = None
+            if wrapper_class_name_and_value is not None:
+                wrapper_class_name, value = wrapper_class_name_and_value
+                wrapper_class = getattr(self, wrapper_class_name)
+                value = wrapper_class(parser = self) if value is None else wrapper_class(parser = self, value = value)
+            self.register_builtin(name, value = value)
         self.driver = driver
+        self.function_variable_by_key = {}
+        self.guess_category_by_key = {}
+        self.module_file_input_by_name = {}
         self.python_module_by_name = {}
+        self.simple_statement_parsers = self.get_node_parsers(self.simple_statement_parser_name_by_type)
+        self.source_locator = SourceLocator(package_dir = os.path.dirname(os.path.abspath(country_package.__file__))
+            if country_package is not None else None)
+        self.statement_parsers = self.get_node_parsers(self.statement_parser_name_by_type)
         self.tax_benefit_system = tax_benefit_system
+        self.value_parsers = self.get_node_parsers(self.value_parser_name_by_type)
 
     @property
     def entity_class(self):
@@ -2822,6 +3140,16 @@ class Parser(State):
             return None
         return self.column.entity
 
+    def forget_source_file(self, source_file_path):
+        """Forget the trees & wrappers of the modules of a source file, to parse them again when it has changed."""
+        linecache.checkcache(source_file_path)
+        self.source_locator.forget_source_file(source_file_path)
+        for module_name in set(self.module_file_input_by_name) | set(self.python_module_by_name):
+            python_module = sys.modules.get(module_name)
+            if python_module is not None and inspect.getsourcefile(python_module) == source_file_path:
+                self.module_file_input_by_name.pop(module_name, None)
+                self.python_module_by_name.pop(module_name, None)
+
     def get_cell_wrapper(self, container = None, type = None):
         wrapper_class = {
             None: self.Number,
@@ -2835,6 +3163,221 @@ class Parser(State):
             return wrapper_class(container = container, parser = self, type = type)
         return wrapper_class(container = container, parser = self)
 
+    def get_class_source_lines(self, python_class):
+        """Return the source lines of a class and the number of its first line, like inspect.getsourcelines.
+
+        Classes defined at the top level of their module are found by the source locator, without searching their
+        source file; other classes are left to inspect.getsourcelines.
+        """
+        python_module = sys.modules.get(python_class.__module__)
+        source_file_path = inspect.getsourcefile(python_module) if python_module is not None else None
+        if source_file_path is not None:
+            source_file_path = os.path.abspath(source_file_path)
+            location = self.source_locator.locate_class(python_class.__name__, file_path = source_file_path)
+            if location is not None:
+                return self.source_locator.get_source_lines(location), location.first_line_number
+        return inspect.getsourcelines(python_class)
+
+    def get_function_source_lines(self, function):
+        """Return the source lines of a function and the number of its first line, like inspect.getsourcelines.
+
+        Functions defined at the top level of their module are found by name by the source locator, in the current
+        source of their file. inspect.getsourcelines, used for other functions, relies on the line number of their code,
+        which is obsolete when the file has changed since the module was imported.
+        """
+        if self.is_top_level_function(function):
+            source_file_path = inspect.getsourcefile(function)
+            if source_file_path is not None:
+                location = self.source_locator.locate_function(function.__name__,
+                    file_path = os.path.abspath(source_file_path))
+                if location is not None:
+                    return self.source_locator.get_source_lines(location), location.first_line_number
+        return inspect.getsourcelines(function)
+
+    def get_guess_category(self, wrapper_class, table_name, expected):
+        """Return the name of the expected wrapper class of a guessers table with the highest priority (in
+        wrapper_class.guess_categories) that is a subclass of expected, or None.
+
+        The table is the attribute table_name of wrapper_class, whose keys are (wrapper class name, name) tuples.
+        """
+        key = (wrapper_class, table_name, expected)
+        category = self.guess_category_by_key.get(key, UnboundLocalError)
+        if category is UnboundLocalError:
+            table_categories = set(
+                wrapper_class_name
+                for wrapper_class_name, name in getattr(wrapper_class, table_name)
+                )
+            guess_categories = wrapper_class.guess_categories
+            assert table_categories.issubset(guess_categories), "Categories {} of {}.{} are missing from {}".format(
+                sorted(table_categories.difference(guess_categories)), wrapper_class.__name__, table_name,
+                'guess_categories')
+            self.guess_category_by_key[key] = category = next(
+                (
+                    wrapper_class_name
+                    for wrapper_class_name in guess_categories
+                    if wrapper_class_name in table_categories
+                    and issubclass(getattr(self, wrapper_class_name), expected)
+                    ),
+                None,
+                )
+        return category
+
+    def get_helper_source_files_path(self):
+        """Return the source files of the module functions parsed for the current column."""
+        helper_source_files_path = set()
+        for module_name, name in self.function_variable_by_key:
+            function = getattr(sys.modules[module_name], name)
+            helper_source_file_path = inspect.getsourcefile(function)
+            if helper_source_file_path is not None:
+                helper_source_files_path.add(helper_source_file_path)
+        return helper_source_files_path
+
+    def get_law(self):
+        """Return the CompactNode wrapper of the root of the legislation, creating it on first call."""
+        law = self.law
+        if law is None:
+            self.law = law = self.CompactNode(parser = self, value = self.get_legislation())
+        return law
+
+    def get_legislation(self):
+        """Return the legislation JSON of the tax-benefit system, loading it only once per parser."""
+        legislation = self.legislation
+        if legislation is None:
+            self.legislation = legislation = self.tax_benefit_system.get_legislation()
+        return legislation
+
+    def get_module_file_input(self, python_module):
+        """Return the wrapper of the tree of the whole given module, parsing it on first request.
+
+        Return None when the module source is not available or can't be parsed as a whole.
+        """
+        if self.lean:
+            # Don't keep whole modules trees: Parse each definition alone.
+            return None
+        name = python_module.__name__
+        if name in self.module_file_input_by_name:
+            return self.module_file_input_by_name[name]
+        self.module_file_input_by_name[name] = module_file_input = self.ModuleFileInput.parse(python_module,
+            parser = self)
+        return module_file_input
+
+    def get_node_parsers(self, parser_name_by_type):
+        """Convert a dictionary of names of wrapper classes or of parser methods to a dense list of functions.
+
+        The list is indexed by lib2to3 node type and contains None for unknown types. Each function is called with a
+        node and a container.
+        """
+        node_parsers = [None] * (max(parser_name_by_type) + 1)
+        for node_type, parser_name in parser_name_by_type.iteritems():
+            node_parser = getattr(self, parser_name)
+            if isinstance(node_parser, type) and issubclass(node_parser, AbstractWrapper):
+                node_parser = functools.partial(node_parser.parse, parser = self)
+            node_parsers[node_type] = node_parser
+        return node_parsers
+
+    def get_source_span(self, node):
+        """Return the SourceSpan of a node of the source being parsed."""
+        leaf = node
+        while leaf.children:
+            leaf = leaf.children[0]
+        file_path, first_line_number = self.source_origin or (None, None)
+        return SourceSpan(column = leaf.column, file_path = file_path, first_line_number = first_line_number,
+            line_number = leaf.lineno, type = node.type)
+
+    def get_span_node(self, source_span):
+        """Parse again the source of a SourceSpan and return the node it spans, or None."""
+        if source_span.file_path is None:
+            return None
+        source_lines = linecache.getlines(source_span.file_path)
+        if source_span.first_line_number is not None:
+            source_lines = inspect.getblock(source_lines[source_span.first_line_number - 1:])
+        node = self.parse_source(textwrap.dedent(''.join(source_lines)))
+        for node in node.pre_order():
+            leaf = node
+            while leaf.children:
+                leaf = leaf.children[0]
+            if node.type == source_span.type and leaf.lineno == source_span.line_number \
+                    and leaf.column == source_span.column:
+                return node
+        return None
+
+    def ignore_node(self, node, container = None):
+        return None
+
+    def is_top_level_function(self, function):
+        """Return whether a function is defined at the top level of its module, that binds it to its name."""
+        python_module = sys.modules.get(function.__module__)
+        return python_module is not None and getattr(python_module, function.__name__, None) is function
+
+    def parse_atom(self, node, container = None):
+        assert node.type == symbols.atom, "Unexpected atom type:\n{}\n\n{}".format(repr(node),
+            unicode(node).encode('utf-8'))
+        children = node.children
+        assert len(children) == 3, "Unexpected length {} of children in atom:\n{}\n\n{}".format(len(children),
+            repr(node), unicode(node).encode('utf-8'))
+        left_parenthesis, value, right_parenthesis = children
+        assert left_parenthesis.type in (tokens.LBRACE, tokens.LPAR, tokens.LSQB), \
+            "Unexpected left parenthesis {} in atom:\n{}\n\n{}".format(left_parenthesis.value, repr(node),
+                unicode(node).encode('utf-8'))
+        assert right_parenthesis.type in (tokens.RBRACE, tokens.RPAR, tokens.RSQB), \
+            "Unexpected right parenthesis {} in atom:\n{}\n\n{}".format(right_parenthesis.value, repr(node),
+                unicode(node).encode('utf-8'))
+        if left_parenthesis.type == tokens.LPAR:
+            value = self.parse_value(value, container = container)
+            return self.ParentheticalExpression(container = container, node = node, parser = self, value = value)
+        if value.type == symbols.dictsetmaker:
+            dict_children = value.children
+            child_index = 0
+            while child_index < len(dict_children):
+                item_key = self.parse_value(dict_children[child_index], container = container)
+                assert dict_children[child_index + 1].type == tokens.COLON, \
+                    "Unexpected colon {} in atom:\n{}\n\n{}".format(dict_children[child_index + 1], repr(value),
+                        unicode(value).encode('utf-8'))
+                item_value = self.parse_value(dict_children[child_index + 2], container = container)
+                child_index += 3
+                if (child_index < len(dict_children)) and dict_children[child_index].type == tokens.COMMA:
+                    child_index += 1
+                else:
+                    assert child_index == len(dict_children), \
+                        "Missing comma after dictionary item {} in atom:\n{}\n\n{}".format(child_index, repr(value),
+                            unicode(value).encode('utf-8'))
+            # TODO: Currently it is assumed that dictionary is uniform.
+            return self.UniformDictionary(
+                container = container,
+                key = item_key,
+                parser = self,
+                value = item_value,
+                )
+        if value.type == symbols.listmaker:
+            if any(child.type == symbols.comp_for for child in value.children):
+                return self.ListGenerator.parse(value, container = container, parser = self)
+            return self.List.parse(value, container = container, parser = self)
+        singleton = self.parse_value(value, container = container)
+        return self.List(container = container, node = value, parser = self, value = [singleton])
+
+    def parse_continue(self, node, container = None):
+        assert node.value == 'continue', "Unexpected simple statement in suite:\n{}\n\n{}".format(repr(node.parent),
+            unicode(node.parent).encode('utf-8'))
+        return self.Continue(container = container, node = node, parser = self)
+
+    def parse_function_definition(self, node, container = None):
+        function = container.get_function_class(parser = self).parse(node, container = container, parser = self)
+        container.variable_by_name[function.name] = self.Variable(container = container, name = function.name,
+            parser = self, value = function)
+        return function
+
+    def parse_name(self, node, container = None):
+        name = node.value
+        if name == u'False':
+            return self.Boolean(container = container, parser = self, value = False)
+        elif name == u'None':
+            return self.NoneWrapper(container = container, parser = self)
+        elif name == u'True':
+            return self.Boolean(container = container, parser = self, value = True)
+        variable = container.get_variable(name, default = None, parser = self)
+        assert variable is not None, "Undefined variable: {}".format(name)
+        return variable
+
     def parse_power(self, node, container = None):
         assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
             unicode(node).encode('utf-8'))
@@ -2872,6 +3415,67 @@ class Parser(State):
                 subject = self.Key.parse(subject, trailer, container = container, parser = self)
         return subject
 
+    def parse_simple_statement(self, node, container = None):
+        assert len(node.children) == 2, \
+            "Unexpected length {} for simple statement in function definition:\n{}\n\n{}".format(
+                len(node.children), repr(node), unicode(node).encode('utf-8'))
+        statement = node.children[0]
+        statement_type = statement.type
+        simple_statement_parsers = self.simple_statement_parsers
+        simple_statement_parser = simple_statement_parsers[statement_type] \
+            if statement_type < len(simple_statement_parsers) else None
+        assert simple_statement_parser is not None, "Unexpected simple statement in suite:\n{}\n\n{}".format(
+            repr(node), unicode(node).encode('utf-8'))
+        wrapper = simple_statement_parser(statement, container = container)
+        assert node.children[1].type == tokens.NEWLINE and node.children[1].value == '\n'
+        return wrapper
+
+    def parse_source(self, source):
+        """Parse Python source code into a lib2to3 tree, reusing the tree stored in cache directory when present."""
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            return self.driver.parse_string(source)
+
+        grammar_hash = self.grammar_hash
+        if grammar_hash is None:
+            grammar = self.driver.grammar
+            self.grammar_hash = grammar_hash = hashlib.sha1(repr((
+                sorted(grammar.keywords),
+                sorted(grammar.symbol2number.iteritems()),
+                sorted(grammar.tokens.iteritems()),
+                ))).hexdigest()
+        source_hash = hashlib.sha1(grammar_hash)
+        source_hash.update(source.encode('utf-8') if isinstance(source, unicode) else source)
+        source_hash = source_hash.hexdigest()
+        cache_file_path = os.path.join(cache_dir, source_hash[:2], source_hash + '.pickle')
+        if os.path.exists(cache_file_path):
+            try:
+                with open(cache_file_path, 'rb') as cache_file:
+                    return cPickle.load(cache_file)
+            except Exception:
+                log.warning(u'Ignoring invalid parse tree cache file {}'.format(cache_file_path))
+
+        node = self.driver.parse_string(source)
+        cache_file_dir = os.path.dirname(cache_file_path)
+        if not os.path.isdir(cache_file_dir):
+            try:
+                os.makedirs(cache_file_dir)
+            except OSError:
+                # Directory may have been created by a concurrent parser.
+                pass
+        # Write to a temporary file first, so that concurrent readers never see a truncated tree.
+        cache_file = tempfile.NamedTemporaryFile(delete = False, dir = cache_file_dir, suffix = '.tmp')
+        try:
+            with cache_file:
+                cPickle.dump(node, cache_file, cPickle.HIGHEST_PROTOCOL)
+            os.rename(cache_file.name, cache_file_path)
+        except (IOError, OSError, RuntimeError):
+            # RuntimeError is raised when the tree is too deep to be pickled.
+            log.warning(u'Unable to store parse tree in cache file {}'.format(cache_file_path))
+            if os.path.exists(cache_file.name):
+                os.remove(cache_file.name)
+        return node
+
     def parse_suite(self, node, container = None):
         assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
             unicode(node).encode('utf-8'))
@@ -2883,61 +3487,15 @@ class Parser(State):
         else:
             children = [node]  # Suite is only a single statement.
         body = []
+        statement_parsers = self.statement_parsers
         for child in children:
-            if child.type == symbols.for_stmt:
-                for_wrapper = self.For.parse(child, container = container, parser = self)
-                body.append(for_wrapper)
-            elif child.type == symbols.funcdef:
-                function = container.get_function_class(parser = self).parse(child, container = container,
-                    parser = self)
-                body.append(function)
-                container.variable_by_name[function.name] = self.Variable(container = container, name = function.name,
-                    parser = self, value = function)
-            elif child.type == symbols.if_stmt:
-                if_wrapper = self.If.parse(child, container = container, parser = self)
-                body.append(if_wrapper)
-            elif child.type == symbols.simple_stmt:
-                assert len(child.children) == 2, \
-                    "Unexpected length {} for simple statement in function definition:\n{}\n\n{}".format(
-                        len(child.children), repr(child), unicode(child).encode('utf-8'))
-                statement = child.children[0]
-                if statement.type == symbols.assert_stmt:
-                    assert_statement = self.Assert.parse(statement, container = container, parser = self)
-                    body.append(assert_statement)
-                elif statement.type == symbols.expr_stmt:
-                    assignment = self.Assignment.parse(statement, container = container, parser = self)
-                    body.append(assignment)
-                elif statement.type == symbols.global_stmt:
-                    # TODO: Used only by zone_apl.
-                    pass
-                elif statement.type == symbols.power:
-                    power = self.parse_power(statement, container = container)
-                    body.append(power)
-                elif statement.type == symbols.raise_stmt:
-                    raise_statement = self.Raise.parse(statement, container = container, parser = self)
-                    body.append(raise_statement)
-                elif statement.type == symbols.return_stmt:
-                    return_wrapper = self.Return.parse(statement, container = container, parser = self)
-                    body.append(return_wrapper)
-                elif statement.type == tokens.NAME and statement.value == 'continue':
-                    continue_statement = self.Continue(container = container, node = statement, parser = self)
-                    body.append(continue_statement)
-                elif statement.type == tokens.STRING:
-                    # Docstring
-                    string = self.String.parse(statement, container = container, parser = self)
-                    body.append(string)
-                else:
-                    assert False, "Unexpected simple statement in suite:\n{}\n\n{}".format(repr(child),
-                        unicode(child).encode('utf-8'))
-                assert child.children[1].type == tokens.NEWLINE and child.children[1].value == '\n'
-            elif child.type == symbols.with_stmt:
-                # TODO: Used only by zone_apl.
-                pass
-            elif child.type in (tokens.DEDENT, tokens.INDENT, tokens.NEWLINE):
-                pass
-            else:
-                assert False, "Unexpected statement in suite:\n{}\n\n{}".format(repr(child),
-                    unicode(child).encode('utf-8'))
+            child_type = child.type
+            statement_parser = statement_parsers[child_type] if child_type < len(statement_parsers) else None
+            assert statement_parser is not None, "Unexpected statement in suite:\n{}\n\n{}".format(repr(child),
+                unicode(child).encode('utf-8'))
+            statement = statement_parser(child, container = container)
+            if statement is not None:
+                body.append(statement)
         return body
 
     def parse_value(self, node, container = None):
@@ -2946,111 +3504,143 @@ class Parser(State):
         assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(container,
             repr(node), unicode(node).encode('utf-8'))
 
-        if node.type == symbols.and_expr:
-            return self.AndExpression.parse(node, container = container, parser = self)
-
-        if node.type == symbols.and_test:
-            return self.AndTest.parse(node, container = container, parser = self)
+        node_type = node.type
+        value_parsers = self.value_parsers
+        value_parser = value_parsers[node_type] if node_type < len(value_parsers) else None
+        assert value_parser is not None, "Unexpected value:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
+        return value_parser(node, container = container)
 
-        if node.type == symbols.arith_expr:
-            return self.ArithmeticExpression.parse(node, container = container, parser = self)
-
-        if node.type == symbols.atom:
-            assert node.type == symbols.atom, "Unexpected atom type:\n{}\n\n{}".format(repr(node),
-                unicode(node).encode('utf-8'))
-            children = node.children
-            assert len(children) == 3, "Unexpected length {} of children in atom:\n{}\n\n{}".format(len(children),
-                repr(node), unicode(node).encode('utf-8'))
-            left_parenthesis, value, right_parenthesis = children
-            assert left_parenthesis.type in (tokens.LBRACE, tokens.LPAR, tokens.LSQB), \
-                "Unexpected left parenthesis {} in atom:\n{}\n\n{}".format(left_parenthesis.value, repr(node),
-                    unicode(node).encode('utf-8'))
-            assert right_parenthesis.type in (tokens.RBRACE, tokens.RPAR, tokens.RSQB), \
-                "Unexpected right parenthesis {} in atom:\n{}\n\n{}".format(right_parenthesis.value, repr(node),
-                    unicode(node).encode('utf-8'))
-            if left_parenthesis.type == tokens.LPAR:
-                value = self.parse_value(value, container = container)
-                return self.ParentheticalExpression(container = container, node = node, parser = self, value = value)
-            if value.type == symbols.dictsetmaker:
-                dict_children = value.children
-                child_index = 0
-                while child_index < len(dict_children):
-                    item_key = self.parse_value(dict_children[child_index], container = container)
-                    assert dict_children[child_index + 1].type == tokens.COLON, \
-                        "Unexpected colon {} in atom:\n{}\n\n{}".format(dict_children[child_index + 1], repr(value),
-                            unicode(value).encode('utf-8'))
-                    item_value = self.parse_value(dict_children[child_index + 2], container = container)
-                    child_index += 3
-                    if (child_index < len(dict_children)) and dict_children[child_index].type == tokens.COMMA:
-                        child_index += 1
-                    else:
-                        assert child_index == len(dict_children), \
-                            "Missing comma after dictionary item {} in atom:\n{}\n\n{}".format(child_index, repr(value),
-                                unicode(value).encode('utf-8'))
-                # TODO: Currently it is assumed that dictionary is uniform.
-                return self.UniformDictionary(
-                    container = container,
-                    key = item_key,
-                    parser = self,
-                    value = item_value,
-                    )
-            if value.type == symbols.listmaker:
-                if any(child.type == symbols.comp_for for child in value.children):
-                    return self.ListGenerator.parse(value, container = container, parser = self)
-                return self.List.parse(value, container = container, parser = self)
-            singleton = self.parse_value(value, container = container)
-            return self.List(container = container, node = value, parser = self, value = [singleton])
-
-        if node.type == symbols.comparison:
-            return self.Comparison.parse(node, container = container, parser = self)
-
-        if node.type == symbols.expr:
-            return self.Expression.parse(node, container = container, parser = self)
-
-        if node.type == symbols.factor:
-            return self.Factor.parse(node, container = container, parser = self)
-
-        if node.type == symbols.lambdef:
-            return self.Lambda.parse(node, container = container, parser = self)
-
-        if node.type == symbols.not_test:
-            return self.NotTest.parse(node, container = container, parser = self)
-
-        if node.type == symbols.power:
-            return self.parse_power(node, container = container)
-
-        if node.type == symbols.term:
-            return self.Term.parse(node, container = container, parser = self)
-
-        if node.type == symbols.test:
-            return self.Test.parse(node, container = container, parser = self)
-
-        if node.type == symbols.testlist:
-            return self.Tuple.parse(node, container = container, parser = self)
-
-        if node.type == symbols.testlist_gexp:
-            return self.TupleGenerator.parse(node, container = container, parser = self)
-
-        if node.type == tokens.NAME:
-            name = node.value
-            if name == u'False':
-                return self.Boolean(container = container, parser = self, value = False)
-            elif name == u'None':
-                return self.NoneWrapper(container = container, parser = self)
-            elif name == u'True':
-                return self.Boolean(container = container, parser = self, value = True)
-            variable = container.get_variable(name, default = None, parser = self)
-            assert variable is not None, "Undefined variable: {}".format(name)
-            return variable
+    @property
+    def person_class(self):
+        return self.tax_benefit_system.person_entity
 
-        if node.type == tokens.NUMBER:
-            return self.Number.parse(node, container = container, parser = self)
+    def register_builtin(self, name, value = None):
+        """Make a variable available in all the modules parsed by this parser, and return its Variable wrapper.
 
-        if node.type == tokens.STRING:
-            return self.String.parse(node, container = container, parser = self)
+        The value is a wrapper, or None when it is unknown. Variables of the module itself take precedence.
+        """
+        self.builtin_variable_by_name[name] = variable = self.Variable(name = name, parser = self, value = value)
+        return variable
 
-        assert False, "Unexpected value:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
 
-    @property
-    def person_class(self):
-        return self.tax_benefit_system.person_entity
+class SourceLocator(object):
+    """Index of the classes & functions defined at the top level of the Python source files of a package
+
+    Source files are parsed with the ast module, without importing them. Like inspect.getsourcelines, the location of a
+    class is the one of its first top-level definition in a file, and excludes its decorators. The location of a
+    function is the one of its last top-level definition, which is the one bound to its name when the module is run.
+    Files are indexed one at a time when the file of a class is known, and all at once on the first lookup of a class by
+    name only.
+    """
+    location_by_class_name = None  # SourceLocation of each class of the package (in the first file defining it)
+    location_by_class_name_by_file_path = None
+    location_by_function_name_by_file_path = None
+    package_dir = None
+
+    def __init__(self, package_dir = None):
+        self.location_by_class_name_by_file_path = {}
+        self.location_by_function_name_by_file_path = {}
+        if package_dir is not None:
+            self.package_dir = package_dir
+
+    def forget_source_file(self, file_path):
+        """Forget the locations of the classes & functions of a source file, to index it again when it has changed."""
+        self.location_by_function_name_by_file_path.pop(file_path, None)
+        if self.location_by_class_name_by_file_path.pop(file_path, None) is not None:
+            self.location_by_class_name = None
+
+    def get_source_lines(self, location):
+        return linecache.getlines(location.file_path)[location.first_line_number - 1:location.last_line_number]
+
+    def index_file(self, file_path):
+        """Return the SourceLocation of each top-level class of a source file, parsing the file on first request.
+
+        The locations of the top-level functions of the file are indexed at the same time.
+        """
+        location_by_class_name = self.location_by_class_name_by_file_path.get(file_path)
+        if location_by_class_name is not None:
+            return location_by_class_name
+        self.location_by_class_name_by_file_path[file_path] = location_by_class_name = {}
+        self.location_by_function_name_by_file_path[file_path] = location_by_function_name = {}
+        source_lines = linecache.getlines(file_path)
+        try:
+            statements = ast.parse(''.join(source_lines)).body
+        except SyntaxError:
+            log.warning(u'Unable to locate classes of source file {}'.format(file_path))
+            return location_by_class_name
+        for statement, next_statement in zip(statements, statements[1:] + [None]):
+            if isinstance(statement, ast.ClassDef):
+                if statement.name in location_by_class_name:
+                    continue
+                location_by_name = location_by_class_name
+            elif isinstance(statement, ast.FunctionDef):
+                location_by_name = location_by_function_name
+            else:
+                continue
+            # The line number of a decorated statement is the one of its first decorator.
+            first_line_number = statement.lineno
+            while not source_lines[first_line_number - 1].startswith(('class', 'def')):
+                first_line_number += 1
+            last_line_number = len(source_lines) if next_statement is None else next_statement.lineno - 1
+            # Like inspect.getblock, stop at the last statement of the class.
+            while last_line_number > first_line_number and (not source_lines[last_line_number - 1].strip()
+                    or source_lines[last_line_number - 1].lstrip().startswith('#')):
+                last_line_number -= 1
+            location_by_name[statement.name] = SourceLocation(file_path = file_path,
+                first_line_number = first_line_number, last_line_number = last_line_number)
+        return location_by_class_name
+
+    def locate_class(self, class_name, file_path = None):
+        """Return the SourceLocation of a class defined at the top level of a source file, or None.
+
+        When no file is given, the class is looked up in all the source files of the package.
+        """
+        if file_path is not None:
+            return self.index_file(file_path).get(class_name)
+        location_by_class_name = self.location_by_class_name
+        if location_by_class_name is None:
+            location_by_class_name = {}
+            if self.package_dir is not None:
+                for dir, dirs_name, files_name in os.walk(self.package_dir):
+                    dirs_name.sort()
+                    for file_name in sorted(files_name):
+                        if file_name.endswith('.py'):
+                            for name, location in self.index_file(os.path.join(dir, file_name)).iteritems():
+                                location_by_class_name.setdefault(name, location)
+            self.location_by_class_name = location_by_class_name
+        return location_by_class_name.get(class_name)
+
+    def locate_function(self, function_name, file_path):
+        """Return the SourceLocation of a function defined at the top level of a source file, or None."""
+        self.index_file(file_path)
+        return self.location_by_function_name_by_file_path[file_path].get(function_name)
+
+
+def add_parameter_path(parameters_tree, names):
+    """Add the path of a legislation parameter or node to a tree of used legislation nodes, and return its subtree.
+
+    The tree is made of nested dictionaries by name, whose leaves (empty dictionaries) are the used parameters.
+    """
+    for name in names:
+        subtree = parameters_tree.get(name)
+        if subtree is None:
+            parameters_tree[name] = subtree = {}
+        parameters_tree = subtree
+    return parameters_tree
+
+
+def iter_parameters_name(parameters_tree):
+    """Iterate over the dotted names of the leaves of a tree of used legislation nodes (see add_parameter_path)."""
+    remaining_items = [
+        (unicode(name), subtree)
+        for name, subtree in parameters_tree.iteritems()
+        ]
+    while remaining_items:
+        dotted_name, subtree = remaining_items.pop()
+        if subtree:
+            remaining_items.extend(
+                (dotted_name + u'.' + name, child)
+                for name, child in subtree.iteritems()
+                )
+        else:
+            yield dotted_name
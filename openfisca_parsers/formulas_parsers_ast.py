@@ -0,0 +1,753 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Parsers for formula-specific abstract syntax trees, using the ast module of the standard library
+
+This front end builds the same wrappers as formulas_parsers_2to3, from the trees of the C parser behind ast.parse
+instead of those of the (much slower) pure Python lib2to3 driver. Only the wrappers that receive whole definitions
+(classes, functions & file inputs) are specialized. Values & statements are converted to wrappers by the parser, which
+dispatches on the class of ast nodes.
+"""
+
+
+from __future__ import division
+
+import ast
+import collections
+import functools
+import inspect
+import linecache
+import logging
+import os
+import textwrap
+
+from . import formulas_parsers_2to3
+from .formulas_parsers_2to3 import AbstractWrapper, SourceSpan
+
+
+log = logging.getLogger(__name__)
+
+
+# Wrappers of definitions
+
+
+class Class(formulas_parsers_2to3.Class):
+    @classmethod
+    def parse(cls, node, container = None, parser = None):
+        try:
+            assert isinstance(node, ast.ClassDef), "Unexpected class definition:\n{}".format(ast.dump(node))
+            assert not node.decorator_list, "Unexpected decorators in class definition:\n{}".format(ast.dump(node))
+            assert len(node.bases) == 1 and isinstance(node.bases[0], ast.Name), \
+                "Unexpected base classes in class definition:\n{}".format(ast.dump(node))
+
+            variable_by_name = collections.OrderedDict()
+            self = cls(base_class_name = node.bases[0].id, container = container, name = node.name, node = node,
+                parser = parser, variable_by_name = variable_by_name)
+
+            for statement in node.body:
+                if isinstance(statement, ast.FunctionDef):
+                    if statement.decorator_list:
+                        decorator = parser.Decorator.parse(statement, container = self, parser = parser)
+                        variable_by_name[decorator.decorated.name] = parser.Variable(container = self,
+                            name = decorator.name, parser = parser, value = decorator)
+                    else:
+                        function = cls.get_function_class(parser = parser).parse(statement, container = self,
+                            parser = parser)
+                        variable_by_name[function.name] = parser.Variable(container = self, name = function.name,
+                            parser = parser, value = function)
+                else:
+                    # Like the lib2to3 front end, ignore class attributes and docstring.
+                    assert isinstance(statement, (ast.Assign, ast.AugAssign)) or isinstance(statement, ast.Expr) \
+                        and isinstance(statement.value, ast.Str), \
+                        "Unexpected statement in class definition:\n{}".format(ast.dump(statement))
+            return self
+        except:
+            if node is not None:
+                print "An exception occurred in node:\n{}".format(ast.dump(node))
+            raise
+
+
+class ClassFileInput(formulas_parsers_2to3.ClassFileInput):
+    @classmethod
+    def parse(cls, class_definition, parser = None):
+        python_module = inspect.getmodule(class_definition)
+        module_file_input = parser.get_module_file_input(python_module)
+        node = module_file_input.class_node_by_name.get(class_definition.__name__) \
+            if module_file_input is not None else None
+        if node is None:
+            # Class is not at the top level of a module parsable by ast => Parse its source alone.
+            source_lines, line_number = parser.get_class_source_lines(class_definition)
+            source_origin = (inspect.getsourcefile(class_definition), line_number)
+            file_input_node = parser.parse_source(textwrap.dedent(''.join(source_lines)))
+            assert len(file_input_node.body) == 1 and isinstance(file_input_node.body[0], ast.ClassDef), \
+                "Unexpected node children in:\n{}".format(ast.dump(file_input_node))
+            node = file_input_node.body[0]
+        else:
+            file_input_node = module_file_input.node
+            source_origin = (inspect.getsourcefile(python_module), None)
+        if parser.country_package is not None:
+            assert python_module.__file__.startswith(os.path.dirname(parser.country_package.__file__)), \
+                "Requested class is defined outside country_package:\n{}".format(ast.dump(node))
+        previous_source_origin = parser.source_origin
+        parser.source_origin = source_origin
+        try:
+            module = parser.python_module_by_name.get(python_module.__name__)
+            if module is None:
+                parser.python_module_by_name[python_module.__name__] = module = parser.Module(file_input_node,
+                    python = python_module, parser = parser)
+            self = cls(parser = parser)
+            class_definition_class = self.get_class_class(parser = parser)
+            return class_definition_class.parse(node, container = module, parser = parser)
+        except:
+            if node is not None:
+                print "An exception occurred in node:\n{}".format(ast.dump(node))
+            raise
+        finally:
+            parser.source_origin = previous_source_origin
+
+
+class Decorator(formulas_parsers_2to3.Decorator):
+    @classmethod
+    def parse(cls, node, container = None, parser = None):
+        try:
+            assert len(node.decorator_list) == 1, "Unexpected decorators in:\n{}".format(ast.dump(node))
+            decorator = node.decorator_list[0]
+            assert isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Name), \
+                "Unexpected decorator:\n{}".format(ast.dump(decorator))
+            name = decorator.func.id
+            subject = parser.Variable(container = container, name = name, node = decorator.func, parser = parser)
+            subject = parser.parse_call_arguments(subject, decorator, container = container)
+
+            decorated = container.get_function_class(parser = parser).parse(node, container = container,
+                parser = parser)
+
+            return cls(container = container, decorated = decorated, name = name, node = node, parser = parser,
+                subject = subject)
+        except:
+            if node is not None:
+                print "An exception occurred in node:\n{}".format(ast.dump(node))
+            raise
+
+
+class Function(formulas_parsers_2to3.Function):
+    @classmethod
+    def parse(cls, node, container = None, parser = None):
+        try:
+            assert isinstance(node, ast.FunctionDef), "Unexpected function definition:\n{}".format(ast.dump(node))
+            self = cls(container = container, name = node.name, node = node, parser = parser)
+            self.parse_parameters()
+            # Don't parse body now. Wait for first call (to know the values of the parameters).
+            return self
+        except:
+            if node is not None:
+                print "An exception occurred in node:\n{}".format(ast.dump(node))
+            raise
+
+    def parse_body(self):
+        parser = self.parser
+        node = self.get_node()
+
+        self.body_parsed = True
+        previous_source_origin = parser.source_origin
+        if isinstance(self.node, SourceSpan):
+            parser.source_origin = (self.node.file_path, self.node.first_line_number)
+        try:
+            body = parser.parse_suite(node.body, container = self)
+        finally:
+            parser.source_origin = previous_source_origin
+        self.body[:] = body
+        # In lean mode, the node is no more needed.
+        self.definition_node = None
+
+    def parse_parameters(self):
+        parser = self.parser
+        arguments = self.get_node().args
+
+        first_named_parameter_index = len(arguments.args) - len(arguments.defaults)
+        for parameter_index, parameter in enumerate(arguments.args):
+            assert isinstance(parameter, ast.Name), "Unexpected parameter:\n{}".format(ast.dump(parameter))
+            parameter_name = parameter.id
+            if parameter_index < first_named_parameter_index:
+                # Positional parameter
+                self.positional_parameters.append(parameter_name)
+            else:
+                # Named parameter
+                self.named_parameters[parameter_name] = parser.parse_value(
+                    arguments.defaults[parameter_index - first_named_parameter_index], container = self)
+            self.variable_by_name[parameter_name] = parser.Variable(container = self, name = parameter_name,
+                parser = parser)
+        if arguments.vararg is not None:
+            self.star_name = arguments.vararg
+            self.variable_by_name[self.star_name] = parser.Variable(container = self, name = self.star_name,
+                parser = parser)
+        if arguments.kwarg is not None:
+            self.keyword_name = arguments.kwarg
+            self.variable_by_name[self.keyword_name] = parser.Variable(container = self, name = self.keyword_name,
+                parser = parser)
+
+
+class FunctionFileInput(formulas_parsers_2to3.FunctionFileInput):
+    @classmethod
+    def parse(cls, function, parser = None):
+        python_module = inspect.getmodule(function)
+        module_file_input = parser.get_module_file_input(python_module)
+        # See formulas_parsers_2to3.FunctionFileInput.parse.
+        node = module_file_input.function_node_by_name.get(function.__name__) \
+            if module_file_input is not None and parser.is_top_level_function(function) else None
+        if node is None:
+            # Function is not at the top level of a module parsable by ast => Parse its source alone.
+            source_lines, line_number = parser.get_function_source_lines(function)
+            source_origin = (inspect.getsourcefile(function), line_number)
+            file_input_node = parser.parse_source(textwrap.dedent(''.join(source_lines)))
+            assert len(file_input_node.body) == 1 and isinstance(file_input_node.body[0], ast.FunctionDef) \
+                and not file_input_node.body[0].decorator_list, \
+                "Unexpected node children in:\n{}".format(ast.dump(file_input_node))
+            node = file_input_node.body[0]
+        else:
+            file_input_node = module_file_input.node
+            source_origin = (inspect.getsourcefile(python_module), None)
+        if parser.country_package is not None:
+            assert python_module.__file__.startswith(os.path.dirname(parser.country_package.__file__)), \
+                "Requested class is defined outside country_package:\n{}".format(ast.dump(node))
+        previous_source_origin = parser.source_origin
+        parser.source_origin = source_origin
+        try:
+            module = parser.python_module_by_name.get(python_module.__name__)
+            if module is None:
+                parser.python_module_by_name[python_module.__name__] = module = parser.Module(file_input_node,
+                    python = python_module, parser = parser)
+            self = cls(parser = parser)
+            function_class = self.get_function_class(parser = parser)
+            return function_class.parse(node, container = module, parser = parser)
+        except:
+            if node is not None:
+                print "An exception occurred in node:\n{}".format(ast.dump(node))
+            raise
+        finally:
+            parser.source_origin = previous_source_origin
+
+
+class ModuleFileInput(formulas_parsers_2to3.ModuleFileInput):
+    """Wrapper for the ast tree of a whole Python module, parsed once and shared by all its definitions"""
+
+    @classmethod
+    def parse(cls, python_module, parser = None):
+        source_file_path = inspect.getsourcefile(python_module)
+        if source_file_path is None:
+            return None
+        source_lines = linecache.getlines(source_file_path, python_module.__dict__)
+        if not source_lines:
+            return None
+        try:
+            node = parser.parse_source(''.join(source_lines))
+        except SyntaxError:
+            log.warning(u'Unable to parse module {} as a whole'.format(python_module.__name__))
+            return None
+
+        class_node_by_name = {}
+        function_node_by_name = {}
+        for statement in node.body:
+            if isinstance(statement, ast.ClassDef):
+                # Like inspect.getsourcelines, use the first top-level definition of a class.
+                class_node_by_name.setdefault(statement.name, statement)
+            elif isinstance(statement, ast.FunctionDef):
+                if statement.decorator_list:
+                    # Like the lib2to3 front end, decorated functions are parsed alone.
+                    function_node_by_name.pop(statement.name, None)
+                else:
+                    # Use the last top-level definition of a function, which is the one bound to its name.
+                    function_node_by_name[statement.name] = statement
+        return cls(class_node_by_name = class_node_by_name, function_node_by_name = function_node_by_name,
+            node = node, parser = parser, python = python_module)
+
+
+# Formula-specific classes
+
+
+class FormulaClass(formulas_parsers_2to3.FormulaClass, Class):
+    pass
+
+
+class FormulaClassFileInput(formulas_parsers_2to3.FormulaClassFileInput, ClassFileInput):
+    pass
+
+
+class FormulaFunction(formulas_parsers_2to3.FormulaFunction, Function):
+    @classmethod
+    def parse(cls, node, container = None, parser = None):
+        try:
+            assert isinstance(node, ast.FunctionDef), "Unexpected function definition:\n{}".format(ast.dump(node))
+            self = cls(container = container, name = node.name, node = node, parser = parser)
+            self.parse_parameters()
+            self.parse_body()
+            return self
+        except:
+            if node is not None:
+                print "An exception occurred in node:\n{}".format(ast.dump(node))
+            raise
+
+
+# Default Parser
+
+
+class Parser(formulas_parsers_2to3.Parser):
+    # Symbols of augmented assignment operators, by ast operator class
+    augmented_operator_symbol_by_class = {
+        ast.Add: '+=',
+        ast.BitAnd: '&=',
+        ast.Mult: '*=',
+        ast.Sub: '-=',
+        }
+    # Names of the wrapper classes of binary operations and symbols of their operators, by ast operator class.
+    # Operators sharing the same wrapper class have the same precedence and are chained in a single wrapper.
+    binary_operation_wrapper_name_and_symbol_by_class = {
+        ast.Add: ('ArithmeticExpression', '+'),
+        ast.BitAnd: ('AndExpression', '&'),
+        ast.BitOr: ('Expression', '|'),
+        ast.Div: ('Term', '/'),
+        ast.FloorDiv: ('Term', '//'),
+        ast.Mod: ('Term', '%'),
+        ast.Mult: ('Term', '*'),
+        ast.Sub: ('ArithmeticExpression', '-'),
+        }
+    Class = Class
+    ClassFileInput = ClassFileInput
+    # Symbols of comparison operators, by ast operator class
+    comparison_operator_symbol_by_class = {
+        ast.Eq: '==',
+        ast.Gt: '>',
+        ast.GtE: '>=',
+        ast.In: 'in',
+        ast.Is: 'is',
+        ast.IsNot: 'is not',
+        ast.Lt: '<',
+        ast.LtE: '<=',
+        ast.NotEq: '!=',
+        ast.NotIn: 'not in',
+        }
+    Decorator = Decorator
+    FormulaClass = FormulaClass
+    FormulaClassFileInput = FormulaClassFileInput
+    FormulaFunction = FormulaFunction
+    Function = Function
+    FunctionFileInput = FunctionFileInput
+    ModuleFileInput = ModuleFileInput
+    node_class = ast.AST
+    simple_statement_parser_name_by_type = {}  # ast has no simple statement nodes.
+    # Names of the wrapper classes or of the parser methods that parse a statement of a suite, by ast node class
+    statement_parser_name_by_type = {
+        ast.Assert: 'parse_assert',
+        ast.Assign: 'parse_assignment',
+        ast.AugAssign: 'parse_augmented_assignment',
+        ast.Continue: 'parse_continue',
+        ast.Expr: 'parse_expression_statement',
+        ast.For: 'parse_for',
+        ast.FunctionDef: 'parse_function_definition',
+        ast.Global: 'ignore_node',  # TODO: Used only by zone_apl.
+        ast.If: 'parse_if',
+        ast.Raise: 'parse_raise',
+        ast.Return: 'parse_return',
+        ast.With: 'ignore_node',  # TODO: Used only by zone_apl.
+        }
+    # Names of the wrapper classes or of the parser methods that parse a value, by ast node class
+    value_parser_name_by_type = {
+        ast.Attribute: 'parse_attribute',
+        ast.BinOp: 'parse_binary_operation',
+        ast.BoolOp: 'parse_boolean_operation',
+        ast.Call: 'parse_call',
+        ast.Compare: 'parse_comparison',
+        ast.Dict: 'parse_dictionary',
+        ast.GeneratorExp: 'parse_generator_expression',
+        ast.IfExp: 'parse_if_expression',
+        ast.Lambda: 'parse_lambda',
+        ast.List: 'parse_list',
+        ast.ListComp: 'parse_list_comprehension',
+        ast.Name: 'parse_name',
+        ast.Num: 'parse_number',
+        ast.Str: 'parse_string',
+        ast.Subscript: 'parse_subscript',
+        ast.Tuple: 'parse_tuple',
+        ast.UnaryOp: 'parse_unary_operation',
+        }
+
+    def get_node_parsers(self, parser_name_by_type):
+        """Convert a dictionary of names of wrapper classes or of parser methods to a dictionary of functions.
+
+        The dictionary is keyed by ast node class. Each function is called with a node and a container.
+        """
+        node_parser_by_type = {}
+        for node_type, parser_name in parser_name_by_type.iteritems():
+            node_parser = getattr(self, parser_name)
+            if isinstance(node_parser, type) and issubclass(node_parser, AbstractWrapper):
+                node_parser = functools.partial(node_parser.parse, parser = self)
+            node_parser_by_type[node_type] = node_parser
+        return node_parser_by_type
+
+    def get_source_span(self, node):
+        """Return the SourceSpan of a node of the source being parsed."""
+        file_path, first_line_number = self.source_origin or (None, None)
+        return SourceSpan(column = getattr(node, 'col_offset', None), file_path = file_path,
+            first_line_number = first_line_number, line_number = getattr(node, 'lineno', None), type = type(node))
+
+    def get_span_node(self, source_span):
+        """Parse again the source of a SourceSpan and return the node it spans, or None."""
+        if source_span.file_path is None:
+            return None
+        source_lines = linecache.getlines(source_span.file_path)
+        if source_span.first_line_number is not None:
+            source_lines = inspect.getblock(source_lines[source_span.first_line_number - 1:])
+        for node in ast.walk(self.parse_source(textwrap.dedent(''.join(source_lines)))):
+            if type(node) is source_span.type and getattr(node, 'lineno', None) == source_span.line_number \
+                    and getattr(node, 'col_offset', None) == source_span.column:
+                return node
+        return None
+
+    def parse_assert(self, node, container = None):
+        test = self.parse_value(node.test, container = container)
+        # TODO
+        # error = self.parse_value(node.msg, container = container)
+        return self.Assert(container = container, node = node, parser = self, test = test)
+
+    def parse_assignment(self, node, container = None):
+        assert len(node.targets) == 1, "Unexpected chained assignment:\n{}".format(ast.dump(node))
+        left = node.targets[0]
+        right = node.value
+
+        # Right items must be parsed before left ones, to avoid reuse of left variables (for example in statements like:
+        # period = period).
+        if isinstance(left, ast.Tuple) and isinstance(right, ast.Tuple):
+            right_items = [
+                self.parse_value(right_item, container = container)
+                for right_item in right.elts
+                ]
+        else:
+            right_items = [self.parse_value(right, container = container)]
+
+        if isinstance(left, ast.Tuple):
+            left_items = []
+            for left_item in left.elts:
+                assert isinstance(left_item, ast.Name), "Unexpected assignment left operand:\n{}".format(
+                    ast.dump(node))
+                variable = self.Variable(container = container, name = left_item.id, node = left_item, parser = self)
+                left_items.append(variable)
+                container.variable_by_name[variable.name] = variable
+        else:
+            left_items = [self.parse_assignment_target(left, container = container)]
+
+        return self.Assignment(container = container, left = left_items, node = node, operator = '=', parser = self,
+            right = right_items)
+
+    def parse_assignment_target(self, node, container = None, operator = '='):
+        """Parse the single left operand of an assignment and return its wrapper."""
+        if isinstance(node, (ast.Attribute, ast.Subscript)):
+            return self.parse_value(node, container = container)
+        assert isinstance(node, ast.Name), "Unexpected assignment left operand:\n{}".format(ast.dump(node))
+        variable = self.Variable(container = container, name = node.id, node = node, parser = self,
+            value = None if operator == '=' else container.get_variable(node.id, parser = self))
+        container.variable_by_name[variable.name] = variable
+        return variable
+
+    def parse_attribute(self, node, container = None):
+        subject = self.parse_value(node.value, container = container)
+        return self.Attribute(container = container, name = node.attr, node = node, parser = self, subject = subject)
+
+    def parse_augmented_assignment(self, node, container = None):
+        operator_symbol = self.augmented_operator_symbol_by_class.get(type(node.op))
+        assert operator_symbol is not None, "Unexpected assignment operator:\n{}".format(ast.dump(node))
+        right = self.parse_value(node.value, container = container)
+        left = self.parse_assignment_target(node.target, container = container, operator = operator_symbol)
+        return self.Assignment(container = container, left = [left], node = node, operator = operator_symbol,
+            parser = self, right = [right])
+
+    def parse_binary_operation(self, node, container = None):
+        wrapper_name, operator_symbol = self.binary_operation_wrapper_name_and_symbol_by_class.get(type(node.op),
+            (None, None))
+        assert wrapper_name is not None, "Unexpected binary operator:\n{}".format(ast.dump(node))
+
+        # Like lib2to3, gather the left-associated operations of the same precedence in a single wrapper.
+        operands_node = []
+        operators_symbol = []
+        operand_node = node
+        while isinstance(operand_node, ast.BinOp):
+            operand_wrapper_name, operand_operator_symbol = self.binary_operation_wrapper_name_and_symbol_by_class.get(
+                type(operand_node.op), (None, None))
+            if operand_wrapper_name != wrapper_name:
+                break
+            operands_node.append(operand_node.right)
+            operators_symbol.append(operand_operator_symbol)
+            operand_node = operand_node.left
+        operands_node.append(operand_node)
+        operands_node.reverse()
+        operators_symbol.reverse()
+        operands = [
+            self.parse_value(operand_node, container = container)
+            for operand_node in operands_node
+            ]
+
+        wrapper_class = getattr(self, wrapper_name)
+        if wrapper_name in ('ArithmeticExpression', 'Term'):
+            items = [operands[0]]
+            for operator_symbol, operand in zip(operators_symbol, operands[1:]):
+                items.append(operator_symbol)
+                items.append(operand)
+            return wrapper_class(container = container, items = items, node = node, parser = self)
+        return wrapper_class(container = container, node = node, operands = operands, operator = operator_symbol,
+            parser = self)
+
+    def parse_boolean_operation(self, node, container = None):
+        assert isinstance(node.op, ast.And), "Unexpected boolean operator:\n{}".format(ast.dump(node))
+        operands = [
+            self.parse_value(operand, container = container)
+            for operand in node.values
+            ]
+        return self.AndTest(container = container, node = node, operands = operands, operator = u'and', parser = self)
+
+    def parse_call(self, node, container = None):
+        subject = self.parse_value(node.func, container = container)
+        return self.parse_call_arguments(subject, node, container = container)
+
+    def parse_call_arguments(self, subject, node, container = None):
+        """Parse the arguments of an ast.Call node and return the Call wrapper of given subject."""
+        positional_arguments = [
+            self.parse_value(argument, container = container)
+            for argument in node.args
+            ]
+        named_arguments = collections.OrderedDict(
+            (keyword.arg, self.parse_value(keyword.value, container = container))
+            for keyword in node.keywords
+            )
+        star_argument = self.parse_value(node.starargs, container = container) \
+            if node.starargs is not None else None
+        keyword_argument = self.parse_value(node.kwargs, container = container) if node.kwargs is not None else None
+        return self.Call(container = container, keyword_argument = keyword_argument,
+            named_arguments = named_arguments, node = node, parser = self,
+            positional_arguments = positional_arguments, star_argument = star_argument, subject = subject)
+
+    def parse_comparison(self, node, container = None):
+        assert len(node.ops) == 1, "Unexpected chained comparison:\n{}".format(ast.dump(node))
+        operator_symbol = self.comparison_operator_symbol_by_class[type(node.ops[0])]
+        left = self.parse_value(node.left, container = container)
+        right = self.parse_value(node.comparators[0], container = container)
+        return self.Comparison(container = container, left = left, node = node, operator = operator_symbol,
+            parser = self, right = right)
+
+    def parse_continue(self, node, container = None):
+        return self.Continue(container = container, node = node, parser = self)
+
+    def parse_dictionary(self, node, container = None):
+        assert node.keys, "Unexpected empty dictionary:\n{}".format(ast.dump(node))
+        for key, value in zip(node.keys, node.values):
+            item_key = self.parse_value(key, container = container)
+            item_value = self.parse_value(value, container = container)
+        # TODO: Currently it is assumed that dictionary is uniform.
+        return self.UniformDictionary(
+            container = container,
+            key = item_key,
+            parser = self,
+            value = item_value,
+            )
+
+    def parse_expression_statement(self, node, container = None):
+        value = node.value
+        if isinstance(value, ast.Str):
+            # Docstring
+            return self.parse_string(value, container = container)
+        assert isinstance(value, (ast.Attribute, ast.Call, ast.Subscript)), \
+            "Unexpected simple statement in suite:\n{}".format(ast.dump(node))
+        return self.parse_value(value, container = container)
+
+    def parse_for(self, node, container = None):
+        assert not node.orelse, "Unexpected else clause in for statement:\n{}".format(ast.dump(node))
+        variable_by_name = self.parse_iteration_variables(node.target, container = container)
+        iterator = self.parse_value(node.iter, container = container)
+        for_wrapper = self.For(container = container, iterator = iterator, node = node, parser = self,
+            variable_by_name = variable_by_name)
+        for_wrapper.body = self.parse_suite(node.body, container = container)
+        return for_wrapper
+
+    def parse_function_definition(self, node, container = None):
+        assert not node.decorator_list, "Unexpected decorated function in suite:\n{}".format(ast.dump(node))
+        return super(Parser, self).parse_function_definition(node, container = container)
+
+    def parse_generator_expression(self, node, container = None):
+        # TODO: Used only by zone_apl
+        return self.TupleGenerator(container = container, node = node, parser = self)
+
+    def parse_if(self, node, container = None):
+        items = []
+        if_node = node
+        while True:
+            test = self.parse_value(if_node.test, container = container)
+            body = self.parse_suite(if_node.body, container = container)
+            items.append((test, body))
+            orelse = if_node.orelse
+            if len(orelse) == 1 and isinstance(orelse[0], ast.If):
+                # elif
+                if_node = orelse[0]
+                continue
+            if orelse:
+                items.append((None, self.parse_suite(orelse, container = container)))
+            break
+        return self.If(container = container, items = items, node = node, parser = self)
+
+    def parse_if_expression(self, node, container = None):
+        true_value = self.parse_value(node.body, container = container)
+        test = self.parse_value(node.test, container = container)
+        false_value = self.parse_value(node.orelse, container = container)
+        return self.Test(container = container, false_value = false_value, node = node, parser = self, test = test,
+            true_value = true_value)
+
+    def parse_iteration_variables(self, node, container = None):
+        """Return the ordered dictionary of the variables assigned by the target of a for statement or generator."""
+        if isinstance(node, ast.Tuple):
+            variables_node = node.elts
+        else:
+            variables_node = [node]
+        variable_by_name = collections.OrderedDict()
+        for variable_node in variables_node:
+            assert isinstance(variable_node, ast.Name), "Unexpected variables in for statement:\n{}".format(
+                ast.dump(node))
+            variable_by_name[variable_node.id] = self.Variable(container = container, name = variable_node.id,
+                node = variable_node, parser = self)
+        return variable_by_name
+
+    def parse_lambda(self, node, container = None):
+        parameters = node.args
+        assert len(parameters.args) == 1 and isinstance(parameters.args[0], ast.Name) and not parameters.defaults \
+            and parameters.vararg is None and parameters.kwarg is None, \
+            "Unexpected parameters in lambda definition:\n{}".format(ast.dump(node))
+        lambda_wrapper = self.Lambda(container = container, node = node, parser = self)
+        parameter_name = parameters.args[0].id
+        lambda_wrapper.positional_parameters.append(parameter_name)
+        lambda_wrapper.variable_by_name[parameter_name] = self.Variable(container = lambda_wrapper,
+            name = parameter_name, parser = self)
+        lambda_wrapper.expression = self.parse_value(node.body, container = lambda_wrapper)
+        return lambda_wrapper
+
+    def parse_list(self, node, container = None):
+        items = [
+            self.parse_value(item, container = container)
+            for item in node.elts
+            ]
+        return self.List(container = container, node = node, parser = self, value = items)
+
+    def parse_list_comprehension(self, node, container = None):
+        iterators = []
+        variable_by_name = collections.OrderedDict()
+        for generator in node.generators:
+            assert not generator.ifs, "Unexpected condition in list generator:\n{}".format(ast.dump(node))
+            variable_by_name.update(self.parse_iteration_variables(generator.target, container = container))
+            iterators.append(self.parse_value(generator.iter, container = container))
+        list_generator = self.ListGenerator(container = container, iterators = iterators, node = node,
+            parser = self, variable_by_name = variable_by_name)
+        list_generator.value = self.parse_value(node.elt, container = container)
+        return list_generator
+
+    def parse_name(self, node, container = None):
+        name = node.id
+        if name == u'False':
+            return self.Boolean(container = container, parser = self, value = False)
+        elif name == u'None':
+            return self.NoneWrapper(container = container, parser = self)
+        elif name == u'True':
+            return self.Boolean(container = container, parser = self, value = True)
+        variable = container.get_variable(name, default = None, parser = self)
+        assert variable is not None, "Undefined variable: {}".format(name)
+        return variable
+
+    def parse_number(self, node, container = None):
+        return self.Number(container = container, node = node, parser = self, value = node.n)
+
+    def parse_raise(self, node, container = None):
+        assert node.type is not None and node.inst is None and node.tback is None, \
+            "Unexpected raise statement:\n{}".format(ast.dump(node))
+        exception = self.parse_value(node.type, container = container)
+        return self.Raise(container = container, exception = exception, node = node, parser = self)
+
+    def parse_return(self, node, container = None):
+        assert node.value is not None, "Unexpected return without value:\n{}".format(ast.dump(node))
+        value = self.parse_value(node.value, container = container)
+        return_wrapper = self.Return(container = container, node = node, parser = self, value = value)
+        return_wrapper.containing_function.returns.append(return_wrapper)
+        return return_wrapper
+
+    def parse_source(self, source):
+        """Parse Python source code into an ast tree.
+
+        ast.parse is fast enough for its trees not to be stored in cache directory.
+        """
+        return ast.parse(source)
+
+    def parse_string(self, node, container = None):
+        value = node.s
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        return self.String(container = container, node = node, parser = self, value = value)
+
+    def parse_subscript(self, node, container = None):
+        assert isinstance(node.slice, ast.Index), "Unexpected key:\n{}".format(ast.dump(node))
+        subject = self.parse_value(node.value, container = container)
+        value = self.parse_value(node.slice.value, container = container)
+        return self.Key(container = container, node = node, parser = self, subject = subject, value = value)
+
+    def parse_suite(self, node, container = None):
+        """Parse a list of ast statements and return the list of their wrappers."""
+        assert isinstance(node, list), "Invalid suite: {}".format(node)
+        assert isinstance(container, AbstractWrapper), "Invalid container {} for suite: {}".format(container, node)
+
+        body = []
+        statement_parsers = self.statement_parsers
+        for child in node:
+            statement_parser = statement_parsers.get(type(child))
+            assert statement_parser is not None, "Unexpected statement in suite:\n{}".format(ast.dump(child))
+            statement = statement_parser(child, container = container)
+            if statement is not None:
+                body.append(statement)
+        return body
+
+    def parse_tuple(self, node, container = None):
+        items = [
+            self.parse_value(item, container = container)
+            for item in node.elts
+            ]
+        return self.Tuple(container = container, node = node, parser = self, value = tuple(items))
+
+    def parse_unary_operation(self, node, container = None):
+        operator = node.op
+        operand = self.parse_value(node.operand, container = container)
+        if isinstance(operator, ast.Not):
+            return self.NotTest(container = container, node = node, parser = self, value = operand)
+        assert isinstance(operator, (ast.Invert, ast.USub)), "Unexpected operator type:\n{}".format(ast.dump(node))
+        return self.Factor(container = container, node = node, operand = operand,
+            operator = '~' if isinstance(operator, ast.Invert) else '-', parser = self)
+
+    def parse_value(self, node, container = None):
+        assert isinstance(node, ast.expr), "Invalid node: {}".format(node)
+        assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}".format(container,
+            ast.dump(node))
+
+        value_parser = self.value_parsers.get(type(node))
+        assert value_parser is not None, "Unexpected value:\n{}".format(ast.dump(node))
+        return value_parser(node, container = container)
@@ -26,15 +26,42 @@
 """Extract input variables from Python formulas using lib2to3."""
 
 
+import collections
+import hashlib
+import inspect
+import itertools
+import json
 import lib2to3.pgen2.driver
 import lib2to3.pygram
 import lib2to3.pytree
 import logging
+import mmap
+import os
+import pkgutil
+import struct
+import sys
 
-from . import formulas_parsers_2to3
+import numpy as np
 
+from . import bytecode_extractors, formulas_parsers_2to3, formulas_parsers_ast
 
+
+# Graph of the input variables & parameters of all variables, as compressed sparse rows (CSR) arrays:
+# indices[indptr[i]:indptr[i + 1]] are the indexes (in variables_name or parameters_name) of the input variables or
+# parameters used by formula of variable variables_name[i].
+DependencyGraph = collections.namedtuple('DependencyGraph', [
+    'input_variables_indices',
+    'input_variables_indptr',
+    'parameters_indices',
+    'parameters_indptr',
+    'parameters_name',  # Sorted array of dotted names of parameters
+    'variables_name',  # Sorted array of names of variables
+    ])
 log = logging.getLogger(__name__)
+manifest_version = 2  # Version of manifest format, to increment when extracted data change
+snapshot_magic = 'OFDGRAPH'  # First bytes of dependency graph snapshot files
+snapshot_version = 1  # Version of snapshot format, to increment when the layout of snapshot files changes
+warm_start_version = 1  # Version of warm start files format, to increment when their layout changes
 
 
 class Attribute(formulas_parsers_2to3.Attribute):
@@ -44,7 +71,8 @@ class Attribute(formulas_parsers_2to3.Attribute):
 
         compact_node = self.subject.guess(parser.CompactNode)
         if compact_node is not None:
-            parser.parameters.add(tuple(compact_node.iter_names()) + (self.name,))
+            formulas_parsers_2to3.add_parameter_path(parser.parameters_tree,
+                itertools.chain(compact_node.iter_names(), (self.name,)))
 
 
 class Call(formulas_parsers_2to3.Call):
@@ -82,6 +110,8 @@ class Call(formulas_parsers_2to3.Call):
 class Parser(formulas_parsers_2to3.Parser):
     Attribute = Attribute
     Call = Call
+    helper_source_files_path = None  # Source files of the module functions used by the formula of the last column
+    parameters_tree = None  # Tree of the legislation nodes used by the last column formula (see add_parameter_path)
 
     def get_input_variables_and_parameters(self, column):
         formula_class = column.formula_class
@@ -90,29 +120,427 @@ class Parser(formulas_parsers_2to3.Parser):
             return None, None
         self.column = column
         self.input_variables = input_variables = set()
-        self.parameters = parameters = set()
+        self.parameters_tree = parameters_tree = {}
         try:
             self.FormulaClassFileInput.parse(formula_class, parser = self)
         except AssertionError:
             # When parsing fails, assume that all input variables have already been parsed.
             pass
-        for names_tuple in parameters.copy():
-            for i in range(len(names_tuple)):
-                parameters.discard(names_tuple[:i])
-        parameters = set(
-            u'.'.join(names_tuple)
-            for names_tuple in parameters
-            )
+        parameters = set(formulas_parsers_2to3.iter_parameters_name(parameters_tree))
         del self.column
         del self.input_variables
-        del self.parameters
-        self.python_module_by_name.clear()
+        self.helper_source_files_path = self.get_helper_source_files_path()
+        # Keep module wrappers for next columns, but forget the functions parsed with the arguments of this column.
+        self.function_variable_by_key.clear()
         return input_variables, parameters
 
 
-def setup(tax_benefit_system):
+class AstParser(formulas_parsers_ast.Parser, Parser):
+    """Parser using the front end based on the ast module instead of lib2to3"""
+
+
+class ParametersImpactIndex(object):
+    """Index of the variables impacted by changes of legislation parameters, built from a DependencyGraph
+
+    A formula is impacted by a changed legislation path when it uses this path, a parameter below it or a node above
+    it, or when it depends on an impacted variable.
+    """
+    consumers_indices = None  # Transposed CSR arrays of the input variables of the graph: the variables that use each
+    consumers_indptr = None  # variable
+    dependency_graph = None
+    parameter_consumers_indices = None  # Transposed CSR arrays of the parameters of the graph: the variables that use
+    parameter_consumers_indptr = None  # each parameter
+
+    def __init__(self, dependency_graph = None):
+        assert isinstance(dependency_graph, DependencyGraph)
+        self.dependency_graph = dependency_graph
+        variables_count = len(dependency_graph.variables_name)
+        self.consumers_indices, self.consumers_indptr = transpose_csr(dependency_graph.input_variables_indices,
+            dependency_graph.input_variables_indptr, variables_count)
+        self.parameter_consumers_indices, self.parameter_consumers_indptr = transpose_csr(
+            dependency_graph.parameters_indices, dependency_graph.parameters_indptr,
+            len(dependency_graph.parameters_name))
+
+    def get_impacted_variables(self, parameters_name):
+        """Return the names of the variables impacted by changes of given dotted legislation paths."""
+        dependency_graph = self.dependency_graph
+        parameter_consumers_indices = self.parameter_consumers_indices
+        parameter_consumers_indptr = self.parameter_consumers_indptr
+        impacted = np.zeros(len(dependency_graph.variables_name), dtype = np.bool)
+        frontier = np.unique(np.concatenate([np.array([], dtype = np.int32)] + [
+            parameter_consumers_indices[parameter_consumers_indptr[parameter_index]:
+                parameter_consumers_indptr[parameter_index + 1]]
+            for parameter_name in parameters_name
+            for parameter_index in self.iter_matching_parameters_index(parameter_name)
+            ]))
+        consumers_indices = self.consumers_indices
+        consumers_indptr = self.consumers_indptr
+        while len(frontier):
+            frontier = frontier[~impacted[frontier]]
+            impacted[frontier] = True
+            frontier = np.unique(np.concatenate([np.array([], dtype = np.int32)] + [
+                consumers_indices[consumers_indptr[variable_index]:consumers_indptr[variable_index + 1]]
+                for variable_index in frontier
+                ]))
+        return set(dependency_graph.variables_name[impacted])
+
+    def iter_matching_parameters_index(self, parameter_name):
+        """Iterate over the indexes of the parameters of the graph that are equal to a dotted legislation path, below
+        it or above it.
+
+        Parameters names are sorted, so the parameters below a path are found by binary search, as the names between
+        "path." and "path/" ("/" follows "." in character order).
+        """
+        parameters_name = self.dependency_graph.parameters_name
+        names = parameter_name.split(u'.')
+        for names_count in range(1, len(names) + 1):
+            ancestor_name = u'.'.join(names[:names_count])
+            index = parameters_name.searchsorted(ancestor_name)
+            if index < len(parameters_name) and parameters_name[index] == ancestor_name:
+                yield index
+        start, stop = parameters_name.searchsorted([parameter_name + u'.', parameter_name + u'/'])
+        for index in range(start, stop):
+            yield index
+
+
+def align_offset(offset, alignment = 8):
+    """Return the smallest multiple of alignment that is not less than offset."""
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def extract_dependency_graph(tax_benefit_system, parser = None):
+    """Analyse the formulas of all columns once and return their dependencies as a DependencyGraph."""
+    if parser is None:
+        parser = setup(tax_benefit_system)
+    input_variables_by_name = {}
+    parameters_by_name = {}
+    for name, column in tax_benefit_system.column_by_name.iteritems():
+        input_variables, parameters = parser.get_input_variables_and_parameters(column)
+        if input_variables is not None:
+            input_variables_by_name[name] = input_variables
+            parameters_by_name[name] = parameters
+
+    variables_name = set(tax_benefit_system.column_by_name)
+    for input_variables in input_variables_by_name.itervalues():
+        variables_name.update(input_variables)
+    variables_name = sorted(variables_name)
+    parameters_name = sorted(set(
+        parameter_name
+        for parameters in parameters_by_name.itervalues()
+        for parameter_name in parameters
+        ))
+
+    def to_csr(items_by_variable_name, items_name):
+        index_by_item_name = dict(
+            (item_name, index)
+            for index, item_name in enumerate(items_name)
+            )
+        indptr = np.zeros(len(variables_name) + 1, dtype = np.int32)
+        indices = []
+        for variable_index, variable_name in enumerate(variables_name):
+            items = items_by_variable_name.get(variable_name)
+            if items:
+                indices.extend(sorted(index_by_item_name[item_name] for item_name in items))
+            indptr[variable_index + 1] = len(indices)
+        return np.array(indices, dtype = np.int32), indptr
+
+    input_variables_indices, input_variables_indptr = to_csr(input_variables_by_name, variables_name)
+    parameters_indices, parameters_indptr = to_csr(parameters_by_name, parameters_name)
+    return DependencyGraph(
+        input_variables_indices = input_variables_indices,
+        input_variables_indptr = input_variables_indptr,
+        parameters_indices = parameters_indices,
+        parameters_indptr = parameters_indptr,
+        parameters_name = np.array(parameters_name, dtype = np.unicode_),
+        variables_name = np.array(variables_name, dtype = np.unicode_),
+        )
+
+
+def get_country_package_fingerprint(country_package_name):
+    """Return a SHA-1 of the paths, sizes & modification times of the files of a country package (except compiled
+    ones), without importing the package nor reading its files.
+
+    It is much cheaper than get_country_package_source_hash, but changes also when a file is touched.
+    """
+    fingerprint = hashlib.sha1()
+    for file_path, relative_file_path in iter_package_files_path(country_package_name):
+        file_stat = os.stat(file_path)
+        fingerprint.update('{}\0{}\0{!r}\0'.format(relative_file_path, file_stat.st_size, file_stat.st_mtime))
+    return fingerprint.hexdigest()
+
+
+def get_country_package_source_hash(country_package_name):
+    """Return the SHA-1 of all the files of a country package (except compiled ones), without importing it."""
+    source_hash = hashlib.sha1()
+    for file_path, relative_file_path in iter_package_files_path(country_package_name):
+        source_hash.update(relative_file_path.encode('utf-8') + '\0')
+        with open(file_path, 'rb') as source_file:
+            source_hash.update(source_file.read())
+    return source_hash.hexdigest()
+
+
+def get_input_variables_and_parameters_from_graph(dependency_graph, name):
+    """Return the input variables & parameters of the formula of a variable, looked up in a DependencyGraph.
+
+    Names are found by binary search in the sorted arrays of the graph, so this works with memory-mapped graphs without
+    loading them.
+    """
+    variables_name = dependency_graph.variables_name
+    index = variables_name.searchsorted(name)
+    if index >= len(variables_name) or variables_name[index] != name:
+        return None, None
+    input_variables_indices = dependency_graph.input_variables_indices[
+        dependency_graph.input_variables_indptr[index]:dependency_graph.input_variables_indptr[index + 1]]
+    parameters_indices = dependency_graph.parameters_indices[
+        dependency_graph.parameters_indptr[index]:dependency_graph.parameters_indptr[index + 1]]
+    return (
+        set(variables_name[input_variables_indices]),
+        set(dependency_graph.parameters_name[parameters_indices]),
+        )
+
+
+def get_legislation_source_hash(tax_benefit_system):
+    """Return the SHA-1 of the XML files of the legislation of a tax-benefit system, with their place in the tree."""
+    source_hash = hashlib.sha1()
+    for xml_file_path, path_in_legislation_tree in tax_benefit_system.legislation_xml_info_list:
+        source_hash.update(u'{}\0'.format(u'.'.join(path_in_legislation_tree or [])).encode('utf-8'))
+        with open(xml_file_path, 'rb') as xml_file:
+            source_hash.update(xml_file.read())
+    return source_hash.hexdigest()
+
+
+def get_parsers_source_hash():
+    """Return the SHA-1 of the source files of OpenFisca-Parsers, whose changes may change the extracted data."""
+    return get_country_package_source_hash(__name__.split('.')[0])
+
+
+def iter_package_files_path(package_name):
+    """Iterate over the (absolute, relative to package directory) paths of the files of a package, except compiled
+    ones, in a stable order and without importing the package.
+    """
+    package_dir = os.path.dirname(pkgutil.get_loader(package_name).get_filename())
+    for dir, dirs_name, files_name in os.walk(package_dir):
+        dirs_name.sort()
+        for file_name in sorted(files_name):
+            if file_name.endswith(('.pyc', '.pyo')):
+                continue
+            file_path = os.path.join(dir, file_name)
+            yield file_path, os.path.relpath(file_path, package_dir)
+
+
+def load_dependency_graph(dir, mmap_mode = 'r'):
+    """Load a DependencyGraph saved by save_dependency_graph, memory-mapping its arrays by default."""
+    return DependencyGraph(**dict(
+        (field_name, np.load(os.path.join(dir, field_name + '.npy'), mmap_mode = mmap_mode))
+        for field_name in DependencyGraph._fields
+        ))
+
+
+def load_dependency_graph_snapshot(file_path):
+    """Load a dependency graph snapshot saved by save_dependency_graph_snapshot.
+
+    Return its header and a DependencyGraph whose arrays are views of a read-only memory map of the file.
+    """
+    with open(file_path, 'rb') as snapshot_file:
+        snapshot_buffer = mmap.mmap(snapshot_file.fileno(), 0, access = mmap.ACCESS_READ)
+    prefix_size = len(snapshot_magic) + 4
+    assert snapshot_buffer[:len(snapshot_magic)] == snapshot_magic, u'Not a snapshot file: {}'.format(file_path)
+    header_size, = struct.unpack('<I', snapshot_buffer[len(snapshot_magic):prefix_size])
+    header = json.loads(snapshot_buffer[prefix_size:prefix_size + header_size])
+    assert header['version'] == snapshot_version, u'Snapshot {} has obsolete version {}'.format(file_path,
+        header['version'])
+    dependency_graph = DependencyGraph(**dict(
+        (field_name, np.frombuffer(snapshot_buffer, count = array_header['length'],
+            dtype = np.dtype(str(array_header['dtype'])), offset = array_header['offset']))
+        for field_name, array_header in header['array_header_by_name'].iteritems()
+        ))
+    return header, dependency_graph
+
+
+def load_manifest(file_path):
+    """Load a manifest saved by save_manifest, or return None when it is missing or has an obsolete format."""
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != manifest_version:
+        log.info(u'Ignoring manifest {} with obsolete version {}'.format(file_path, manifest.get('version')))
+        return None
+    return manifest
+
+
+def load_warm_start(file_path, **header):
+    """Load the result saved by save_warm_start, or return None when the file is missing, has an obsolete format or
+    was saved with another header (for example another fingerprint of the country package or other options).
+    """
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as warm_start_file:
+        warm_start = json.load(warm_start_file)
+    if warm_start.get('version') != warm_start_version or warm_start.get('header') != header:
+        log.info(u'Ignoring stale warm start file {}'.format(file_path))
+        return None
+    return warm_start['result']
+
+
+def save_dependency_graph(dependency_graph, dir):
+    """Save each array of a DependencyGraph in a .npy file of given directory."""
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    for field_name, array in zip(DependencyGraph._fields, dependency_graph):
+        np.save(os.path.join(dir, field_name + '.npy'), array)
+
+
+def save_dependency_graph_snapshot(dependency_graph, file_path, country_package_name = None,
+        country_package_version = None, source_hash = None):
+    """Save a DependencyGraph in a single binary file, that load_dependency_graph_snapshot memory-maps.
+
+    The file starts with a magic string, the size of a JSON header (as a little-endian 32 bits integer) and the header,
+    followed by the little-endian arrays of the graph, each one aligned on 8 bytes. Names of variables & parameters are
+    stored once, in fixed-width sorted arrays, and the edges of the graph refer to them by index.
+    """
+    arrays = [
+        np.ascontiguousarray(array, dtype = array.dtype.newbyteorder('<'))
+        for array in dependency_graph
+        ]
+    header = dict(
+        country_package_name = country_package_name,
+        country_package_version = country_package_version,
+        source_hash = source_hash,
+        version = snapshot_version,
+        )
+    # Offsets of arrays depend on the size of the header, which depends on the offsets: compute them with a header
+    # whose size is an upper bound.
+    header['array_header_by_name'] = dict(
+        (field_name, dict(dtype = array.dtype.str, length = len(array), offset = sys.maxint))
+        for field_name, array in zip(DependencyGraph._fields, arrays)
+        )
+    offset = align_offset(len(snapshot_magic) + 4 + len(json.dumps(header, sort_keys = True)))
+    for field_name, array in zip(DependencyGraph._fields, arrays):
+        header['array_header_by_name'][field_name]['offset'] = offset
+        offset = align_offset(offset + array.nbytes)
+    header_json = json.dumps(header, sort_keys = True)
+    with open(file_path, 'wb') as snapshot_file:
+        snapshot_file.write(snapshot_magic)
+        snapshot_file.write(struct.pack('<I', len(header_json)))
+        snapshot_file.write(header_json)
+        for field_name, array in zip(DependencyGraph._fields, arrays):
+            snapshot_file.write('\0' * (header['array_header_by_name'][field_name]['offset'] - snapshot_file.tell()))
+            snapshot_file.write(array.tobytes())
+
+
+def save_manifest(manifest, file_path):
+    with open(file_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent = 2, sort_keys = True)
+
+
+def save_warm_start(result, file_path, **header):
+    """Save a JSON result with a header, so that load_warm_start returns it only when given the same header.
+
+    Scripts put the fingerprint of the country package & the source hash of OpenFisca-Parsers in the header, to answer
+    from the saved result without importing the country package as long as neither of them changes.
+    """
+    with open(file_path, 'w') as warm_start_file:
+        json.dump(dict(header = header, result = result, version = warm_start_version), warm_start_file,
+            sort_keys = True)
+
+
+def setup(tax_benefit_system, cache_dir = None, front_end = u'lib2to3', lean = False):
+    """Return a parser of formulas, whose front end (u'ast' or u'lib2to3') converts Python source to syntax trees.
+
+    With the u'bytecode' front end, return a bytecode_extractors.Extractor instead, which needs no source code.
+    """
+    if front_end == u'bytecode':
+        return bytecode_extractors.setup(tax_benefit_system)
+    if front_end == u'ast':
+        return AstParser(
+            lean = lean,
+            tax_benefit_system = tax_benefit_system,
+            )
+    assert front_end == u'lib2to3', u'Unknown front end: {}'.format(front_end)
     return Parser(
+        cache_dir = cache_dir,
         driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert,
             logger = log),
+        lean = lean,
         tax_benefit_system = tax_benefit_system,
         )
+
+
+def transpose_csr(indices, indptr, columns_count):
+    """Return the (indices, indptr) arrays of the transposed matrix of a sparse boolean matrix in CSR format."""
+    rows_index = np.repeat(np.arange(len(indptr) - 1, dtype = np.int32), np.diff(indptr))
+    transposed_indptr = np.zeros(columns_count + 1, dtype = np.int32)
+    np.cumsum(np.bincount(indices, minlength = columns_count), out = transposed_indptr[1:])
+    # A stable sort keeps the rows of each column sorted.
+    return rows_index[np.argsort(indices, kind = 'mergesort')], transposed_indptr
+
+
+def update_manifest(tax_benefit_system, front_end = u'lib2to3', manifest = None, parser = None):
+    """Extract input variables & parameters of all columns, reusing the entries of a previous manifest.
+
+    An entry is reused when neither the source file of its formula nor the source files of the module functions called
+    by its formula have changed. No entry is reused when the previous manifest was extracted with another front end,
+    another legislation or another version of OpenFisca-Parsers.
+
+    Return the updated manifest and the names of the columns that have been (re-)extracted.
+    """
+    header = dict(
+        front_end = front_end,
+        legislation_source_hash = get_legislation_source_hash(tax_benefit_system),
+        parsers_source_hash = get_parsers_source_hash(),
+        )
+    if manifest is not None and manifest.get('header') != header:
+        log.info(u'Ignoring entries of manifest extracted with another front end, legislation or parsers version')
+        manifest = None
+    entry_by_column_name = manifest['entry_by_column_name'] if manifest is not None else {}
+    source_hash_by_path = {}
+
+    def get_source_hash(source_file_path):
+        source_hash = source_hash_by_path.get(source_file_path)
+        if source_hash is None:
+            try:
+                with open(source_file_path, 'rb') as source_file:
+                    source_hash = hashlib.sha1(source_file.read()).hexdigest()
+            except IOError:
+                source_hash = u''
+            source_hash_by_path[source_file_path] = source_hash
+        return source_hash
+
+    extracted_columns_name = []
+    updated_entry_by_column_name = {}
+    for name, column in sorted(tax_benefit_system.column_by_name.iteritems()):
+        if column.is_input_variable():
+            continue
+        # Without source (for example when the country package is installed compiled only, which is supported by the
+        # bytecode front end), the compiled file of the module is used instead.
+        source_file_path = inspect.getsourcefile(column.formula_class) or inspect.getfile(column.formula_class)
+        entry = entry_by_column_name.get(name)
+        if entry is not None and entry['source_file'] == source_file_path \
+                and entry['source_hash'] == get_source_hash(source_file_path) \
+                and all(
+                    helper_source_hash == get_source_hash(helper_source_file_path)
+                    for helper_source_file_path, helper_source_hash in entry['helper_source_hash_by_path'].iteritems()
+                    ):
+            updated_entry_by_column_name[name] = entry
+            continue
+
+        if parser is None:
+            parser = setup(tax_benefit_system, front_end = front_end)
+        input_variables, parameters = parser.get_input_variables_and_parameters(column)
+        updated_entry_by_column_name[name] = dict(
+            helper_source_hash_by_path = dict(
+                (helper_source_file_path, get_source_hash(helper_source_file_path))
+                for helper_source_file_path in parser.helper_source_files_path
+                ),
+            input_variables = sorted(input_variables),
+            parameters = sorted(parameters),
+            source_file = source_file_path,
+            source_hash = get_source_hash(source_file_path),
+            )
+        extracted_columns_name.append(name)
+    return dict(
+        entry_by_column_name = updated_entry_by_column_name,
+        header = header,
+        version = manifest_version,
+        ), extracted_columns_name
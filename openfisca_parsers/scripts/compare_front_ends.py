@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Extract the input variables & parameters of all formulas with the lib2to3 front end and another one (ast by default),
+and compare them.
+
+Print the duration of each front end and the columns whose extracted variables differ. Exit with status 1 when a
+difference is found.
+"""
+
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+import time
+
+from openfisca_parsers import input_variables_extractors
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+reference_front_end = u'lib2to3'
+log = logging.getLogger(app_name)
+
+
+def extract_all(tax_benefit_system, front_end, lean = False):
+    """Return the input variables & parameters of all columns, by column name, and the duration of the extraction."""
+    start_time = time.time()
+    extractor = input_variables_extractors.setup(tax_benefit_system, front_end = front_end, lean = lean)
+    input_variables_and_parameters_by_name = {}
+    # Parser prints the nodes it fails to parse.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for name, column in tax_benefit_system.column_by_name.iteritems():
+            input_variables_and_parameters_by_name[name] = extractor.get_input_variables_and_parameters(column)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return input_variables_and_parameters_by_name, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-c', '--country-package', default = 'openfisca_france',
+        help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-f', '--front-end', choices = ('ast', 'bytecode'), default = 'ast',
+        help = u'front end to compare with the lib2to3 one (default: ast)')
+    parser.add_argument('-l', '--lean', action = 'store_true', default = False,
+        help = u"don't keep syntax trees after parsing, to use less memory")
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stderr)
+
+    country_package = importlib.import_module(args.country_package)
+    tax_benefit_system = country_package.CountryTaxBenefitSystem()
+    # Load the legislation before measuring, because it doesn't depend on the front end.
+    tax_benefit_system.get_legislation()
+
+    input_variables_and_parameters_by_name_by_front_end = {}
+    compared_front_end = args.front_end.decode('utf-8')
+    for front_end in (reference_front_end, compared_front_end):
+        input_variables_and_parameters_by_name, duration = extract_all(tax_benefit_system, front_end,
+            lean = args.lean)
+        input_variables_and_parameters_by_name_by_front_end[front_end] = input_variables_and_parameters_by_name
+        print u'Duration with {} front end: {:.1f} s'.format(front_end, duration)
+
+    reference_by_name = input_variables_and_parameters_by_name_by_front_end[reference_front_end]
+    compared_by_name = input_variables_and_parameters_by_name_by_front_end[compared_front_end]
+    differences_count = 0
+    for name in sorted(tax_benefit_system.column_by_name):
+        reference = reference_by_name[name]
+        compared = compared_by_name[name]
+        if compared == reference:
+            continue
+        differences_count += 1
+        print name
+        for label, reference_items, compared_items in zip((u'Input variables', u'Parameters'), reference, compared):
+            if compared_items == reference_items:
+                continue
+            reference_items = reference_items or set()
+            compared_items = compared_items or set()
+            print u' {} only found by {}: {}'.format(label, reference_front_end,
+                u', '.join(sorted(reference_items - compared_items)))
+            print u' {} only found by {}: {}'.format(label, compared_front_end,
+                u', '.join(sorted(compared_items - reference_items)))
+    print u'Columns with different input variables or parameters: {} / {}'.format(differences_count,
+        len(tax_benefit_system.column_by_name))
+
+    return 1 if differences_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,52 +28,183 @@
 
 
 import argparse
+import collections
 import importlib
 import logging
+import multiprocessing
 import os
 import sys
 
+import pkg_resources
+
 from openfisca_parsers import input_variables_extractors
 
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
+cache_dir = None
+extractor = None  # Parser of a worker process
+front_end = u'lib2to3'
+lean = False
 log = logging.getLogger(app_name)
+tax_benefit_system = None  # Tax-benefit system shared by worker processes (through fork)
+
+
+def extract_columns(columns_name):
+    """Extract input variables & parameters of some columns in a worker process."""
+    global extractor
+    if extractor is None:
+        extractor = input_variables_extractors.setup(tax_benefit_system, cache_dir = cache_dir,
+            front_end = front_end, lean = lean)
+    results = []
+    for column_name in columns_name:
+        column = tax_benefit_system.column_by_name[column_name]
+        input_variables, parameters = extractor.get_input_variables_and_parameters(column)
+        results.append((column_name, input_variables, parameters))
+    return results
 
 
 def main():
+    global cache_dir, front_end, lean, tax_benefit_system
     parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'directory where parsed formulas are cached between runs (default: no cache)')
     parser.add_argument('-c', '--country-package', default = 'openfisca_france',
         help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-f', '--front-end', choices = ('ast', 'bytecode', 'lib2to3'), default = 'lib2to3',
+        help = u'module used to parse Python source code, or "bytecode" to disassemble formulas (default: lib2to3)')
+    parser.add_argument('-j', '--jobs', default = 1, type = int,
+        help = u'number of worker processes used to extract all variables (default: 1, 0 for one per CPU)')
+    parser.add_argument('-l', '--lean', action = 'store_true', default = False,
+        help = u"don't keep lib2to3 trees after parsing, to use less memory")
+    parser.add_argument('-m', '--manifest', default = None,
+        help = u'JSON file where extracted variables are stored, to re-extract only the formulas whose sources changed')
     parser.add_argument('-n', '--name', default = None,
         help = u'name of the formula to extract variables from (default: all)')
+    parser.add_argument('-s', '--snapshot', default = None,
+        help = u'binary file where the dependency graph of all variables is saved, for load_dependency_graph_snapshot')
     parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    parser.add_argument('-w', '--warm-start', default = None,
+        help = u'JSON file where the variables of all formulas are stored, to answer without importing the country '
+        u'package while its files are unchanged')
     args = parser.parse_args()
+    if args.manifest is not None and (args.name is not None or args.jobs != 1):
+        parser.error(u'--manifest can only be used to extract all variables in a single process')
+    if args.snapshot is not None and (args.manifest is not None or args.name is not None or args.jobs != 1):
+        parser.error(u'--snapshot can only be used to extract all variables in a single process, without manifest')
+    if args.warm_start is not None and (args.manifest is not None or args.snapshot is not None or args.jobs != 1):
+        parser.error(u'--warm-start can only be used in a single process, without manifest nor snapshot')
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
 
+    if args.warm_start is not None:
+        warm_start_header = dict(
+            country_package_name = args.country_package,
+            fingerprint = input_variables_extractors.get_country_package_fingerprint(args.country_package),
+            front_end = args.front_end,
+            parsers_source_hash = input_variables_extractors.get_parsers_source_hash(),
+            )
+        results = input_variables_extractors.load_warm_start(args.warm_start, **warm_start_header)
+        if results is None:
+            country_package = importlib.import_module(args.country_package)
+            tax_benefit_system = country_package.CountryTaxBenefitSystem()
+            extractor = input_variables_extractors.setup(tax_benefit_system, cache_dir = args.cache_dir,
+                front_end = args.front_end, lean = args.lean)
+            results = []
+            for column in tax_benefit_system.column_by_name.itervalues():
+                input_variables, parameters = extractor.get_input_variables_and_parameters(column)
+                results.append((
+                    column.name,
+                    sorted(input_variables) if input_variables is not None else None,
+                    sorted(parameters) if parameters is not None else None,
+                    ))
+            input_variables_extractors.save_warm_start(results, args.warm_start, **warm_start_header)
+            log.info(u'Saved variables of {} formulas in {}'.format(len(results), args.warm_start))
+        else:
+            log.info(u'Country package is unchanged, answering from {}'.format(args.warm_start))
+        # Print columns sorted by name, like when extracting without warm start.
+        for column_name, input_variables, parameters in sorted(results):
+            if args.name is None or column_name == args.name:
+                print_input_variables_and_parameters(column_name, input_variables, parameters)
+        return 0
+
     country_package = importlib.import_module(args.country_package)
     tax_benefit_system = country_package.CountryTaxBenefitSystem()
-
-    extractor = input_variables_extractors.setup(tax_benefit_system)
-
-    if args.name is None:
+    cache_dir = args.cache_dir
+    front_end = args.front_end
+    lean = args.lean
+
+    if args.snapshot is not None:
+        dependency_graph = input_variables_extractors.extract_dependency_graph(tax_benefit_system,
+            parser = input_variables_extractors.setup(tax_benefit_system, cache_dir = cache_dir, front_end = front_end,
+                lean = lean))
+        input_variables_extractors.save_dependency_graph_snapshot(dependency_graph, args.snapshot,
+            country_package_name = args.country_package,
+            country_package_version = pkg_resources.get_distribution(args.country_package).version,
+            source_hash = input_variables_extractors.get_country_package_source_hash(args.country_package),
+            )
+        log.info(u'Saved dependency graph of {} variables in {}'.format(len(dependency_graph.variables_name),
+            args.snapshot))
+    elif args.manifest is not None:
+        manifest, extracted_columns_name = input_variables_extractors.update_manifest(tax_benefit_system,
+            front_end = front_end,
+            manifest = input_variables_extractors.load_manifest(args.manifest),
+            parser = input_variables_extractors.setup(tax_benefit_system, cache_dir = cache_dir,
+                front_end = front_end, lean = lean))
+        input_variables_extractors.save_manifest(manifest, args.manifest)
+        log.info(u'Extracted {} variables, reused {} others from manifest'.format(len(extracted_columns_name),
+            len(manifest['entry_by_column_name']) - len(extracted_columns_name)))
+        entry_by_column_name = manifest['entry_by_column_name']
+        for column_name in sorted(tax_benefit_system.column_by_name):
+            entry = entry_by_column_name.get(column_name)
+            if entry is None:
+                print_input_variables_and_parameters(column_name, None, None)
+            else:
+                print_input_variables_and_parameters(column_name, entry['input_variables'], entry['parameters'])
+    elif args.name is None and args.jobs != 1:
+        # Shard columns by module, so that each module is parsed by a single worker.
+        columns_name_by_module_name = collections.defaultdict(list)
         for column in tax_benefit_system.column_by_name.itervalues():
-            print column.name
-            input_variables, parameters = extractor.get_input_variables_and_parameters(column)
-            if input_variables is not None:
-                print u' Input variables:', u', '.join(sorted(input_variables))
-            if parameters:
-                print u' Parameters:', u', '.join(sorted(parameters))
+            columns_name_by_module_name[column.formula_class.__module__].append(column.name)
+        shards = sorted(columns_name_by_module_name.itervalues(), key = len, reverse = True)
+        # OpenFisca-Core caches the legislation in the tax-benefit system once computed, so computing it before
+        # forking the workers shares it with all of them, instead of letting each worker load it again.
+        tax_benefit_system.get_legislation()
+        pool = multiprocessing.Pool(processes = args.jobs or None)
+        try:
+            results = [
+                result
+                for shard_results in pool.imap_unordered(extract_columns, shards)
+                for result in shard_results
+                ]
+        finally:
+            pool.close()
+            pool.join()
+        for column_name, input_variables, parameters in sorted(results):
+            print_input_variables_and_parameters(column_name, input_variables, parameters)
     else:
-        column = tax_benefit_system.column_by_name[args.name]
-        print column.name
-        input_variables, parameters = extractor.get_input_variables_and_parameters(column)
-        if input_variables is not None:
-            print u' Input variables:', u', '.join(sorted(input_variables))
-        if parameters:
-            print u' Parameters:', u', '.join(sorted(parameters))
+        extractor = input_variables_extractors.setup(tax_benefit_system, cache_dir = cache_dir,
+            front_end = front_end, lean = lean)
+        if args.name is None:
+            columns = [
+                column
+                for column_name, column in sorted(tax_benefit_system.column_by_name.iteritems())
+                ]
+        else:
+            columns = [tax_benefit_system.column_by_name[args.name]]
+        # Print columns sorted by name, like when extracting with several jobs.
+        for column in columns:
+            input_variables, parameters = extractor.get_input_variables_and_parameters(column)
+            print_input_variables_and_parameters(column.name, input_variables, parameters)
 
     return 0
 
 
+def print_input_variables_and_parameters(column_name, input_variables, parameters):
+    print column_name
+    if input_variables is not None:
+        print u' Input variables:', u', '.join(sorted(input_variables))
+    if parameters:
+        print u' Parameters:', u', '.join(sorted(parameters))
+
+
 if __name__ == "__main__":
     sys.exit(main())
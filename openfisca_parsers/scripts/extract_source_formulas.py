@@ -33,7 +33,7 @@ import logging
 import os
 import sys
 
-from openfisca_parsers import source_formulas_extractors
+from openfisca_parsers import input_variables_extractors, source_formulas_extractors
 
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
@@ -42,18 +42,67 @@ log = logging.getLogger(app_name)
 
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'directory where parsed formulas are cached between runs (default: no cache)')
     parser.add_argument('-c', '--country-package', default = 'openfisca_france',
         help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-d', '--downstream', action = 'store_true', default = False,
+        help = u'extract the formulas that depend on the formula, with their depth, instead of its source formulas')
     parser.add_argument('-n', '--name', required = True,
         help = u'name of the formula to extract source formulas from (default: all)')
+    parser.add_argument('-s', '--scan', action = 'store_true', default = False,
+        help = u'scan the tokens of formulas and parse only the formulas where scanning is not enough')
     parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    parser.add_argument('-w', '--warm-start', default = None,
+        help = u'JSON file where the source formulas of all formulas are stored, to answer without importing the '
+        u'country package while its files are unchanged')
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
 
-    country_package = importlib.import_module(args.country_package)
-    tax_benefit_system = country_package.CountryTaxBenefitSystem()
-
-    source_formulas = source_formulas_extractors.extract_source_formulas(tax_benefit_system, args.name)
+    if args.warm_start is not None:
+        warm_start_header = dict(
+            country_package_name = args.country_package,
+            fingerprint = input_variables_extractors.get_country_package_fingerprint(args.country_package),
+            parsers_source_hash = input_variables_extractors.get_parsers_source_hash(),
+            scan = args.scan,
+            )
+        source_formulas_by_name = input_variables_extractors.load_warm_start(args.warm_start, **warm_start_header)
+        if source_formulas_by_name is None:
+            country_package = importlib.import_module(args.country_package)
+            tax_benefit_system = country_package.CountryTaxBenefitSystem()
+            source_formulas_by_name, path_by_name = source_formulas_extractors.extract_all_source_formulas(
+                tax_benefit_system, parser = source_formulas_extractors.setup(tax_benefit_system,
+                    cache_dir = args.cache_dir), scan = args.scan)
+            source_formulas_by_name = dict(
+                (name, sorted(source_formulas))
+                for name, source_formulas in source_formulas_by_name.iteritems()
+                )
+            input_variables_extractors.save_warm_start(source_formulas_by_name, args.warm_start, **warm_start_header)
+            log.info(u'Saved source formulas of {} formulas in {}'.format(len(source_formulas_by_name),
+                args.warm_start))
+        else:
+            log.info(u'Country package is unchanged, answering from {}'.format(args.warm_start))
+        index = source_formulas_extractors.SourceFormulasIndex(source_formulas_by_name = source_formulas_by_name)
+    else:
+        country_package = importlib.import_module(args.country_package)
+        tax_benefit_system = country_package.CountryTaxBenefitSystem()
+        index = None
+
+    if args.downstream:
+        if index is None:
+            index = source_formulas_extractors.extract_source_formulas_index(tax_benefit_system,
+                parser = source_formulas_extractors.setup(tax_benefit_system, cache_dir = args.cache_dir),
+                scan = args.scan)
+        print u' Downstream formulas:', u'\n'.join(
+            '  - {} ({})'.format(name, depth)
+            for name, depth in index.get_downstream_formulas([args.name]))
+        return 0
+
+    if index is None:
+        source_formulas = source_formulas_extractors.extract_source_formulas(tax_benefit_system, args.name,
+            cache_dir = args.cache_dir, scan = args.scan)
+    else:
+        source_formulas = source_formulas_extractors.extract_source_formulas(None, args.name, index = index)
     if source_formulas:
         print u' Source formulas:', u'\n'.join(
             '  - {}'.format(name)
@@ -30,105 +30,194 @@
 import argparse
 import codecs
 import importlib
+import itertools
+import json
 import logging
+import multiprocessing
 import os
-import pyclbr
 import re
 import sys
 
+from openfisca_parsers import input_variables_extractors
+
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
-build_column_re = re.compile(ur'(?ms)build_column\(\s*(?P<quoted_variable_name>[^,]+),')
 log = logging.getLogger(app_name)
-reference_input_variable_re = re.compile(
-    ur'(?ms)reference_input_variable\(.+?name\s*=\s*(?P<quoted_variable_name>[^,)\s]+)')
+scan_cache_version = 1  # Version of scan cache format, to increment when variables_source_re or scanned data change
+# Declarations of input variables and top-level classes, matched in a single pass over each source
+variables_source_re = re.compile(
+    ur'(?ms)build_column\(\s*(?P<build_column_quoted_variable_name>[^,]+),'
+    ur'|reference_input_variable\(.+?name\s*=\s*(?P<reference_input_variable_quoted_variable_name>[^,)\s]+)'
+    ur'|^class\s+(?P<class_name>\w+)'
+    )
 
 
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-file', default = None,
+        help = u'JSON file where the scans of source files are stored, to scan again only the files that changed')
     parser.add_argument('-c', '--country-package', default = 'openfisca_france',
         help = u'name of the OpenFisca package to use for country-specific variables & formulas')
     parser.add_argument('-i', '--input', action = 'store_true', default = False, help = "extract input variables")
+    parser.add_argument('-j', '--jobs', default = 1, type = int,
+        help = u'number of worker processes used to scan source files (default: 1, 0 for one per CPU)')
     parser.add_argument('-o', '--computed', action = 'store_true', default = False, help = "extract computed variables")
     parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    parser.add_argument('-w', '--warm-start', default = None,
+        help = u'JSON file where the tree is stored, to print it without importing the country package while its '
+        u'files are unchanged')
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
 
+    if args.warm_start is not None:
+        warm_start_header = dict(
+            computed_variables = args.computed,
+            country_package_name = args.country_package,
+            fingerprint = input_variables_extractors.get_country_package_fingerprint(args.country_package),
+            input_variables = args.input,
+            parsers_source_hash = input_variables_extractors.get_parsers_source_hash(),
+            )
+        variables_tree = input_variables_extractors.load_warm_start(args.warm_start, **warm_start_header)
+        if variables_tree is not None:
+            log.info(u'Country package is unchanged, answering from {}'.format(args.warm_start))
+            print_variables_node(variables_tree)
+            return 0
+
     country_package = importlib.import_module(args.country_package)
 
     variables_tree = create_variables_tree(country_package, input_variables = args.input,
-        computed_variables = args.computed)
+        computed_variables = args.computed, scan_cache_file_path = args.cache_file, jobs = args.jobs)
+    if args.warm_start is not None:
+        input_variables_extractors.save_warm_start(variables_tree, args.warm_start, **warm_start_header)
 
     print_variables_node(variables_tree)
 
     return 0
 
 
-def create_variables_tree(country_package, input_variables = False, computed_variables = False):
-
-    root_dir = os.path.dirname(country_package.__file__)
+def add_module_variables(variables_tree, module_path, module_variables_name):
+    variables_node = variables_tree
+    for module_name in module_path:
+        variables_node = variables_node.setdefault('children', {}).setdefault(module_name, {})
+    if 'variables' in variables_node:
+        module_variables_name += variables_node['variables']
+    module_variables_name.sort()
+    variables_node['variables'] = module_variables_name
+
+
+def create_variables_tree(country_package, input_variables = False, computed_variables = False,
+        scan_cache_file_path = None, jobs = 1):
+    """Return the tree of modules of the country package, with the input and/or computed variables of each module.
+
+    When a scan cache file is given, only the source files whose modification time or size differ from the cached ones
+    are scanned again, and the cache file is updated.
+    """
+    root_dir = os.path.dirname(os.path.abspath(country_package.__file__))
+    file_stat_by_python_file_path = {}
+    for dir, directories_name, filenames in os.walk(root_dir):
+        for filename in filenames:
+            if filename.endswith('.py'):
+                python_file_path = os.path.join(dir, filename)
+                python_file_stat = os.stat(python_file_path)
+                file_stat_by_python_file_path[python_file_path] = [python_file_stat.st_mtime, python_file_stat.st_size]
+
+    scan_cache = load_scan_cache(scan_cache_file_path) if scan_cache_file_path is not None else None
+    entry_by_python_file_path = scan_cache['entry_by_python_file_path'] if scan_cache is not None else {}
+    scan_by_python_file_path = {}
+    stale_python_files_path = []
+    for python_file_path, file_stat in file_stat_by_python_file_path.iteritems():
+        entry = entry_by_python_file_path.get(python_file_path)
+        if entry is not None and entry['file_stat'] == file_stat:
+            scan_by_python_file_path[python_file_path] = (entry['input_variables'], entry['classes'])
+        else:
+            stale_python_files_path.append(python_file_path)
+    if jobs == 1 or not stale_python_files_path:
+        scan_by_python_file_path.update(itertools.izip(stale_python_files_path, itertools.imap(scan_python_file,
+            stale_python_files_path)))
+    else:
+        pool = multiprocessing.Pool(processes = jobs or None)
+        try:
+            scan_by_python_file_path.update(itertools.izip(stale_python_files_path, pool.imap(scan_python_file,
+                stale_python_files_path, chunksize = 8)))
+        finally:
+            pool.close()
+            pool.join()
+    log.info(u'Scanned {} source files, reused {} others from cache'.format(len(stale_python_files_path),
+        len(scan_by_python_file_path) - len(stale_python_files_path)))
+    if scan_cache_file_path is not None and (stale_python_files_path
+            or len(entry_by_python_file_path) != len(scan_by_python_file_path)):
+        save_scan_cache(
+            dict(
+                entry_by_python_file_path = dict(
+                    (python_file_path, dict(
+                        classes = classes_name,
+                        file_stat = file_stat_by_python_file_path[python_file_path],
+                        input_variables = input_variables_name,
+                        ))
+                    for python_file_path, (input_variables_name, classes_name) in scan_by_python_file_path.iteritems()
+                    ),
+                version = scan_cache_version,
+                ),
+            scan_cache_file_path,
+            )
     variables_tree = {}
 
     if input_variables:
-        for (dir, directories_name, filenames) in os.walk(root_dir):
-            for filename in filenames:
-                if filename.endswith('.py'):
-                    python_file_path = os.path.join(dir, filename)
-                    with codecs.open(python_file_path, encoding = 'utf-8') as python_file:
-                        python_source = python_file.read()
-                    module_variables_name = []
-                    for match in build_column_re.finditer(python_source):
-                        quoted_variable_name = match.group('quoted_variable_name')
-                        variable_name = quoted_variable_name[1:-1]
-                        module_variables_name.append(variable_name)
-                    for match in reference_input_variable_re.finditer(python_source):
-                        quoted_variable_name = match.group('quoted_variable_name')
-                        variable_name = quoted_variable_name[1:-1]
-                        module_variables_name.append(variable_name)
-                    if module_variables_name:
-                        module_path = [
-                            module_name
-                            for module_name in os.path.splitext(python_file_path)[0][len(root_dir):].split(u'/')
-                            if module_name
-                            ]
-                        variables_node = variables_tree
-                        for module_name in module_path:
-                            variables_node = variables_node.setdefault('children', {}).setdefault(module_name, {})
-                        if 'variables' in variables_node:
-                            module_variables_name += variables_node['variables']
-                        module_variables_name.sort()
-                        variables_node['variables'] = module_variables_name
+        for python_file_path, (module_input_variables_name, module_classes_name) in sorted(
+                scan_by_python_file_path.iteritems()):
+            if module_input_variables_name:
+                module_path = [
+                    module_name
+                    for module_name in os.path.splitext(python_file_path)[0][len(root_dir):].split(u'/')
+                    if module_name
+                    ]
+                add_module_variables(variables_tree, module_path, list(module_input_variables_name))
 
     if computed_variables:
         tax_benefit_system = country_package.CountryTaxBenefitSystem()
 
-        for module_name in sys.modules.keys():
-            if module_name.startswith(country_package.__name__) and not module_name.endswith('.__future__'):
-                try:
-                    class_data_by_name = pyclbr.readmodule(module_name)
-                except ImportError:
+        for module_name, module in sys.modules.items():
+            if module is None or not module_name.startswith(country_package.__name__) \
+                    or module_name.endswith('.__future__'):
+                continue
+            python_file_path = getattr(module, '__file__', None)
+            if python_file_path is None:
+                continue
+            python_file_path = os.path.splitext(os.path.abspath(python_file_path))[0] + '.py'
+            scan = scan_by_python_file_path.get(python_file_path)
+            if scan is None:
+                if not os.path.exists(python_file_path):
                     continue
-                module_variables_name = []
-                for class_name, class_data in class_data_by_name.iteritems():
-                    if class_name in tax_benefit_system.column_by_name:
-                        module_variables_name.append(class_name)
-                if module_variables_name:
-                    module_path = [
-                        name
-                        for name in module_name[len(country_package.__name__):].split(u'.')
-                        if name
-                        ]
-                    variables_node = variables_tree
-                    for module_name in module_path:
-                        variables_node = variables_node.setdefault('children', {}).setdefault(module_name, {})
-                    if 'variables' in variables_node:
-                        module_variables_name += variables_node['variables']
-                    module_variables_name.sort()
-                    variables_node['variables'] = module_variables_name
+                scan = scan_python_file(python_file_path)
+            module_input_variables_name, module_classes_name = scan
+            module_variables_name = [
+                class_name
+                for class_name in module_classes_name
+                if class_name in tax_benefit_system.column_by_name
+                ]
+            if module_variables_name:
+                module_path = [
+                    name
+                    for name in module_name[len(country_package.__name__):].split(u'.')
+                    if name
+                    ]
+                add_module_variables(variables_tree, module_path, module_variables_name)
 
     return variables_tree
 
 
+def load_scan_cache(file_path):
+    """Load a scan cache saved by save_scan_cache, or return None when it is missing or has an obsolete format."""
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as scan_cache_file:
+        scan_cache = json.load(scan_cache_file)
+    if scan_cache.get('version') != scan_cache_version:
+        log.info(u'Ignoring scan cache {} with obsolete version {}'.format(file_path, scan_cache.get('version')))
+        return None
+    return scan_cache
+
+
 def print_variables_node(variables_node, indent = 0):
     for variable_name in (variables_node.get('variables') or []):
         print '{}{}'.format(u'    ' * indent, variable_name)
@@ -137,5 +226,29 @@ def print_variables_node(variables_node, indent = 0):
         print_variables_node(module_node, indent = indent + 1)
 
 
+def save_scan_cache(scan_cache, file_path):
+    with open(file_path, 'w') as scan_cache_file:
+        json.dump(scan_cache, scan_cache_file, indent = 2, sort_keys = True)
+
+
+def scan_python_file(python_file_path):
+    """Read a Python source file once and return the names of the input variables it declares (with build_column or
+    reference_input_variable) and the names of its top-level classes, found in a single pass of a regular expression.
+    """
+    with codecs.open(python_file_path, encoding = 'utf-8') as python_file:
+        python_source = python_file.read()
+    input_variables_name = []
+    classes_name = []
+    for match in variables_source_re.finditer(python_source):
+        class_name = match.group('class_name')
+        if class_name is not None:
+            classes_name.append(class_name)
+        else:
+            quoted_variable_name = match.group('build_column_quoted_variable_name') or match.group(
+                'reference_input_variable_quoted_variable_name')
+            input_variables_name.append(quoted_variable_name[1:-1])
+    return input_variables_name, classes_name
+
+
 if __name__ == "__main__":
     sys.exit(main())
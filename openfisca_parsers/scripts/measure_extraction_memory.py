@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Measure the peak memory (RSS) used to extract the input variables & parameters of all formulas.
+
+Run it with and without --slots to compare wrappers storing their attributes in an instance dictionary (as usual) with
+wrappers storing them in slots.
+"""
+
+
+import argparse
+import gc
+import importlib
+import logging
+import os
+import resource
+import sys
+import time
+
+from openfisca_parsers import formulas_parsers_2to3, input_variables_extractors
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+log = logging.getLogger(app_name)
+
+
+def add_wrapper_slots():
+    """Replace the wrapper classes of OpenFisca-Parsers with copies storing their attributes in slots.
+
+    Every scalar class attribute (None, boolean, number or string) of a wrapper class becomes a slot, whose default
+    value is the class attribute. The copies replace the original classes in the modules of OpenFisca-Parsers & in
+    their classes (parsers...), so this must be called before creating any parser.
+    """
+    modules = [
+        module
+        for module_name, module in sorted(sys.modules.iteritems())
+        if module is not None and module_name.split('.')[0] == 'openfisca_parsers'
+        ]
+    old_classes = set(
+        value
+        for module in modules
+        for value in vars(module).itervalues()
+        if isinstance(value, type) and issubclass(value, formulas_parsers_2to3.AbstractWrapper)
+        )
+
+    def get_slot_default(self, name):
+        # Called only when a slot has not been set: Return its default value.
+        try:
+            return self.slot_default_by_name[name]
+        except KeyError:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+
+    new_class_by_old_class = {}
+    # A class has a longer MRO than its base classes, so they are copied before it.
+    for old_class in sorted(old_classes, key = lambda klass: len(klass.__mro__)):
+        bases = tuple(new_class_by_old_class.get(base, base) for base in old_class.__bases__)
+        slot_default_by_name = {}
+        for base in reversed(bases):
+            slot_default_by_name.update(getattr(base, 'slot_default_by_name', {}))
+        inherited_slots_name = set(slot_default_by_name)
+        namespace = dict(vars(old_class))
+        namespace.pop('__dict__', None)
+        namespace.pop('__weakref__', None)
+        slots_name = []
+        for attribute_name, value in sorted(namespace.items()):
+            if attribute_name.startswith('__') or not isinstance(value, (type(None), bool, int, float, basestring)):
+                continue
+            slot_default_by_name[attribute_name] = namespace.pop(attribute_name)
+            if attribute_name not in inherited_slots_name:
+                slots_name.append(attribute_name)
+        if old_class is formulas_parsers_2to3.AbstractWrapper:
+            namespace['__getattr__'] = get_slot_default
+        namespace['__slots__'] = tuple(slots_name)
+        namespace['slot_default_by_name'] = slot_default_by_name
+        new_class_by_old_class[old_class] = type(old_class)(old_class.__name__, bases, namespace)
+
+    # Methods refer to wrapper classes through module globals (super(Call, self)...) & parser class attributes.
+    classes = set(new_class_by_old_class.itervalues())
+    for module in modules:
+        for name, value in vars(module).items():
+            if isinstance(value, type):
+                if value in new_class_by_old_class:
+                    setattr(module, name, new_class_by_old_class[value])
+                elif value.__module__ == module.__name__:
+                    classes.add(value)
+    for klass in classes:
+        for name, value in vars(klass).items():
+            if isinstance(value, type) and value in new_class_by_old_class:
+                setattr(klass, name, new_class_by_old_class[value])
+    return len(new_class_by_old_class)
+
+
+def get_peak_rss():
+    """Return the peak resident set size of current process, in kilobytes."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # On Mac OS X, ru_maxrss is in bytes.
+        peak_rss //= 1024
+    return peak_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'directory where parsed formulas are cached between runs (default: no cache)')
+    parser.add_argument('-c', '--country-package', default = 'openfisca_france',
+        help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-f', '--front-end', choices = ('ast', 'bytecode', 'lib2to3'), default = 'lib2to3',
+        help = u'module used to parse Python source code, or "bytecode" to disassemble formulas (default: lib2to3)')
+    parser.add_argument('-l', '--lean', action = 'store_true', default = False,
+        help = u"don't keep lib2to3 trees after parsing, to use less memory")
+    parser.add_argument('-s', '--slots', action = 'store_true', default = False,
+        help = u'store the attributes of wrappers in slots instead of instance dictionaries')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stderr)
+
+    if args.slots:
+        log.info(u'Added slots to {} wrapper classes'.format(add_wrapper_slots()))
+    country_package = importlib.import_module(args.country_package)
+    tax_benefit_system = country_package.CountryTaxBenefitSystem()
+    # Load the legislation before measuring, because it doesn't depend on the parser.
+    tax_benefit_system.get_legislation()
+    initial_peak_rss = get_peak_rss()
+
+    start_time = time.time()
+    extractor = input_variables_extractors.setup(tax_benefit_system, cache_dir = args.cache_dir,
+        front_end = args.front_end, lean = args.lean)
+    # Parser prints the nodes it fails to parse.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for column in tax_benefit_system.column_by_name.itervalues():
+            extractor.get_input_variables_and_parameters(column)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    duration = time.time() - start_time
+    final_peak_rss = get_peak_rss()
+
+    wrappers_count = sum(
+        1
+        for item in gc.get_objects()
+        if isinstance(item, formulas_parsers_2to3.AbstractWrapper)
+        )
+    print u'Wrappers: {}'.format(u'slots' if args.slots else u'instance dictionaries')
+    print u'Columns: {}'.format(len(tax_benefit_system.column_by_name))
+    print u'Duration: {:.1f} s'.format(duration)
+    print u'Live wrappers after extraction: {}'.format(wrappers_count)
+    print u'Peak RSS before extraction: {} kB'.format(initial_peak_rss)
+    print u'Peak RSS after extraction: {} kB (+{} kB)'.format(final_peak_rss, final_peak_rss - initial_peak_rss)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Serve the input variables, parameters & source formulas of formulas over localhost HTTP, from warm parsers.
+
+The country package, the tax-benefit system & the parsers are loaded once. Results are kept, per column, in a bounded
+LRU cache, whose entries are discarded when the source files they have been extracted from change. Changed files are
+parsed again, but their Python modules are not reloaded: formulas & top-level functions are found by name in the
+current sources, while nested functions are still located with the line numbers of the loaded code, and the values of
+module-level names are those of the loaded modules. Restart the server when variables or functions are added, removed
+or renamed, when module-level values change or when an edit moves the lines of nested functions.
+
+Queries (names are given as "name" parameters, that can be repeated):
+- GET /input-variables?name=...: input variables & parameters of each formula
+- GET /source-formulas?name=...: formulas that each formula depends on, directly or not (including itself)
+"""
+
+
+import argparse
+import BaseHTTPServer
+import collections
+import importlib
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+import urlparse
+
+from openfisca_parsers import input_variables_extractors, source_formulas_extractors
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+log = logging.getLogger(app_name)
+
+
+class ExtractionService(object):
+    """Warm parsers and LRU cache of their results, by (query kind, column name)"""
+    entry_by_key = None  # (result, mtime by source file path) couples, least recently used first
+    input_variables_parser = None
+    max_entries = None
+    mtime_by_parsed_source_file_path = None  # Modification times of source files, when the parsers have read them
+    source_formulas_parser = None
+    stats = None  # Counter of cache hits, misses & invalidations
+    tax_benefit_system = None
+
+    def __init__(self, tax_benefit_system = None, cache_dir = None, front_end = u'lib2to3', lean = False,
+            max_entries = None):
+        self.entry_by_key = collections.OrderedDict()
+        self.input_variables_parser = input_variables_extractors.setup(tax_benefit_system, cache_dir = cache_dir,
+            front_end = front_end, lean = lean)
+        self.max_entries = max_entries
+        self.mtime_by_parsed_source_file_path = {}
+        self.source_formulas_parser = source_formulas_extractors.setup(tax_benefit_system, cache_dir = cache_dir,
+            front_end = front_end, lean = lean)
+        self.stats = collections.Counter()
+        self.tax_benefit_system = tax_benefit_system
+
+    def extract(self, kind, column):
+        """Return the result of an extraction and the source files it depends on."""
+        if kind == u'input-variables':
+            parser = self.input_variables_parser
+            input_variables, parameters = parser.get_input_variables_and_parameters(column)
+            result = None if input_variables is None else dict(
+                input_variables = sorted(input_variables),
+                parameters = sorted(parameters),
+                )
+        else:
+            parser = self.source_formulas_parser
+            source_formulas = parser.get_source_formulas(column)
+            result = None if source_formulas is None else sorted(source_formulas)
+        source_files_path = set([inspect.getsourcefile(column.formula_class)])
+        if result is not None:
+            source_files_path.update(parser.helper_source_files_path)
+        return result, source_files_path
+
+    def get(self, kind, column):
+        """Return the result of an extraction, from the cache when its source files are unchanged."""
+        key = (kind, column.name)
+        entry = self.entry_by_key.pop(key, None)
+        if entry is not None:
+            result, mtime_by_source_file_path = entry
+            if all(
+                    get_mtime(source_file_path) == mtime
+                    for source_file_path, mtime in mtime_by_source_file_path.iteritems()
+                    ):
+                # Move entry to the end, as the most recently used.
+                self.entry_by_key[key] = entry
+                self.stats['hits'] += 1
+                return result
+            self.stats['invalidations'] += 1
+        else:
+            self.stats['misses'] += 1
+
+        # Make parsers read again the source files that have changed since they have read them, extracting again
+        # when the result depends on a file that has changed.
+        self.refresh_source_file(inspect.getsourcefile(column.formula_class))
+        if entry is not None:
+            for source_file_path in entry[1]:
+                self.refresh_source_file(source_file_path)
+        while True:
+            result, source_files_path = self.extract(kind, column)
+            changed_source_files_path = [
+                source_file_path
+                for source_file_path in source_files_path
+                if self.refresh_source_file(source_file_path)
+                ]
+            if not changed_source_files_path:
+                break
+        self.entry_by_key[key] = (result, dict(
+            (source_file_path, self.mtime_by_parsed_source_file_path[source_file_path])
+            for source_file_path in source_files_path
+            ))
+        while len(self.entry_by_key) > self.max_entries:
+            self.entry_by_key.popitem(last = False)
+        return result
+
+    def get_input_variables(self, names):
+        return dict(
+            (name, self.get(u'input-variables', self.tax_benefit_system.column_by_name[name]))
+            for name in names
+            )
+
+    def get_source_formulas(self, names):
+        """Return the closure of the source formulas of each name, using the cached source formulas of each column."""
+        column_by_name = self.tax_benefit_system.column_by_name
+        source_formulas_by_name = {}
+        for name in names:
+            source_formulas = set()
+            remaining_names = set([name])
+            while remaining_names:
+                remaining_name = remaining_names.pop()
+                column = column_by_name.get(remaining_name)
+                new_names = self.get(u'source-formulas', column) if column is not None else None
+                if new_names is not None:
+                    source_formulas.add(remaining_name)
+                    remaining_names.update(
+                        new_name
+                        for new_name in new_names
+                        if new_name not in source_formulas
+                        )
+            source_formulas_by_name[name] = sorted(source_formulas)
+        return source_formulas_by_name
+
+    def refresh_source_file(self, source_file_path):
+        """Make parsers forget a source file when it has changed since they have read it, and return True in this
+        case.
+        """
+        mtime = get_mtime(source_file_path)
+        parsed_mtime = self.mtime_by_parsed_source_file_path.get(source_file_path)
+        self.mtime_by_parsed_source_file_path[source_file_path] = mtime
+        if parsed_mtime is None or parsed_mtime == mtime:
+            return False
+        log.info(u'Source file {} has changed'.format(source_file_path))
+        self.input_variables_parser.forget_source_file(source_file_path)
+        self.source_formulas_parser.forget_source_file(source_file_path)
+        return True
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    service = None  # ExtractionService shared by all requests
+
+    def do_GET(self):
+        start_time = time.time()
+        url = urlparse.urlparse(self.path)
+        names = [
+            name.decode('utf-8')
+            for name in urlparse.parse_qs(url.query).get('name', [])
+            ]
+        query_method_name = {
+            '/input-variables': 'get_input_variables',
+            '/source-formulas': 'get_source_formulas',
+            }.get(url.path)
+        if query_method_name is None:
+            return self.respond_json(404, dict(error = u'Unknown path: {}'.format(url.path)))
+        if not names:
+            return self.respond_json(400, dict(error = u'Missing "name" parameter'))
+        column_by_name = self.service.tax_benefit_system.column_by_name
+        unknown_names = [
+            name
+            for name in names
+            if name not in column_by_name
+            ]
+        if unknown_names:
+            return self.respond_json(400, dict(error = u'Unknown variables: {}'.format(u', '.join(unknown_names))))
+        # Parser prints the nodes it fails to parse.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            data = getattr(self.service, query_method_name)(names)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        log.debug(u'{} answered in {:.1f} ms ({})'.format(self.path, (time.time() - start_time) * 1000,
+            dict(self.service.stats)))
+        return self.respond_json(200, data)
+
+    def log_message(self, format, *args):
+        log.info(format % args)
+
+    def respond_json(self, status, data):
+        body = json.dumps(data, sort_keys = True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_mtime(file_path):
+    try:
+        return os.stat(file_path).st_mtime
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'directory where parsed formulas are cached between runs (default: no cache)')
+    parser.add_argument('-c', '--country-package', default = 'openfisca_france',
+        help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-f', '--front-end', choices = ('ast', 'lib2to3'), default = 'lib2to3',
+        help = u'module used to parse Python source code (default: lib2to3)')
+    parser.add_argument('-l', '--lean', action = 'store_true', default = False,
+        help = u"don't keep syntax trees after parsing, to use less memory")
+    parser.add_argument('-m', '--max-entries', default = 4096, type = int,
+        help = u'maximum number of per-column results kept in cache (default: 4096)')
+    parser.add_argument('-p', '--port', default = 2015, type = int,
+        help = u'port of localhost where queries are served (default: 2015)')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO, stream = sys.stderr)
+
+    country_package = importlib.import_module(args.country_package)
+    tax_benefit_system = country_package.CountryTaxBenefitSystem()
+    tax_benefit_system.get_legislation()
+
+    # Parsers are not thread-safe: requests are handled one at a time.
+    RequestHandler.service = ExtractionService(
+        cache_dir = args.cache_dir,
+        front_end = args.front_end.decode('utf-8'),
+        lean = args.lean,
+        max_entries = args.max_entries,
+        tax_benefit_system = tax_benefit_system,
+        )
+    server = BaseHTTPServer.HTTPServer(('localhost', args.port), RequestHandler)
+    log.info(u'Serving on http://localhost:{}/'.format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
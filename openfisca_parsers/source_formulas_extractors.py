@@ -26,14 +26,31 @@
 """Extract input variables from Python formulas using lib2to3."""
 
 
+import ast
+import collections
+import inspect
 import lib2to3.pgen2.driver
 import lib2to3.pygram
 import lib2to3.pytree
 import logging
+import os
+import tokenize
 
-from . import formulas_parsers_2to3
+from . import formulas_parsers_2to3, formulas_parsers_ast
 
 
+# Names of the methods of simulations whose first argument is the name of a variable to calculate
+calculation_methods_name = frozenset([
+    'calculate',
+    'calculate_add',
+    'calculate_add_divide',
+    'calculate_divide',
+    'compute',
+    'compute_add',
+    'compute_add_divide',
+    'compute_divide',
+    'get_array',
+    ])
 log = logging.getLogger(__name__)
 
 
@@ -44,8 +61,7 @@ class Call(formulas_parsers_2to3.Call):
             named_arguments = named_arguments, node = node, parser = parser,
             positional_arguments = positional_arguments, star_argument = star_argument, subject = subject)
 
-        if self.subject.name in ('calculate', 'calculate_add', 'calculate_add_divide', 'calculate_divide', 'compute',
-                'compute_add', 'compute_add_divide', 'compute_divide', 'get_array'):
+        if self.subject.name in calculation_methods_name:
             # TODO: Guess input_variable instead of assuming that it is a string with a "value" attribute.
             input_variable = self.positional_arguments[0]
             while isinstance(input_variable, parser.Variable):
@@ -71,6 +87,7 @@ class Call(formulas_parsers_2to3.Call):
 
 class Parser(formulas_parsers_2to3.Parser):
     Call = Call
+    helper_source_files_path = None  # Source files of the module functions used by the formula of the last column
 
     def get_source_formulas(self, column):
         formula_class = column.formula_class
@@ -86,19 +103,156 @@ class Parser(formulas_parsers_2to3.Parser):
             pass
         del self.column
         del self.source_formulas
-        self.python_module_by_name.clear()
+        self.helper_source_files_path = self.get_helper_source_files_path()
+        # Keep module wrappers for next columns, but forget the functions parsed with the arguments of this column.
+        self.function_variable_by_key.clear()
         return source_formulas
 
+    def get_source_formulas_and_path(self, column):
+        """Return the source formulas of a column and the path used to find them.
 
-def extract_source_formulas(tax_benefit_system, name):
-    extractor = setup(tax_benefit_system)
+        The path is u'scan' when scanning the tokens of the formula was enough (see scan_source_formulas) and u'parser'
+        when the formula has been parsed.
+        """
+        formula_class = column.formula_class
+        assert formula_class is not None, "Column {} has no formula".format(column.name)
+        if column.is_input_variable():
+            return None, None
+        source_formulas = scan_source_formulas(formula_class, self.source_locator)
+        if source_formulas is not None:
+            return source_formulas, u'scan'
+        return self.get_source_formulas(column), u'parser'
+
+
+class AstParser(formulas_parsers_ast.Parser, Parser):
+    """Parser using the front end based on the ast module instead of lib2to3"""
+
+
+class SourceFormulasIndex(object):
+    """Index of the dependencies between all the formulas of a tax-benefit system, built once to answer many queries
+
+    Queries return the (name, depth) couples of the formulas of a closure in topological order: each formula comes after
+    the formulas of the closure it depends on (except inside dependency cycles, which are broken arbitrarily). The
+    depth of a formula is the number of dependencies between it and the nearest queried name.
+    """
+    consumers_name_by_name = None  # Names of the formulas that depend directly on each variable
+    source_formulas_name_by_name = None  # Names of the variables that each formula depends on directly
+
+    def __init__(self, source_formulas_by_name = None):
+        assert isinstance(source_formulas_by_name, dict)
+        self.source_formulas_name_by_name = dict(
+            (name, tuple(sorted(source_formulas)))
+            for name, source_formulas in source_formulas_by_name.iteritems()
+            )
+        consumers_name_by_name = collections.defaultdict(list)
+        for name, source_formulas_name in sorted(self.source_formulas_name_by_name.iteritems()):
+            for source_formula_name in source_formulas_name:
+                consumers_name_by_name[source_formula_name].append(name)
+        self.consumers_name_by_name = dict(
+            (name, tuple(consumers_name))
+            for name, consumers_name in consumers_name_by_name.iteritems()
+            )
+
+    def get_depth_by_name(self, names, adjacent_names_by_name):
+        """Return the depth of each name of the closure of given names, following adjacent names breadth-first."""
+        depth_by_name = {}
+        depth = 0
+        level_names = list(names)
+        while level_names:
+            next_level_names = []
+            for name in level_names:
+                if name not in depth_by_name:
+                    depth_by_name[name] = depth
+                    next_level_names.extend(adjacent_names_by_name.get(name, ()))
+            depth += 1
+            level_names = next_level_names
+        return depth_by_name
+
+    def get_downstream_formulas(self, names):
+        """Return the (name, depth) couples of the formulas that depend on given variables, directly or not, including
+        the given variables that have a formula.
+        """
+        return self.sort_topologically(self.get_depth_by_name(names, self.consumers_name_by_name))
+
+    def get_upstream_formulas(self, names):
+        """Return the (name, depth) couples of the formulas that given formulas depend on, directly or not, including
+        the given formulas.
+        """
+        return self.sort_topologically(self.get_depth_by_name(names, self.source_formulas_name_by_name))
+
+    def sort_topologically(self, depth_by_name):
+        """Return the (name, depth) couples of the formulas of a closure, each formula after its dependencies."""
+        source_formulas_name_by_name = self.source_formulas_name_by_name
+        sorted_names = []
+        visited_names = set()
+        for name in sorted(depth_by_name):
+            if name in visited_names or name not in source_formulas_name_by_name:
+                continue
+            visited_names.add(name)
+            # Depth-first traversal of the dependencies, without recursion because dependency chains can be long.
+            stack = [(name, iter(source_formulas_name_by_name[name]))]
+            while stack:
+                current_name, source_formulas_name = stack[-1]
+                for source_formula_name in source_formulas_name:
+                    if source_formula_name in depth_by_name and source_formula_name not in visited_names \
+                            and source_formula_name in source_formulas_name_by_name:
+                        visited_names.add(source_formula_name)
+                        stack.append((source_formula_name, iter(source_formulas_name_by_name[source_formula_name])))
+                        break
+                else:
+                    stack.pop()
+                    sorted_names.append(current_name)
+        return [
+            (name, depth_by_name[name])
+            for name in sorted_names
+            ]
+
+
+def extract_all_source_formulas(tax_benefit_system, parser = None, scan = False):
+    """Return the source formulas of all the formulas, by column name, and the path used for each (see
+    Parser.get_source_formulas_and_path).
+
+    When scan is False, every formula is parsed and the path is always u'parser'.
+    """
+    if parser is None:
+        parser = setup(tax_benefit_system)
+    path_by_name = {}
+    source_formulas_by_name = {}
+    for name, column in tax_benefit_system.column_by_name.iteritems():
+        if scan:
+            source_formulas, path = parser.get_source_formulas_and_path(column)
+        else:
+            source_formulas, path = parser.get_source_formulas(column), u'parser'
+        if source_formulas is not None:
+            path_by_name[name] = path
+            source_formulas_by_name[name] = source_formulas
+    return source_formulas_by_name, path_by_name
+
+
+def extract_source_formulas(tax_benefit_system, name, cache_dir = None, index = None, scan = False):
+    """Return the names of the formulas that the formula of given name depends on, directly or not (including itself).
+
+    When scan is True, formulas are parsed only when scanning their tokens is not enough. When a SourceFormulasIndex is
+    given, it is used instead of parsing formulas.
+    """
+    if index is not None:
+        return set(
+            source_formula_name
+            for source_formula_name, depth in index.get_upstream_formulas([name])
+            )
+    extractor = setup(tax_benefit_system, cache_dir = cache_dir)
 
     source_formulas = set()
     remaining_names = set([name])
     while remaining_names:
         name = remaining_names.pop()
         column = tax_benefit_system.column_by_name[name]
-        new_names = extractor.get_source_formulas(column)
+        if scan:
+            new_names, path = extractor.get_source_formulas_and_path(column)
+            if path is not None:
+                log.debug(u'Source formulas of {} found by {}'.format(name, path))
+        else:
+            new_names = extractor.get_source_formulas(column)
         if new_names is not None:
             source_formulas.add(name)
             for new_name in new_names:
@@ -107,9 +261,112 @@ def extract_source_formulas(tax_benefit_system, name):
     return source_formulas
 
 
-def setup(tax_benefit_system):
+def extract_source_formulas_index(tax_benefit_system, parser = None, scan = False):
+    """Extract the source formulas of all the formulas once, and return them as a SourceFormulasIndex."""
+    source_formulas_by_name, path_by_name = extract_all_source_formulas(tax_benefit_system, parser = parser,
+        scan = scan)
+    return SourceFormulasIndex(source_formulas_by_name = source_formulas_by_name)
+
+
+def function_may_calculate(function, visited_functions = None):
+    """Return whether a Python function may call a calculation method, directly or through the global functions it
+    uses.
+
+    The names used by the bytecode of the function (and of its nested functions) are checked, so a function that
+    doesn't mention any calculation method nor any function that does, can't calculate variables.
+    """
+    if visited_functions is None:
+        visited_functions = set()
+    elif function in visited_functions:
+        return False
+    visited_functions.add(function)
+    remaining_codes = [function.func_code]
+    while remaining_codes:
+        code = remaining_codes.pop()
+        for name in code.co_names:
+            if name in calculation_methods_name:
+                return True
+            global_function = function.func_globals.get(name)
+            if inspect.isfunction(global_function) and function_may_calculate(global_function,
+                    visited_functions = visited_functions):
+                return True
+        remaining_codes.extend(
+            constant
+            for constant in code.co_consts
+            if inspect.iscode(constant)
+            )
+    return False
+
+
+def scan_source_formulas(formula_class, source_locator):
+    """Return the names of the variables calculated by a formula class, found by scanning the tokens of its source.
+
+    The source of the class is found by a formulas_parsers_2to3.SourceLocator. Return None when the scan is not enough
+    and the formula must be parsed: when its source is not available, when a calculation method is called with
+    something else than a string literal as first argument, or when a function of its module (whose body may calculate
+    other variables) is called.
+    """
+    python_module = inspect.getmodule(formula_class)
+    source_file_path = inspect.getsourcefile(python_module) if python_module is not None else None
+    if source_file_path is None:
+        return None
+    location = source_locator.locate_class(formula_class.__name__, file_path = os.path.abspath(source_file_path))
+    if location is None:
+        return None
+    source_lines = source_locator.get_source_lines(location)
+    significant_tokens = [
+        (token_type, token_string)
+        for token_type, token_string, start, end, line in tokenize.generate_tokens(iter(source_lines).next)
+        if token_type not in (tokenize.COMMENT, tokenize.NL)
+        ]
+
+    source_formulas = set()
+    for token_index, (token_type, token_string) in enumerate(significant_tokens):
+        if token_type != tokenize.NAME or token_index + 1 >= len(significant_tokens) \
+                or significant_tokens[token_index + 1] != (tokenize.OP, '('):
+            if token_string in calculation_methods_name:
+                # Calculation method used without being called
+                return None
+            continue
+        previous_token = significant_tokens[token_index - 1] if token_index > 0 else (None, None)
+        if token_string in calculation_methods_name:
+            if previous_token != (tokenize.OP, '.'):
+                return None
+            # The first argument must be a (possibly implicitly concatenated) string literal.
+            argument_index = token_index + 2
+            while argument_index < len(significant_tokens) \
+                    and significant_tokens[argument_index][0] == tokenize.STRING:
+                argument_index += 1
+            if argument_index == token_index + 2 or argument_index >= len(significant_tokens) \
+                    or significant_tokens[argument_index] not in ((tokenize.OP, ','), (tokenize.OP, ')')):
+                return None
+            variable_name = ast.literal_eval(' '.join(
+                argument_token_string
+                for argument_token_type, argument_token_string in significant_tokens[token_index + 2:argument_index]
+                ))
+            if isinstance(variable_name, str):
+                variable_name = variable_name.decode('utf-8')
+            source_formulas.add(variable_name)
+        elif previous_token not in ((tokenize.OP, '.'), (tokenize.NAME, 'class'), (tokenize.NAME, 'def')):
+            function = getattr(python_module, token_string, None)
+            if inspect.isfunction(function) and function_may_calculate(function):
+                # Call of a function that may calculate other variables
+                return None
+    return source_formulas
+
+
+def setup(tax_benefit_system, cache_dir = None, front_end = u'lib2to3', lean = False):
+    """Return a parser of formulas, whose front end (u'ast' or u'lib2to3') converts Python source to syntax trees."""
+    if front_end == u'ast':
+        return AstParser(
+            lean = lean,
+            tax_benefit_system = tax_benefit_system,
+            )
+    assert front_end == u'lib2to3', u'Unknown front end: {}'.format(front_end)
     return Parser(
+        cache_dir = cache_dir,
         driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert,
             logger = log),
+        lean = lean,
         tax_benefit_system = tax_benefit_system,
         )